@@ -1,13 +1,14 @@
 import re
 import json
-from django.db.models import Q
-from datetime import datetime
+from django.db.models import Prefetch, Q
+from datetime import date, datetime
 from django.conf import settings
+from django.utils import timezone
 from django.contrib.gis.db import models
 from parler_rest.serializers import TranslatableModelSerializer, TranslatedFieldsField
 from rest_framework import serializers, viewsets, generics
 from rest_framework.exceptions import ParseError
-from django.contrib.gis.gdal import SRSException, CoordTransform, SpatialReference
+from django.contrib.gis.gdal import SRSException
 from django.contrib.gis.geos import Point, Polygon
 try:
     from django.contrib.gis.geos.base import gdal
@@ -15,12 +16,19 @@ except ImportError:
     # Django 1.9 onwards
     from django.contrib.gis import gdal
 from munigeo.models import AdministrativeDivisionType, AdministrativeDivision,\
-    AdministrativeDivisionGeometry, Municipality, Street, Address
+    AdministrativeDivisionGeometry, Municipality, Street, Address, DataGeneration
+from munigeo.utils import get_coord_transform, get_srs
 
 # Use the GPS coordinate system by default
 DEFAULT_SRID = 4326
 DATABASE_SRID = getattr(settings, 'PROJECTION_SRID', 4326)
-DEFAULT_SRS = SpatialReference(DEFAULT_SRID)
+
+
+def __getattr__(name):
+    # Built lazily to keep GDAL out of module import
+    if name == 'DEFAULT_SRS':
+        return get_srs(DEFAULT_SRID)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 all_views = []
 def register_view(klass, name):
@@ -45,7 +53,7 @@ def srid_to_srs(srid):
     except ValueError:
         raise ParseError("'srid' must be an integer")
     try:
-        srs = SpatialReference(srid)
+        srs = get_srs(srid)
     except SRSException:
         raise ParseError("SRID %d not found (try 4326 for GPS coordinate system)" % srid)
     return srs
@@ -101,29 +109,15 @@ class MPTTModelSerializer(serializers.ModelSerializer):
                 del self.fields[field_name]
 
 
-# Maintain a cache of different coordinate transformations for performance
-# reasons.
-srs_cache = {}
-coord_transforms = {}
-
 def geom_to_json(geom, target_srs):
-    srs = srs_cache.get(geom.srid, None)
-    if not srs:
-        srs = geom.srs
-        srs_cache[geom.srid] = srs
-
     if target_srs:
-        ct_id = '%s-%s' % (geom.srid, target_srs.srid)
-        ct = coord_transforms.get(ct_id, None)
-        if not ct:
-            ct = CoordTransform(srs, target_srs)
-            coord_transforms[ct_id] = ct
+        ct = get_coord_transform(geom.srid, target_srs.srid)
     else:
         ct = None
 
     if ct:
         wkb = geom.wkb
-        geom = gdal.OGRGeometry(wkb, srs)
+        geom = gdal.OGRGeometry(wkb, get_srs(geom.srid))
         geom.transform(ct)
         geom_name = geom.geom_name.lower()
     else:
@@ -163,7 +157,7 @@ class GeoModelSerializer(serializers.ModelSerializer):
 
     def to_representation(self, obj):
         # SRS is deduced in ViewSet and passed from there
-        self.srs = self.context.get('srs', DEFAULT_SRS)
+        self.srs = self.context['srs'] if 'srs' in self.context else get_srs(DEFAULT_SRID)
         ret = super(GeoModelSerializer, self).to_representation(obj)
         if obj is None:
             return ret
@@ -208,9 +202,19 @@ class AdministrativeDivisionSerializer(GeoModelSerializer, TranslatedModelSerial
         if not 'request' in self.context:
             return ret
         qparams = self.context['request'].query_params
-        if qparams.get('geometry', '').lower() in ('true', '1'):
-            geom = obj.geometry.boundary
-            ret['boundary'] = geom_to_json(geom, self.srs)
+        try:
+            geom_obj = obj.geometry
+        except AdministrativeDivisionGeometry.DoesNotExist:
+            geom_obj = None
+        if qparams.get('geometry', '').lower() in ('true', '1') and geom_obj is not None:
+            ret['boundary'] = geom_to_json(geom_obj.boundary, self.srs)
+        if geom_obj is not None and geom_obj.bbox is not None:
+            ring = geom_to_json(geom_obj.bbox, self.srs)['coordinates'][0]
+            xs = [coords[0] for coords in ring]
+            ys = [coords[1] for coords in ring]
+            ret['bbox'] = [min(xs), min(ys), max(xs), max(ys)]
+            ret['area'] = geom_obj.area
+            ret['label_point'] = geom_to_json(geom_obj.label_point, self.srs)
         ret['type'] = obj.type.type
         return ret
 
@@ -235,12 +239,45 @@ def parse_lat_lon(query_params):
 
     point = Point(lon, lat, srid=DEFAULT_SRID)
     if DEFAULT_SRID != DATABASE_SRID:
-        ct = CoordTransform(SpatialReference(DEFAULT_SRID),
-                            SpatialReference(DATABASE_SRID))
-        point.transform(ct)
+        point.transform(get_coord_transform(DEFAULT_SRID, DATABASE_SRID))
     return point
 
 
+# (date, divisions data generation) and the ids of the divisions with a
+# validity period that are valid on that date
+current_divisions = (None, frozenset())
+
+def get_current_time_bound_division_ids():
+    """Returns the ids of the divisions with a start or end date that are
+    valid today. They are cached until the date or the data changes."""
+    global current_divisions
+    today = timezone.localdate() if settings.USE_TZ else date.today()
+    generation = DataGeneration.objects.filter(entity='divisions').values_list('generation', flat=True).first()
+    key = (today, generation)
+    cached_key, ids = current_divisions
+    if cached_key != key:
+        ids = frozenset(AdministrativeDivision.objects.exclude(start__isnull=True, end__isnull=True)
+                        .valid_on(today).values_list('id', flat=True))
+        current_divisions = (key, ids)
+    return ids
+
+
+def filter_divisions_by_date(queryset, date_val):
+    """Filters a division queryset by the 'date' query parameter. Without
+    it only the currently valid divisions are included, 'all' includes
+    all of them."""
+    if date_val is None:
+        return queryset.filter(Q(start__isnull=True, end__isnull=True) |
+                               Q(pk__in=get_current_time_bound_division_ids()))
+    if date_val == 'all':
+        return queryset
+    try:
+        valid_date = datetime.strptime(date_val, '%Y-%m-%d').date()
+    except ValueError:
+        raise ParseError("Invalid date. The required format is YYYY-MM-DD, or 'all'.")
+    return queryset.valid_on(valid_date)
+
+
 class AdministrativeDivisionViewSet(GeoModelAPIView, viewsets.ReadOnlyModelViewSet):
     queryset = AdministrativeDivision.objects.all()
     serializer_class = AdministrativeDivisionSerializer
@@ -264,8 +301,9 @@ class AdministrativeDivisionViewSet(GeoModelAPIView, viewsets.ReadOnlyModelViewS
 
         point = parse_lat_lon(filters)
         if point:
-            geometries = AdministrativeDivisionGeometry.objects.filter(boundary__contains=point)
-            queryset = queryset.filter(geometry__in=geometries).distinct()
+            # The subdivided parts have few vertices each, which makes the
+            # exact test cheap. Points on the cut lines are in two parts.
+            queryset = queryset.filter(geometry__parts__boundary__intersects=point).distinct()
 
         if 'input' in filters:
             queryset = queryset.filter(name__icontains=filters['input'].strip())
@@ -291,20 +329,30 @@ class AdministrativeDivisionViewSet(GeoModelAPIView, viewsets.ReadOnlyModelViewS
 
             queryset = queryset.filter(ocd_id__in=ocd_id_list)
 
-        if 'geometry' in filters:
+        if 'bbox' in filters:
+            # Compares the stored bounding boxes only
+            poly = poly_from_bbox(filters['bbox'])
+            poly.srid = self.srs.srid
+            queryset = queryset.filter(geometry__bbox__intersects=poly)
+
+        for param, lookup in (('min_area', 'gte'), ('max_area', 'lte')):
+            if param in filters:
+                try:
+                    val = float(filters[param])
+                except ValueError:
+                    raise ParseError("'%s' must be a number" % param)
+                queryset = queryset.filter(**{'geometry__area__%s' % lookup: val})
+
+        if filters.get('geometry', '').lower() in ('true', '1'):
             queryset = queryset.select_related('geometry')
+        else:
+            # The summary columns are enough without the boundary
+            queryset = queryset.select_related('geometry').defer('geometry__boundary')
 
         if 'origin_id' in filters:
             queryset = queryset.filter(origin_id=filters['origin_id'])
 
-        if 'date' in filters:
-            try:
-                date = datetime.strptime(filters['date'], '%Y-%m-%d').date()
-            except ValueError:
-                raise ParseError('Invalid date. The required format is YYYY-MM-DD.')
-            queryset = queryset.filter(
-                (Q(start__lte=date) | Q(start__isnull=True)) &
-                (Q(end__gte=date)   | Q(end__isnull=True)))
+        queryset = filter_divisions_by_date(queryset, filters.get('date', None))
 
         queryset = queryset.select_related('type')
 
@@ -369,11 +417,21 @@ class AddressSerializer(GeoModelSerializer):
         if hasattr(obj, 'distance'):
             ret['distance'] = obj.distance.m
         ret['street'] = StreetSerializer(obj.street).data
+        # Prefetched by the view set when requested with 'divisions'
+        if hasattr(obj, 'division_list'):
+            ret['divisions'] = [{
+                'type': div.type.type,
+                'ocd_id': div.ocd_id,
+                'origin_id': div.origin_id,
+                'name': {trans.language_code: trans.name for trans in div.translations.all()},
+                'start': div.start,
+                'end': div.end,
+            } for div in obj.division_list]
         return ret
 
     class Meta:
         model = Address
-        exclude = ('id', 'street')
+        exclude = ('id', 'street', 'divisions')
 
 
 class AddressViewSet(GeoModelAPIView, viewsets.ReadOnlyModelViewSet):
@@ -430,6 +488,22 @@ class AddressViewSet(GeoModelAPIView, viewsets.ReadOnlyModelViewSet):
         if point:
             queryset = queryset.distance(point).order_by('distance')
 
+        divisions = filters.get('divisions', '').strip()
+        if divisions and divisions.lower() not in ('false', '0'):
+            # The memberships are precomputed, so this is a plain join.
+            # divisions=district,postcode_area limits the division types.
+            div_qs = AdministrativeDivision.objects.select_related('type').prefetch_related('translations')
+            if divisions.lower() not in ('true', '1'):
+                types = set(t for t in divisions.split(',') if t)
+                unknown = types - set(AdministrativeDivisionType.objects.filter(type__in=types)
+                                      .values_list('type', flat=True))
+                if unknown:
+                    raise ParseError("Unknown division types: %s" % ', '.join(sorted(unknown)))
+                div_qs = div_qs.filter(type__type__in=types)
+            # Memberships are stored for expired divisions too
+            div_qs = filter_divisions_by_date(div_qs, filters.get('date', None))
+            queryset = queryset.prefetch_related(Prefetch('divisions', queryset=div_qs, to_attr='division_list'))
+
         return queryset
 
 register_view(AddressViewSet, 'address')
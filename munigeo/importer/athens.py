@@ -3,7 +3,6 @@ import os
 import csv
 #import unicodecsv
 import requests
-import requests_cache
 import io
 import json
 
@@ -74,6 +73,7 @@ def convert_from_wgs84(coords):
 @register_importer
 class AthensImporter(Importer):
     name = "athens"
+    dry_run_types = ('pois',)
 
     def __init__(self, *args, **kwargs):
         super(AthensImporter, self).__init__(*args, **kwargs)
@@ -82,14 +82,14 @@ class AthensImporter(Importer):
 
     def import_municipalities(self):
         muni, c = Municipality.objects.get_or_create(id=30001, name="Athens")
+        if c:
+            self.record_changes('municipalities')
         self.logger.info("Athens municipality added.")
 
     def import_pois_from_citadel(self):
         muni = Municipality.objects.get(id=30001)
-        for d in CITADEL_LIST:
-            self._import_citadel(muni, d)
+        self.import_citadel_list(muni, CITADEL_LIST)
 
     def import_pois(self):
-        requests_cache.install_cache('geo_import_athens')
         self.logger.info("Importing POIs from Citadel")
         self.import_pois_from_citadel()
@@ -1,14 +1,50 @@
+import ast
+import importlib
 import os
 import requests
 import json
 import logging
+from contextlib import nullcontext
 from django.utils.text import slugify
 from django.contrib.gis.gdal import DataSource, SpatialReference, CoordTransform
 from django.contrib.gis.geos import GEOSGeometry, MultiPolygon, Point
 from django.conf import settings
+from django import db
 
 from munigeo.models import *
-from munigeo.importer.sync import ModelSyncher
+from munigeo.importer.sync import ModelSyncher, BulkModelSyncher, bulk_create_saved
+from munigeo.importer.fetch import SourceCache
+from munigeo.importer.journal import ImportJournal
+from munigeo.importer.metrics import ImportMetrics
+from munigeo.importer.diff import ImportDiff
+
+def chunked(iterable, size):
+    """Yields lists of at most `size` items from `iterable`."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_cache_dir():
+    """Returns the directory of the source cache and the import journals."""
+    cache_dir = getattr(settings, 'MUNIGEO_SOURCE_CACHE_DIR', None)
+    if cache_dir:
+        return cache_dir
+    if hasattr(settings, 'PROJECT_ROOT'):
+        root_dir = settings.PROJECT_ROOT
+    else:
+        root_dir = settings.BASE_DIR
+    return os.path.join(root_dir, 'data', 'cache')
+
+
+def get_import_journal(name):
+    return ImportJournal(os.path.join(get_cache_dir(), 'journal-%s.json' % name))
+
 
 def convert_from_wgs84(coords):
     pnt = Point(coords[1], coords[0], srid=4326)
@@ -16,40 +52,175 @@ def convert_from_wgs84(coords):
     return pnt
 
 class Importer(object):
-    def _import_citadel(self, muni, info):
+    # Time in seconds a cached Citadel document is used without revalidating it
+    citadel_ttl = 24 * 3600
+    # Import types that support the read-only --dry-run mode
+    dry_run_types = ()
+
+    poi_fields = ('name', 'category', 'municipality', 'location', 'street_address', 'zip_code')
+
+    def get_poi_categories(self, cat_defs):
+        """Returns POICategory objects by type for the `cat_defs` mapping of
+        type to description, creating the missing ones in bulk. In dry-run
+        mode the missing ones are returned unsaved."""
+        cats = {cat.type: cat for cat in POICategory.objects.filter(type__in=cat_defs.keys())}
+        missing = [POICategory(type=cat_type, description=desc)
+                   for cat_type, desc in cat_defs.items() if cat_type not in cats]
+        if not missing:
+            return cats
+        if self.dry_run:
+            for cat in missing:
+                self.diff.add('poi_categories', 'created', cat.type)
+        else:
+            bulk_create_saved(POICategory, missing)
+        for cat in missing:
+            cats[cat.type] = cat
+        return cats
+
+    def sync_pois(self, queryset, records):
+        """Synchronizes the POIs in `queryset` with `records`, which are dicts
+        of POI field values including 'origin_id'. New and changed POIs are
+        written and POIs missing from `records` deleted in bulk."""
+        with self.write_transaction():
+            syncher = BulkModelSyncher(queryset, lambda obj: obj.origin_id, update_fields=self.poi_fields,
+                                       metrics=self.metrics, stage='pois')
+            with self.metrics.stage('pois:diff') as m:
+                m.add_rows(len(records))
+                self._diff_pois(syncher, records)
+            if self.dry_run:
+                self.add_syncher_diff('pois', syncher)
+                return
+            created, updated, deleted = syncher.finish()
+            if created or updated or deleted:
+                self.record_changes('pois')
+        self.logger.info("POIs: %d created, %d updated, %d deleted" % (created, updated, deleted))
+
+    def _find_pois_outside(self, syncher, records):
+        """Returns the POIs with the origin ids of `records` that are not in
+        the synchronized queryset, e.g. ones of another category. Origin
+        ids are unique, so these are updated instead of created."""
+        origin_ids = [rec['origin_id'] for rec in records if syncher.get(rec['origin_id']) is None]
+        pois = {}
+        for chunk in chunked(origin_ids, 1000):
+            for poi in POI.objects.filter(origin_id__in=chunk):
+                poi._found = False
+                poi._changed = False
+                pois[poi.origin_id] = poi
+        return pois
+
+    def _diff_pois(self, syncher, records):
+        outside = self._find_pois_outside(syncher, records)
+        for rec in records:
+            poi = syncher.get(rec['origin_id'])
+            if poi is None:
+                poi = outside.get(rec['origin_id'])
+                if poi is None:
+                    poi = POI(origin_id=rec['origin_id'])
+                changed = True
+            elif poi._found:
+                self.logger.debug("%s: is duplicate, skipping" % rec['origin_id'])
+                continue
+            else:
+                changed = False
+                for field in self.poi_fields:
+                    if field in ('category', 'municipality'):
+                        # Compare ids to avoid fetching the related objects
+                        old, new = getattr(poi, field + '_id'), rec[field].pk
+                    elif field == 'location':
+                        old, new = poi.location.coords, rec['location'].coords
+                    else:
+                        old, new = getattr(poi, field), rec.get(field)
+                    if old != new:
+                        changed = True
+                        break
+            for field in self.poi_fields:
+                setattr(poi, field, rec.get(field))
+            syncher.mark(poi, changed)
+
+    def _import_citadel(self, muni, info, source=None):
         muni_slug = slugify(muni.name)
 
         self.logger.info("Importing from Citadel")
-        resp = requests.get(info['url'])
-        assert resp.status_code == 200
-        s = resp.content.decode('utf8')
-        resp_json = json.loads(s)
+        if source is None:
+            with self.metrics.stage('pois:fetch'):
+                source = self.fetch_source(info['url'], ttl=self.citadel_ttl)
+        stage = "%s:citadel:%s" % (self.name, info['url'])
+        if not self.source_changed(stage, source.digest):
+            self.logger.info("%s unchanged, skipping" % info['url'])
+            return
+        resp_json = source.json()
+
+        cat_defs = {cat_info['category']: cat_info['category_desc'] for cat_info in info['cat_map'].values()}
+        cats = self.get_poi_categories(cat_defs)
 
+        records = []
         for d in resp_json['dataset']['poi']:
             citadel_type = d['category'][0]
-            cat_info = info['cat_map'][citadel_type]
-            cat, _ = POICategory.objects.get_or_create(type=cat_info['category'],
-                    defaults={'description': cat_info['category_desc']})
+            cat = cats[info['cat_map'][citadel_type]['category']]
 
             origin_id = "%s-%s-%s" % (muni_slug, cat.type, d['id'])
-
-            try:
-                poi = POI.objects.get(origin_id=origin_id)
-            except POI.DoesNotExist:
-                poi = POI(origin_id=origin_id)
-            poi.name = d['title'].strip()
+            name = d['title'].strip()
             coords = d['location']['point']['pos']['posList']
             if not coords:
                 continue
             coords = [float(x) for x in coords.split(' ')]
             if coords[0] > 180 or coords[0] < -180:
-                self.logger.info("Skipping invalid coords for %s" % poi.name)
+                self.logger.info("Skipping invalid coords for %s" % name)
                 continue
-            poi.category = cat
-            poi.municipality = muni
-            poi.location = convert_from_wgs84(coords)
-            poi.save()
-            self.logger.info(poi)
+            records.append({
+                'origin_id': origin_id,
+                'name': name,
+                'category': cat,
+                'municipality': muni,
+                'location': convert_from_wgs84(coords),
+            })
+
+        queryset = POI.objects.filter(municipality=muni, origin_id__startswith='%s-' % muni_slug,
+                                      category__type__in=cat_defs.keys())
+        self.sync_pois(queryset, records)
+        self.mark_imported(stage, source.digest)
+
+    def import_citadel_list(self, muni, info_list):
+        with self.metrics.stage('pois:fetch'):
+            sources = self.fetch_sources([info['url'] for info in info_list], ttl=self.citadel_ttl)
+        for info, source in zip(info_list, sources):
+            self._import_citadel(muni, info, source)
+
+    def record_changes(self, entity):
+        """Records that the current stage has changed objects of `entity`
+        (one of DATA_ENTITIES). Its data generation is bumped when the write
+        transaction commits, or by geo_import after a shadow import."""
+        if self.dry_run:
+            return
+        self.changed_entities.add(entity)
+        if not self.options.get('shadow'):
+            db.transaction.on_commit(lambda: DataGeneration.objects.bump([entity]))
+
+    def write_transaction(self):
+        """Returns an atomic block for the writes of an import stage. In
+        dry-run mode nothing is written and no transaction is opened."""
+        if self.dry_run:
+            return nullcontext()
+        return db.transaction.atomic()
+
+    def add_syncher_diff(self, entity, syncher, deletes=True):
+        """Adds the changes marked in `syncher` to the dry-run diff. Objects
+        missing from the source are reported as deleted if `deletes` is
+        True and as missing otherwise."""
+        gen_id = syncher.generate_obj_id
+        for obj in syncher.obj_dict.values():
+            if not obj._found:
+                self.diff.add(entity, 'deleted' if deletes else 'missing', gen_id(obj))
+            elif obj.pk is None:
+                self.diff.add(entity, 'created', gen_id(obj))
+            elif obj._changed:
+                self.diff.add(entity, 'updated', gen_id(obj))
+
+    def log_vertex_reduction(self, label, before, after):
+        if not before:
+            return
+        self.logger.info("%s: boundary vertices reduced from %d to %d (%.1f %%)" % (
+            label, before, after, 100.0 * (before - after) / before))
 
     def find_data_file(self, data_file):
         for path in self.data_paths:
@@ -58,6 +229,56 @@ class Importer(object):
                 return full_path
         raise FileNotFoundError("Data file '%s' not found" % data_file)
 
+    def fetch_source(self, url, params=None, ttl=0, validate=None):
+        return self.source_cache.fetch(url, params=params, ttl=ttl, validate=validate)
+
+    def fetch_sources(self, urls, params=None, ttl=0, validate=None):
+        """Like fetch_source() but fetches all of `urls` concurrently."""
+        return self.source_cache.fetch_many(urls, params=params, ttl=ttl, validate=validate)
+
+    def source_changed(self, stage, digest):
+        if self.options.get('resume') and self.journal.stage_done(stage, digest):
+            return False
+        if self.options.get('force'):
+            return True
+        changed = not ImportedSource.objects.filter(stage=stage, digest=digest).exists()
+        if not changed:
+            self.diff.add_unchanged_stage(stage)
+        return changed
+
+    def mark_imported(self, stage, digest):
+        if self.dry_run:
+            return
+        ImportedSource.objects.update_or_create(stage=stage, defaults={'digest': digest})
+        self.journal.mark_done(stage, digest)
+
+    def get_checkpoint(self, stage, digest):
+        """Returns the progress saved with save_checkpoint() for `stage` if
+        the import is resumed and the source has not changed, else None."""
+        if not self.options.get('resume'):
+            return None
+        return self.journal.get_progress(stage, digest)
+
+    def save_checkpoint(self, stage, digest, progress):
+        self.journal.set_progress(stage, digest, progress)
+
+    def get_stream_checkpoint(self, stage, reader):
+        """Like get_checkpoint() for stages imported while `reader` streams
+        the source, before its digest is known. The progress is only
+        returned if the pages it was saved after have not changed, so the
+        reader must have been prefetched."""
+        if not self.options.get('resume'):
+            return None
+        digest, progress = self.journal.get_unfinished(stage)
+        if not isinstance(progress, dict) or reader.partial_digest(progress['pages']) != digest:
+            return None
+        return progress['progress']
+
+    def save_stream_checkpoint(self, stage, reader, progress):
+        pages = reader.pages_read
+        self.journal.set_progress(stage, reader.partial_digest(pages),
+                                  {'pages': pages, 'progress': progress})
+
     def __init__(self, options):
         self.logger = logging.getLogger("%s_importer" % self.name)
 
@@ -70,7 +291,19 @@ class Importer(object):
         app_path = os.path.abspath(os.path.join(module_path, '..', 'data'))
         self.data_paths.append(app_path)
 
+        self.source_cache = SourceCache(get_cache_dir())
+
         self.options = options
+        # In dry-run mode the changes are only collected into self.diff
+        self.dry_run = bool(options.get('dry_run'))
+        self.diff = ImportDiff()
+        self.changed_entities = set()
+        # Query counts and memory peaks are only traced when a report is requested
+        self.metrics = ImportMetrics(trace=bool(options.get('metrics_file')))
+        self.journal = get_import_journal(self.name)
+        # geo_import resets the journal itself when it runs several stages
+        if not options.get('resume') and not options.get('keep_journal') and not self.dry_run:
+            self.journal.reset()
 
 importers = {}
 
@@ -78,18 +311,55 @@ def register_importer(klass):
     importers[klass.name] = klass
     return klass
 
-def get_importers():
-    if importers:
-        return importers
+def _find_registered_names(path):
+    """Returns the names of the importers registered in the module at `path`
+    by reading its source, without importing it."""
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), path)
+    names = []
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        decorators = [getattr(dec, 'id', getattr(dec, 'attr', None)) for dec in node.decorator_list]
+        if 'register_importer' not in decorators:
+            continue
+        for stmt in node.body:
+            if not isinstance(stmt, ast.Assign):
+                continue
+            if any(isinstance(target, ast.Name) and target.id == 'name' for target in stmt.targets):
+                names.append(ast.literal_eval(stmt.value))
+    return names
+
+importer_modules = {}
+
+def find_importers():
+    """Returns a dict of importer name -> module path for the importers in
+    this package. The modules are not imported."""
+    if importer_modules:
+        return importer_modules
     module_path = __name__.rpartition('.')[0]
-    # Importing the packages will cause their register_importer() methods
-    # being called.
-    for fname in os.listdir(os.path.dirname(__file__)):
+    dir_path = os.path.dirname(__file__)
+    for fname in sorted(os.listdir(dir_path)):
         module, ext = os.path.splitext(fname)
         if ext.lower() != '.py':
             continue
         if module in ('__init__', 'base'):
             continue
-        full_path = "%s.%s" % (module_path, module)
-        ret = __import__(full_path, locals(), globals())
+        for name in _find_registered_names(os.path.join(dir_path, fname)):
+            importer_modules[name] = "%s.%s" % (module_path, module)
+    return importer_modules
+
+def get_importer(name):
+    """Imports only the module of importer `name` and returns its class."""
+    if name not in importers:
+        modules = find_importers()
+        if name not in modules:
+            raise KeyError(name)
+        # Importing the module calls its register_importer()
+        importlib.import_module(modules[name])
+    return importers[name]
+
+def get_importers():
+    for name in find_importers():
+        get_importer(name)
     return importers
@@ -0,0 +1,55 @@
+"""
+Change summaries for dry-run imports
+
+For every entity the ids of the objects an import would create, update and
+delete are collected. Objects that are no longer in the source but that the
+importer keeps are reported as missing.
+"""
+
+import json
+
+# Number of object ids listed per entity and change type in the report
+MAX_REPORTED_IDS = 100
+
+
+class ImportDiff(object):
+    changes = ('created', 'updated', 'deleted', 'missing')
+
+    def __init__(self):
+        self.entities = {}
+        self.unchanged_stages = []
+
+    def add(self, entity, change, obj_id):
+        assert change in self.changes
+        entity_changes = self.entities.setdefault(entity, {change: [] for change in self.changes})
+        entity_changes[change].append(str(obj_id))
+
+    def add_unchanged_stage(self, stage):
+        self.unchanged_stages.append(stage)
+
+    def update(self, other):
+        """Adds the changes collected in ImportDiff `other` to this diff."""
+        for entity, changes in other.entities.items():
+            for change, ids in changes.items():
+                for obj_id in ids:
+                    self.add(entity, change, obj_id)
+        self.unchanged_stages.extend(other.unchanged_stages)
+
+    @property
+    def has_changes(self):
+        return any(ids for changes in self.entities.values() for change, ids in changes.items()
+                   if change != 'missing')
+
+    def report(self, max_ids=MAX_REPORTED_IDS):
+        entities = {}
+        for entity, changes in self.entities.items():
+            entities[entity] = {change: {'count': len(ids), 'ids': sorted(ids)[:max_ids]}
+                                for change, ids in changes.items()}
+        return {
+            'changed': self.has_changes,
+            'entities': entities,
+            'unchanged_stages': self.unchanged_stages,
+        }
+
+    def as_json(self, **kwargs):
+        return json.dumps(self.report(**kwargs), indent=2, sort_keys=True)
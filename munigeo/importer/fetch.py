@@ -0,0 +1,208 @@
+"""
+Conditional fetching and on-disk caching of importer source data
+
+Downloaded documents are stored in a content-addressed object store
+(`<cache_dir>/objects/<sha256>`) and indexed by URL. A cached copy is used
+without contacting the server while it is younger than the source's TTL.
+After that it is revalidated with `If-None-Match` / `If-Modified-Since`.
+
+The digests of the documents let importers skip sources whose bytes have
+not changed since the last import, see ImportedSource.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from munigeo.importer.jsonfile import load_json, update_json
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# Number of sources fetched concurrently by fetch_many()
+FETCH_WORKERS = 8
+
+
+class SourceFetchError(Exception):
+    pass
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def combine_digests(digests):
+    h = hashlib.sha256()
+    for digest in digests:
+        h.update(digest.encode('ascii'))
+    return h.hexdigest()
+
+
+class CachedSource(object):
+    def __init__(self, url, path, digest, from_cache):
+        self.url = url
+        self.path = path
+        self.digest = digest
+        # True if the data was not transferred from the server
+        self.from_cache = from_cache
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    @property
+    def content(self):
+        with self.open() as f:
+            return f.read()
+
+    def json(self):
+        return json.loads(self.content.decode('utf8'))
+
+    def iter_content(self, chunk_size=CHUNK_SIZE):
+        with self.open() as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+    def __str__(self):
+        return "%s (%s)" % (self.url, self.digest[:12])
+
+
+class SourceCache(object):
+    def __init__(self, cache_dir, session=None, max_workers=FETCH_WORKERS):
+        self.cache_dir = cache_dir
+        self.object_dir = os.path.join(cache_dir, 'objects')
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.max_workers = max_workers
+        if session is None:
+            # Keep a pooled connection for every worker of fetch_many()
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self._lock = threading.RLock()
+        os.makedirs(self.object_dir, exist_ok=True)
+        self._load_index()
+
+    def _set_defaults(self, index):
+        index.setdefault('sources', {})
+
+    def _load_index(self):
+        self.index = load_json(self.index_path)
+        self._set_defaults(self.index)
+
+    def _update_index(self, func):
+        # The index is shared by all importers, which may run in separate
+        # processes, so changes are applied to its current contents on disk
+        def update(index):
+            self._set_defaults(index)
+            func(index)
+        with self._lock:
+            self.index = update_json(self.index_path, update)
+
+    def _object_path(self, digest):
+        return os.path.join(self.object_dir, digest)
+
+    def _remove_unreferenced(self, index, digest):
+        if any(entry['digest'] == digest for entry in index['sources'].values()):
+            return
+        try:
+            os.remove(self._object_path(digest))
+        except OSError:
+            pass
+
+    def _store(self, resp):
+        h = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.object_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                    h.update(chunk)
+                    f.write(chunk)
+            digest = h.hexdigest()
+            os.replace(tmp_path, self._object_path(digest))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return digest
+
+    def fetch(self, url, params=None, ttl=0, validate=None):
+        """Returns a CachedSource for the given URL.
+
+        `ttl` is the time in seconds a cached copy is used without
+        revalidating it with the server. `validate` is an optional callable
+        that is given the response and can raise an exception to prevent
+        caching an unusable document.
+        """
+        key = requests.Request('GET', url, params=params).prepare().url
+        with self._lock:
+            entry = self.index['sources'].get(key)
+        if entry and not os.path.exists(self._object_path(entry['digest'])):
+            entry = None
+
+        headers = {}
+        if entry:
+            path = self._object_path(entry['digest'])
+            if ttl and time.time() - entry['fetched_at'] < ttl:
+                logger.debug("%s: using cached copy" % key)
+                return CachedSource(key, path, entry['digest'], True)
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        resp = self.session.get(key, headers=headers, stream=True)
+        try:
+            if resp.status_code == 304 and entry:
+                logger.debug("%s: not modified" % key)
+                fetched_at = time.time()
+
+                def update(index):
+                    if key in index['sources']:
+                        index['sources'][key]['fetched_at'] = fetched_at
+                self._update_index(update)
+                return CachedSource(key, path, entry['digest'], True)
+            if resp.status_code != 200:
+                raise SourceFetchError("%s: HTTP request failed with %d" % (key, resp.status_code))
+            if validate:
+                validate(resp)
+            digest = self._store(resp)
+        finally:
+            resp.close()
+
+        new_entry = {
+            'digest': digest,
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'fetched_at': time.time(),
+        }
+
+        def update(index):
+            old_entry = index['sources'].get(key)
+            index['sources'][key] = new_entry
+            if old_entry and old_entry['digest'] != digest:
+                self._remove_unreferenced(index, old_entry['digest'])
+        self._update_index(update)
+        return CachedSource(key, self._object_path(digest), digest, False)
+
+    def fetch_many(self, urls, params=None, ttl=0, validate=None):
+        """Fetches `urls` concurrently and returns a list of CachedSources
+        in the same order. The arguments are as in fetch()."""
+        urls = list(urls)
+        if len(urls) < 2 or self.max_workers < 2:
+            return [self.fetch(url, params=params, ttl=ttl, validate=validate) for url in urls]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls))) as executor:
+            futures = [executor.submit(self.fetch, url, params=params, ttl=ttl, validate=validate)
+                       for url in urls]
+            return [future.result() for future in futures]
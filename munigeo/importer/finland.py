@@ -2,81 +2,167 @@
 munigeo importer for Finnish nation-level data
 """
 
+import functools
+import multiprocessing
 import re
 import os
 import zipfile
-import requests
-import io
+from concurrent.futures import ProcessPoolExecutor
 
 from django import db
 from django.contrib.gis.gdal import DataSource
-from django.contrib.gis.geos import MultiPolygon, Polygon
+from django.contrib.gis.geos import GEOSGeometry, Polygon
+from django.utils import timezone
 
 from munigeo.importer.base import Importer, register_importer
-from munigeo.importer.sync import ModelSyncher
-from munigeo.models import AdministrativeDivision, AdministrativeDivisionGeometry, AdministrativeDivisionType, \
-    Municipality, PROJECTION_SRID
+from munigeo.importer.sync import bulk_create_saved, bulk_save_translations
+from munigeo.importer.fetch import file_digest
+from munigeo.importer.geometry import FIN_GRID, TM35_SRID, get_normalize_options, set_layer_filters, \
+    transform_to_multipolygon
+from munigeo.importer.tree import placeholder_tree_fields, rebuild_trees
+from munigeo.models import AdministrativeDivision, AdministrativeDivisionGeometry, \
+    AdministrativeDivisionGeometryPart, AdministrativeDivisionType, Municipality, PROJECTION_SRID
 from munigeo import ocd
-from .helsinki import FIN_GRID, TM35_SRID
-
-try:
-    from concurrent.futures import ThreadPoolExecutor
-except ImportError:
-    ThreadPoolExecutor = None
-# Disable threaded mode for now
-ThreadPoolExecutor = None
 
 MUNI_DATA_URL = 'http://kartat.kapsi.fi/files/kuntajako/kuntajako_1000k/etrs89/gml/TietoaKuntajaosta_2016_1000k.zip'
+# Time in seconds the downloaded municipality data is used without revalidating it
+MUNI_DATA_TTL = 7 * 24 * 3600
+# Only municipalities are read from the administrative units
+MUNI_FILTER = "nationalLevel = '4thOrder'"
+# Finnish and Swedish names in the 'text' field, e.g. "(2:Helsinki,Helsingfors)"
+MUNI_NAME_RE = re.compile(r'\(2:([\w\s:-]+),([\w\s:-]+)\)')
+# Boundary vertices closer than this (in PROJECTION_SRID units) are treated as unchanged
+MUNI_GEOM_TOLERANCE = 0.01
 
 
 @register_importer
 class FinlandImporter(Importer):
     name = "finland"
+    # Boundary normalization options, see NORMALIZE_DEFAULTS
+    muni_normalize = None
+
+    def _parse_muni(self, feat):
+        m = MUNI_NAME_RE.match(feat.get('text'))
+        return str(feat.get('nationalCode')), m.groups()[0], m.groups()[1]
+
+    def _transform_geometries(self, wkbs, srs_wkt):
+        """Transforms the municipality boundaries to PROJECTION_SRID in a
+        process pool and normalizes them. Returns a list of GEOS MultiPolygons."""
+        normalize = get_normalize_options(self.muni_normalize)
+        func = functools.partial(transform_to_multipolygon, srs_wkt=srs_wkt, srid=PROJECTION_SRID,
+                                 normalize=normalize)
+        workers = self.options.get('workers') or os.cpu_count() or 1
+        if workers > 1 and len(wkbs) > 1:
+            # Forked workers must not inherit open database connections.
+            db.connections.close_all()
+            chunksize = max(1, len(wkbs) // (workers * 4))
+            # Forked workers inherit the configured Django setup
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+                results = list(executor.map(func, wkbs, chunksize=chunksize))
+        else:
+            results = [func(wkb) for wkb in wkbs]
+        if normalize:
+            self.log_vertex_reduction("Municipalities", sum(r[1] for r in results), sum(r[2] for r in results))
+        return [GEOSGeometry(memoryview(ewkb)) for ewkb, before, after in results]
+
+    def _get_names(self, obj):
+        return tuple(obj.safe_translation_getter('name', language_code=lang, any_language=False)
+                     for lang in ('fi', 'sv'))
+
+    def _save_munis(self, munis):
+        """Creates or updates the divisions, boundaries and Municipality
+        objects for `munis`, a list of ((origin_id, name_fi, name_sv), geom)
+        tuples, with bulk queries. Unchanged objects are not written.
+
+        Returns the divisions and the numbers of created or updated
+        divisions and municipalities."""
+        muni_type = self.muni_type
+        qs = AdministrativeDivision.objects.filter(type=muni_type).prefetch_related('translations')
+        divs = {div.origin_id: div for div in qs}
+        now = timezone.now()
+
+        new_divs = []
+        old_divs = []
+        for (muni_id, name_fi, name_sv), geom in munis:
+            self.logger.debug(name_fi)
+            munidiv = divs.get(muni_id)
+            if munidiv is None:
+                munidiv = AdministrativeDivision(origin_id=muni_id, type=muni_type)
+                placeholder_tree_fields(munidiv)
+                divs[muni_id] = munidiv
+                new_divs.append(munidiv)
+                old_state = None
+            else:
+                old_divs.append(munidiv)
+                old_state = (self._get_names(munidiv), munidiv.ocd_id)
+            munidiv.set_current_language('fi')
+            munidiv.name = name_fi
+            munidiv.set_current_language('sv')
+            munidiv.name = name_sv
+            munidiv.ocd_id = ocd.make_id(country='fi', kunta=name_fi)
+            munidiv._changed = old_state != (self._get_names(munidiv), munidiv.ocd_id)
+            munidiv._names = (name_fi, name_sv)
+            munidiv._boundary = geom
+
+        bulk_create_saved(AdministrativeDivision, new_divs)
+        saved_divs = new_divs + old_divs
+
+        geoms = {geom_obj.division_id: geom_obj for geom_obj in
+                 AdministrativeDivisionGeometry.objects.filter(division__in=old_divs).only(
+                     'id', 'division', 'boundary')}
+        new_geoms = []
+        changed_geoms = []
+        for munidiv in saved_divs:
+            geom_obj = geoms.get(munidiv.pk)
+            if geom_obj is None:
+                geom_obj = AdministrativeDivisionGeometry(division=munidiv)
+                new_geoms.append(geom_obj)
+            elif geom_obj.boundary.equals_exact(munidiv._boundary, MUNI_GEOM_TOLERANCE):
+                continue
+            else:
+                changed_geoms.append(geom_obj)
+            munidiv._changed = True
+            geom_obj.boundary = munidiv._boundary
+            geom_obj.update_summary()
+
+        changed_divs = [munidiv for munidiv in old_divs if munidiv._changed]
+        for munidiv in changed_divs:
+            munidiv.modified_at = now
+        AdministrativeDivision.objects.bulk_update(changed_divs, ['ocd_id', 'modified_at'])
+        bulk_save_translations(saved_divs)
+        bulk_create_saved(AdministrativeDivisionGeometry, new_geoms)
+        AdministrativeDivisionGeometry.objects.bulk_update(changed_geoms, ['boundary', 'bbox', 'area', 'label_point'])
+        AdministrativeDivisionGeometryPart.objects.refresh(
+            [geom_obj.pk for geom_obj in new_geoms + changed_geoms])
+
+        muni_ids = {munidiv.ocd_id.split('/')[-1].split(':')[-1]: munidiv for munidiv in saved_divs}
+        existing = Municipality.objects.filter(id__in=muni_ids.keys()).prefetch_related('translations')
+        existing = {muni.id: muni for muni in existing}
+        new_munis = []
+        changed_munis = []
+        for muni_id, munidiv in muni_ids.items():
+            muni = existing.get(muni_id)
+            if muni is None:
+                muni = Municipality(id=muni_id)
+                new_munis.append(muni)
+            elif muni.division_id != munidiv.pk or self._get_names(muni) != munidiv._names:
+                changed_munis.append(muni)
+            else:
+                continue
+            muni.division = munidiv
+            muni.set_current_language('fi')
+            muni.name = munidiv._names[0]
+            muni.set_current_language('sv')
+            muni.name = munidiv._names[1]
+        bulk_create_saved(Municipality, new_munis)
+        Municipality.objects.bulk_update(changed_munis, ['division'])
+        bulk_save_translations(new_munis + changed_munis)
 
-    def _process_muni(self, syncher, feat):
-        muni_id = str(feat.get('nationalCode'))
-        t = feat.get('text')
-        m = re.match(r'\(2:([\w\s:-]+),([\w\s:-]+)\)', t)
-        name_fi = m.groups()[0]
-        name_sv = m.groups()[1]
-        self.logger.debug(name_fi)
-
-        munidiv = syncher.get(muni_id)
-        if not munidiv:
-            munidiv = AdministrativeDivision(origin_id=muni_id)
-        munidiv.set_current_language('fi')
-        munidiv.name = name_fi
-        munidiv.set_current_language('sv')
-        munidiv.name = name_sv
-        munidiv.ocd_id = ocd.make_id(country='fi', kunta=name_fi)
-        munidiv.type = self.muni_type
-        munidiv.save()
-        syncher.mark(munidiv)
-
-        try:
-            geom_obj = munidiv.geometry
-        except AdministrativeDivisionGeometry.DoesNotExist:
-            geom_obj = AdministrativeDivisionGeometry(division=munidiv)
-        geom = feat.geom
-        geom.transform(PROJECTION_SRID)
-        # Store only the land boundaries
-        # geom = geom.geos.intersection(self.land_area)
-        geom = geom.geos
-        if geom.geom_type == 'Polygon':
-            geom = MultiPolygon(geom)
-        geom_obj.boundary = geom
-        geom_obj.save()
-
-        try:
-            muni = Municipality.objects.get(division=munidiv)
-        except Municipality.DoesNotExist:
-            muni = Municipality(division=munidiv)
-        muni.set_current_language('fi')
-        muni.name = name_fi
-        muni.set_current_language('sv')
-        muni.name = name_sv
-        muni.id = munidiv.ocd_id.split('/')[-1].split(':')[-1]
-        muni.save()
+        divs_changed = len(new_divs) + len(changed_divs)
+        munis_changed = len(new_munis) + len(changed_munis)
+        self.logger.info("%d municipalities imported (%d new, %d changed)" % (
+            len(saved_divs), len(new_divs), divs_changed - len(new_divs)))
+        return saved_divs, divs_changed, munis_changed
 
     def _setup_land_area(self):
         fin_bbox = Polygon.from_bbox(FIN_GRID)
@@ -90,80 +176,83 @@ class FinlandImporter(Importer):
         self.land_area.transform(PROJECTION_SRID)
 
     def load_muni_data(self):
+        """Fetches the municipality data through the source cache and returns
+        the path to the extracted XML file and the digest of the ZIP file."""
         self.logger.info("Loading Finnish municipalities")
-        resp = requests.get(MUNI_DATA_URL)
-        with io.BytesIO(resp.content) as f:
-            zf = zipfile.ZipFile(f)
+        source = self.fetch_source(MUNI_DATA_URL, ttl=MUNI_DATA_TTL)
+        with zipfile.ZipFile(source.path) as zf:
             for name in zf.namelist():
                 if name.endswith('.xml'):
                     break
             else:
                 raise Exception('XML file not found in %s' % MUNI_DATA_URL)
-            out_path = os.path.join(self.data_paths[0], 'fi')
-            try:
-                os.makedirs(out_path)
-            except OSError:
-                pass
-            zf.extract(name, out_path)
-            return os.path.join(out_path, name)
+            out_path = os.path.join(self.source_cache.cache_dir, 'extracted', source.digest)
+            xml_path = os.path.join(out_path, name)
+            if not os.path.exists(xml_path):
+                zf.extract(name, out_path)
+        return xml_path, source.digest
 
     def find_muni_data(self):
+        """Returns the path to the municipality XML file and a digest of its
+        contents. A copy placed in one of the data paths takes precedence
+        over the downloaded one."""
         for root_path in self.data_paths:
             base_path = os.path.join(root_path, 'fi')
-            if not os.path.exists(base_path):
-                os.makedirs(base_path)
-            paths = os.listdir(base_path)
-            for p in paths:
-                if 'Kuntajaosta' in p:
-                    break
-            else:
-                return self.load_muni_data()
-            xml_dir = p
-            base_path = os.path.join(base_path, xml_dir)
-            paths = os.listdir(base_path)
-            for p in paths:
-                if p.endswith('.xml'):
-                    break
-            else:
-                return self.load_muni_data()
-            return os.path.join(base_path, p)
+            if not os.path.isdir(base_path):
+                continue
+            for xml_dir in os.listdir(base_path):
+                if 'Kuntajaosta' not in xml_dir:
+                    continue
+                dir_path = os.path.join(base_path, xml_dir)
+                for p in os.listdir(dir_path):
+                    if p.endswith('.xml'):
+                        path = os.path.join(dir_path, p)
+                        return path, file_digest(path)
+        return self.load_muni_data()
 
     def import_municipalities(self):
         # self._setup_land_area()
 
         self.logger.info("Loading municipality boundaries")
-        path = self.find_muni_data()
+        with self.metrics.stage('municipalities:fetch'):
+            path, digest = self.find_muni_data()
+        stage = "%s:municipalities" % self.name
+        if not self.source_changed(stage, digest):
+            self.logger.info("Municipality data unchanged since the last import, skipping")
+            return
         ds = DataSource(path)
         lyr = ds[0]
         assert lyr.name == "AdministrativeUnit"
+        set_layer_filters(lyr, attribute_filter=MUNI_FILTER)
 
         defaults = {'name': 'Municipality'}
         muni_type, _ = AdministrativeDivisionType.objects.get_or_create(type='muni', defaults=defaults)
         self.muni_type = muni_type
 
-        syncher = ModelSyncher(AdministrativeDivision.objects.filter(type=muni_type), lambda obj: obj.origin_id)
+        muni_keys = []
+        wkbs = []
+        srs_wkt = None
+        with self.metrics.stage('municipalities:parse') as m:
+            for feat in lyr:
+                geom = feat.geom
+                if srs_wkt is None:
+                    srs_wkt = geom.srs.wkt
+                muni_keys.append(self._parse_muni(feat))
+                wkbs.append(bytes(geom.wkb))
+            m.add_rows(len(wkbs))
 
-        # If running under Python 3, parallelize the heavy lifting.
-        if ThreadPoolExecutor:
-            executor = ThreadPoolExecutor(max_workers=8)
-            futures = []
-        else:
-            executor = None
-
-        with db.transaction.atomic():
-            with AdministrativeDivision.objects.disable_mptt_updates():
-                for idx, feat in enumerate(lyr):
-                    if feat.get('nationalLevel') != '4thOrder':
-                        continue
-                    # Process the first in a single-threaded way to catch
-                    # possible exceptions early.
-                    if executor and idx > 0:
-                        futures.append(executor.submit(self._process_muni, syncher, feat))
-                    else:
-                        self._process_muni(syncher, feat)
-                if executor:
-                    for f in futures:
-                        res = f.result()
-                    executor.shutdown()
-
-            AdministrativeDivision.objects.rebuild()
+        self.logger.info("Transforming %d municipality boundaries" % len(wkbs))
+        with self.metrics.stage('municipalities:transform') as m:
+            geoms = self._transform_geometries(wkbs, srs_wkt)
+            m.add_rows(len(geoms))
+
+        with self.metrics.stage('municipalities:write') as m, db.transaction.atomic():
+            saved_divs, divs_changed, munis_changed = self._save_munis(list(zip(muni_keys, geoms)))
+            rebuild_trees(AdministrativeDivision, set(munidiv.tree_id for munidiv in saved_divs))
+            m.add_rows(len(geoms))
+            if divs_changed:
+                self.record_changes('divisions')
+            if munis_changed:
+                self.record_changes('municipalities')
+
+        self.mark_imported(stage, digest)
@@ -0,0 +1,211 @@
+"""
+Geometry helpers for the importers
+"""
+
+import hashlib
+from ctypes import POINTER, c_char_p, c_double, c_int, c_void_p
+
+from django.contrib.gis.gdal import CoordTransform, GDALException, OGRGeometry
+from django.contrib.gis.gdal.libgdal import lgdal
+from django.contrib.gis.geos import LinearRing, MultiPolygon, Polygon
+
+from munigeo.utils import get_srs
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# ETRS-TM35FIN, the Finnish national projection
+TM35_SRID = 3067
+# The Finnish national grid coordinates in TM35-FIN according to JHS-180
+# specification. We use it as a bounding box.
+FIN_GRID = [-548576, 6291456, 1548576, 8388608]
+
+# Approximate length of one degree of latitude in metres
+METRES_PER_DEGREE = 111320.0
+
+# Default boundary normalization, distances in metres. Coordinates are
+# snapped to `grid_size` and vertices that deviate less than `simplify`
+# from a straight line are dropped. Overridden with the `normalize`
+# setting of a division configuration; `normalize: false` disables it.
+NORMALIZE_DEFAULTS = {
+    'make_valid': True,
+    'grid_size': 0.001,
+    'simplify': 0.01,
+}
+
+_oct_transform = None
+_set_attribute_filter = None
+
+
+def _get_oct_transform():
+    global _oct_transform
+    if _oct_transform is None:
+        func = lgdal.OCTTransform
+        func.argtypes = [c_void_p, c_int, POINTER(c_double), POINTER(c_double), POINTER(c_double)]
+        func.restype = c_int
+        _oct_transform = func
+    return _oct_transform
+
+
+def _get_set_attribute_filter():
+    global _set_attribute_filter
+    if _set_attribute_filter is None:
+        func = lgdal.OGR_L_SetAttributeFilter
+        func.argtypes = [c_void_p, c_char_p]
+        func.restype = c_int
+        _set_attribute_filter = func
+    return _set_attribute_filter
+
+
+def set_layer_filters(lyr, bbox=None, bbox_srid=None, attribute_filter=None):
+    """Sets an OGR spatial filter for `bbox` (minx, miny, maxx, maxy in
+    `bbox_srid`, defaulting to the layer's SRS) and an OGR SQL attribute
+    filter on an OGR layer, so that the driver skips the other features."""
+    if bbox:
+        geom = OGRGeometry.from_bbox(bbox)
+        if bbox_srid and lyr.srs and lyr.srs.srid != bbox_srid:
+            geom.transform(CoordTransform(get_srs(bbox_srid), lyr.srs))
+        lyr.spatial_filter = geom
+    if attribute_filter:
+        err = _get_set_attribute_filter()(lyr.ptr, attribute_filter.encode('utf8'))
+        if err:
+            raise GDALException("Invalid attribute filter: %s" % attribute_filter)
+
+
+def transform_coords(ct, xs, ys):
+    """Transforms sequences of x and y coordinates with CoordTransform `ct`
+    in a single GDAL call. Returns the transformed x and y coordinates as
+    two lists."""
+    n = len(xs)
+    assert len(ys) == n
+    if not n:
+        return [], []
+    x_arr = (c_double * n)(*xs)
+    y_arr = (c_double * n)(*ys)
+    if not _get_oct_transform()(ct.ptr, n, x_arr, y_arr, None):
+        raise GDALException("Coordinate transformation failed")
+    return list(x_arr), list(y_arr)
+
+
+def metres_to_srid_units(metres, srid):
+    """Converts a distance in metres to the (approximate) units of `srid`."""
+    if get_srs(srid).geographic:
+        return metres / METRES_PER_DEGREE
+    return metres
+
+
+def find_moved_points(old_xs, old_ys, new_xs, new_ys, tolerance):
+    """Compares two sets of point coordinates as whole arrays and returns
+    the indices of the points that have moved at least `tolerance`."""
+    if numpy is not None:
+        dx = numpy.asarray(new_xs, dtype=float) - numpy.asarray(old_xs, dtype=float)
+        dy = numpy.asarray(new_ys, dtype=float) - numpy.asarray(old_ys, dtype=float)
+        return numpy.flatnonzero(dx * dx + dy * dy >= tolerance * tolerance).tolist()
+    tol2 = tolerance * tolerance
+    return [idx for idx, (ox, oy, nx, ny) in enumerate(zip(old_xs, old_ys, new_xs, new_ys))
+            if (nx - ox) ** 2 + (ny - oy) ** 2 >= tol2]
+
+
+def get_normalize_options(config):
+    """Returns the normalization options for a `normalize` configuration
+    value, or None if normalization is disabled."""
+    if config is False:
+        return None
+    options = dict(NORMALIZE_DEFAULTS)
+    if isinstance(config, dict):
+        options.update(config)
+    return options
+
+
+def _polygons(geom):
+    """Returns the polygons of a polygonal geometry or a collection."""
+    if geom.geom_type == 'Polygon':
+        return [geom]
+    if geom.geom_type in ('MultiPolygon', 'GeometryCollection'):
+        polys = []
+        for part in geom:
+            polys += _polygons(part)
+        return polys
+    return []
+
+
+def to_multipolygon(geom):
+    polys = _polygons(geom)
+    return MultiPolygon(*polys, srid=geom.srid)
+
+
+def geometry_digest(geom):
+    """Returns a digest of the coordinates of `geom` for change detection."""
+    return hashlib.sha256(bytes(geom.wkb)).hexdigest()
+
+
+def _snap_ring(coords, grid):
+    ring = []
+    for c in coords:
+        pt = (round(c[0] / grid) * grid, round(c[1] / grid) * grid)
+        if not ring or ring[-1] != pt:
+            ring.append(pt)
+    if ring[0] != ring[-1]:
+        ring.append(ring[0])
+    # A ring needs at least three distinct points
+    if len(ring) < 4:
+        return None
+    return LinearRing(ring)
+
+
+def snap_to_grid(geom, grid):
+    """Snaps the coordinates of a polygonal geometry to `grid` and drops the
+    repeated points and collapsed rings that result."""
+    polys = []
+    for poly in _polygons(geom):
+        shell = _snap_ring(poly.exterior_ring.coords, grid)
+        if shell is None:
+            continue
+        holes = [_snap_ring(ring.coords, grid) for ring in poly[1:]]
+        polys.append(Polygon(shell, *[hole for hole in holes if hole is not None]))
+    return MultiPolygon(*polys, srid=geom.srid)
+
+
+def make_valid(geom):
+    if geom.valid:
+        return geom
+    if hasattr(geom, 'make_valid'):
+        fixed = geom.make_valid()
+    else:
+        fixed = geom.buffer(0)
+    # Repairing may leave behind lines and points of collapsed areas
+    return to_multipolygon(fixed)
+
+
+def normalize_geometry(geom, options):
+    """Repairs, snaps to a grid and simplifies a polygonal GEOS geometry
+    according to `options` (see NORMALIZE_DEFAULTS). Returns the result as
+    a MultiPolygon."""
+    srid = geom.srid
+    if options.get('grid_size'):
+        geom = snap_to_grid(geom, metres_to_srid_units(options['grid_size'], srid))
+    if options.get('simplify'):
+        geom = geom.simplify(metres_to_srid_units(options['simplify'], srid), preserve_topology=True)
+        geom.srid = srid
+    if options.get('make_valid'):
+        geom = make_valid(geom)
+    return to_multipolygon(geom)
+
+
+def transform_to_multipolygon(wkb, srs_wkt, srid, normalize=None):
+    """Transforms a polygonal geometry given as WKB in the spatial reference
+    system `srs_wkt` to `srid`, normalizes it with the `normalize` options
+    if given and returns a tuple of the MultiPolygon EWKB and the vertex
+    counts before and after normalization.
+
+    Works only with plain values so that it can be run in a process pool.
+    """
+    geom = OGRGeometry(memoryview(wkb), srs_wkt)
+    geom.transform(srid)
+    geom = to_multipolygon(geom.geos)
+    before = geom.num_coords
+    if normalize:
+        geom = normalize_geometry(geom, normalize)
+    return bytes(geom.ewkb), before, geom.num_coords
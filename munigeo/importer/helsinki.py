@@ -2,30 +2,63 @@
 munigeo importer for Helsinki data
 """
 
+import hashlib
 import os
 import re
 import requests
 import yaml
 
 from django import db
+from django.utils import timezone
 from datetime import datetime
 
-from django.contrib.gis.gdal import DataSource, SpatialReference, CoordTransform
-from django.contrib.gis.geos import GEOSGeometry, MultiPolygon, Point
+from django.contrib.gis.gdal import DataSource
+from django.contrib.gis.geos import MultiPolygon, Point
 from django.contrib.gis import gdal
 
 from munigeo.models import *
-from munigeo.importer.sync import ModelSyncher
+from munigeo.importer.sync import BulkModelSyncher, ModelSyncher, bulk_create_saved, bulk_save_translations
 from munigeo import ocd
 
-from munigeo.importer.base import Importer, register_importer
+from munigeo.importer.base import Importer, register_importer, chunked
+from munigeo.importer.wfs import WFSReader, WFSLayerNotFound
+from munigeo.importer.fetch import file_digest, combine_digests
+from munigeo.importer.pg import copy_rows, quote_name
+from munigeo.importer.tree import placeholder_tree_fields, rebuild_trees
+from munigeo.importer.geometry import transform_coords, metres_to_srid_units, find_moved_points, \
+    geometry_digest, get_normalize_options, normalize_geometry, set_layer_filters, to_multipolygon, TM35_SRID
+from munigeo.utils import get_coord_transform, get_srs
 
 MUNI_URL = "http://tilastokeskus.fi/meta/luokitukset/kunta/001-2013/tekstitiedosto.txt"
 
-# The Finnish national grid coordinates in TM35-FIN according to JHS-180
-# specification. We use it as a bounding box.
-FIN_GRID = [-548576, 6291456, 1548576, 8388608]
-TM35_SRID = 3067
+# Addresses that have moved less than this (in metres) are not updated.
+ADDRESS_MOVE_TOLERANCE = 0.10
+
+ADDRESS_COPY_BATCH_SIZE = 10000
+# Number of points converted with one coordinate transformation call
+COORD_CHUNK_SIZE = 1000
+# Boundary vertices closer than this (in PROJECTION_SRID units) are treated as unchanged
+DIVISION_GEOM_TOLERANCE = 0.01
+ADDRESS_STAGING_TABLE = 'munigeo_address_staging'
+ADDRESS_STAGING_DDL = """
+    CREATE UNLOGGED TABLE IF NOT EXISTS %(staging)s (
+        seq bigserial,
+        municipality_id text,
+        street_fi text,
+        street_sv text,
+        number text,
+        number_end text,
+        letter text,
+        north double precision,
+        east double precision
+    )
+"""
+
+# Time in seconds a cached service unit list is used without revalidating it
+POI_SOURCE_TTL = 3600
+
+ADDRESS_WFS_URL = 'http://kartta.hel.fi/ws/geoserver/avoindata/wfs'
+ADDRESS_WFS_LAYER = 'avoindata:PKS_osoiteluettelo'
 
 SERVICE_CATEGORY_MAP = {
     25480: ("library", "Library"),
@@ -37,32 +70,53 @@ SERVICE_CATEGORY_MAP = {
 
 
 GK25_SRID = 3879
-GK25_SRS = SpatialReference(GK25_SRID)
-PROJECTION_SRS = SpatialReference(PROJECTION_SRID)
-WEB_MERCATOR_SRS = SpatialReference(3857)
+WEB_MERCATOR_SRID = 3857
+
+
+def get_gk25_transform():
+    if GK25_SRID == PROJECTION_SRID:
+        return None
+    return get_coord_transform(GK25_SRID, PROJECTION_SRID)
 
-coord_transform = None
-if GK25_SRS.srid != PROJECTION_SRID:
-    target_srs = SpatialReference(PROJECTION_SRID)
-    coord_transform = CoordTransform(GK25_SRS, target_srs)
+
+def __getattr__(name):
+    # The spatial references are built lazily to keep GDAL out of module import
+    if name == 'GK25_SRS':
+        return get_srs(GK25_SRID)
+    if name == 'PROJECTION_SRS':
+        return get_srs(PROJECTION_SRID)
+    if name == 'WEB_MERCATOR_SRS':
+        return get_srs(WEB_MERCATOR_SRID)
+    if name == 'coord_transform':
+        return get_gk25_transform()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 def convert_from_gk25(north, east):
     ps = "POINT (%f %f)" % (east, north)
-    g = gdal.OGRGeometry(ps, GK25_SRS)
-    if coord_transform:
-        g.transform(coord_transform)
+    g = gdal.OGRGeometry(ps, get_srs(GK25_SRID))
+    ct = get_gk25_transform()
+    if ct:
+        g.transform(ct)
     return g
 
-    pnt = Point(east, north, srid=GK25_SRID)
-    if PROJECTION_SRID == GK25_SRID:
-        return pnt
-    pnt.transform(coord_transform)
-    return pnt
+
+def convert_from_gk25_many(northings, eastings):
+    """Converts sequences of GK25 coordinates with a single transform call.
+
+    Returns a list of (x, y) tuples in the projection SRID.
+    """
+    ct = get_gk25_transform()
+    if ct:
+        xs, ys = transform_coords(ct, eastings, northings)
+    else:
+        xs, ys = eastings, northings
+    return list(zip(xs, ys))
 
 
 @register_importer
 class HelsinkiImporter(Importer):
     name = "helsinki"
+    dry_run_types = ('divisions', 'addresses', 'pois', 'plans')
 
     def __init__(self, *args, **kwargs):
         super(HelsinkiImporter, self).__init__(*args, **kwargs)
@@ -84,12 +138,14 @@ class HelsinkiImporter(Importer):
         if not geom.srid:
             geom.srid = GK25_SRID
         if geom.srid != PROJECTION_SRID:
-            ct = CoordTransform(SpatialReference(geom.srid), SpatialReference(PROJECTION_SRID))
+            ct = get_coord_transform(geom.srid, PROJECTION_SRID)
             geom.transform(ct)
         # geom = geom.geos.intersection(parent.geometry.boundary)
-        geom = geom.geos
-        if geom.geom_type == 'Polygon':
-            geom = MultiPolygon(geom, srid=geom.srid)
+        geom = to_multipolygon(geom.geos)
+        if self._normalize:
+            self._vertex_counts[0] += geom.num_coords
+            geom = normalize_geometry(geom, self._normalize)
+            self._vertex_counts[1] += geom.num_coords
 
         #
         # Attributes
@@ -116,6 +172,11 @@ class HelsinkiImporter(Importer):
 
         if 'parent' in div:
             if 'parent_id' in attr_dict:
+                if self.dry_run and attr_dict['parent_id'] not in parent_dict:
+                    # The parent would be created earlier in a real import
+                    self.diff.add('divisions:%s' % div['type'], 'created',
+                                  "%s-%s" % (attr_dict['parent_id'], origin_id))
+                    return
                 parent = parent_dict[attr_dict['parent_id']]
                 del attr_dict['parent_id']
             else:
@@ -150,6 +211,8 @@ class HelsinkiImporter(Importer):
         obj = syncher.get(full_id)
         if not obj:
             obj = AdministrativeDivision(origin_id=origin_id, type=type_obj)
+        else:
+            old_state = self._division_state(obj, attr_dict, lang_dict)
 
         validity_time_period = div.get('validity')
         if validity_time_period:
@@ -186,6 +249,24 @@ class HelsinkiImporter(Importer):
             args[div['ocd_id']] = val
             obj.ocd_id = ocd.make_id(**args)
             self.logger.debug("%s" % obj.ocd_id)
+
+        if obj.pk is not None:
+            try:
+                old_geom = obj.geometry.boundary
+            except AdministrativeDivisionGeometry.DoesNotExist:
+                old_geom = None
+            obj._changed = (old_state != self._division_state(obj, attr_dict, lang_dict) or
+                            old_geom is None or not old_geom.equals_exact(geom, DIVISION_GEOM_TOLERANCE))
+        if self.dry_run or (obj.pk is not None and not obj._changed):
+            syncher.mark(obj)
+            return
+
+        self._changed_count += 1
+        if obj.pk is None:
+            placeholder_tree_fields(obj)
+        self._tree_ids.add(obj.tree_id)
+        if parent is not None:
+            self._tree_ids.add(parent.tree_id)
         obj.save()
         syncher.mark(obj)
 
@@ -195,17 +276,68 @@ class HelsinkiImporter(Importer):
             geom_obj = AdministrativeDivisionGeometry(division=obj)
 
         geom_obj.boundary = geom
-        geom_obj.save()
-
-    @db.transaction.atomic
-    def _import_one_division_type(self, muni, div):
+        geom_obj.save(refresh_parts=False)
+        self._geometry_ids.append(geom_obj.pk)
+
+    def _division_state(self, obj, attr_dict, lang_dict):
+        state = [obj.parent_id, obj.municipality_id, obj.start, obj.end, obj.ocd_id]
+        state += [getattr(obj, attr) for attr in attr_dict]
+        for attr, langs in lang_dict.items():
+            state += [obj.safe_translation_getter(attr, language_code=lang, any_language=False)
+                      for lang in langs]
+        return state
+
+    def _open_division_source(self, div):
+        """Returns the layer and a digest of its contents, or (None, None)
+        if the source has no layers."""
+        if 'file' in div:
+            path = self.find_data_file(os.path.join(self.division_data_path, div['file']))
+            ds = DataSource(path, encoding='iso8859-1')
+            if len(ds) < 1:
+                return None, None
+            assert len(ds) == 1
+            lyr = ds[0]
+            set_layer_filters(lyr, div.get('bbox'), div.get('bbox_srid'), div.get('filter'))
+            # A changed filter must not be mistaken for unchanged data
+            filter_digest = hashlib.sha256(repr((div.get('bbox'), div.get('bbox_srid'),
+                                                 div.get('filter'))).encode('utf8')).hexdigest()
+            return lyr, combine_digests([file_digest(path), filter_digest])
+
+        lyr = WFSReader(div['wfs_url'], div['wfs_layer'], srid=PROJECTION_SRID,
+                        cache=self.source_cache, ttl=div.get('ttl', 0),
+                        bbox=div.get('bbox'), bbox_srid=div.get('bbox_srid'), filter=div.get('filter'),
+                        geometry_field=div.get('geometry_field', 'geom'))
+        if not self.dry_run:
+            # The layer is imported while it is downloaded and the digest
+            # is checked afterwards, see _import_one_division_type()
+            return lyr, None
+        # A dry run must not report changes for unchanged data
+        try:
+            digest = lyr.prefetch()
+        except WFSLayerNotFound:
+            return None, None
+        return lyr, digest
+
+    def _import_one_division_type(self, muni, div, lyr, stage, digest):
+        """Imports the divisions of `lyr` and returns their count. If the
+        digest of a streamed layer turns out to be unchanged, the import is
+        rolled back and None is returned."""
+        changed_entities = set(self.changed_entities)
+        with self.write_transaction():
+            count = self._sync_division_type(muni, div, lyr)
+            if digest is None and not self.source_changed(stage, lyr.digest):
+                db.transaction.set_rollback(True)
+                self.changed_entities = changed_entities
+                return None
+        return count
+
+    def _sync_division_type(self, muni, div, lyr):
         def make_div_id(obj):
             if 'parent' in div:
                 return "%s-%s" % (obj.parent.origin_id, obj.origin_id)
             else:
                 return obj.origin_id
 
-        self.logger.info(div['name'])
         if not 'origin_id' in div['fields']:
             raise Exception("Field 'origin_id' not defined in config section '%s'" % div['name'])
         try:
@@ -213,12 +345,18 @@ class HelsinkiImporter(Importer):
         except AdministrativeDivisionType.DoesNotExist:
             type_obj = AdministrativeDivisionType(type=div['type'])
             type_obj.name = div['name']
-            type_obj.save()
+            if not self.dry_run:
+                type_obj.save()
 
-        div_qs = AdministrativeDivision.objects.filter(type=type_obj)
+        if type_obj.pk is None:
+            div_qs = AdministrativeDivision.objects.none()
+        else:
+            div_qs = AdministrativeDivision.objects.filter(type=type_obj)
         if not div.get('no_parent_division', False):
             div_qs = div_qs.by_ancestor(muni.division).select_related('parent')
-        syncher = ModelSyncher(div_qs, make_div_id)
+        # The current state is compared to the source to skip unchanged divisions
+        div_qs = div_qs.select_related('geometry').prefetch_related('translations')
+        syncher = ModelSyncher(div_qs, make_div_id, metrics=self.metrics, stage='divisions:%s' % div['type'])
 
         # Cache the list of possible parents. Assumes parents are imported
         # first.
@@ -232,25 +370,32 @@ class HelsinkiImporter(Importer):
         else:
             parent_dict = None
 
-        if 'file' in div:
-            path = self.find_data_file(os.path.join(self.division_data_path, div['file']))
-            ds = DataSource(path, encoding='iso8859-1')
-        else:
-            wfs_url = 'WFS:' + div['wfs_url']
-            if '?' in wfs_url:
-                sep = '&'
-            else:
-                sep = '?'
-            url = wfs_url + sep + 'typeName=' + div['wfs_layer'] + '&' + "srsName=EPSG:%d" % PROJECTION_SRID + '&' + "outputFormat=application/json"
-            ds = DataSource(url)
-        if len(ds) < 1:
-            self.logger.info(f"{div['name']} has no layers, skipping.")
-            return
-        lyr = ds[0]
-        assert len(ds) == 1
-        with AdministrativeDivision.objects.delay_mptt_updates():
+        self._normalize = get_normalize_options(div.get('normalize'))
+        self._vertex_counts = [0, 0]
+        count = 0
+        if self.dry_run:
+            for feat in lyr:
+                self._import_division(muni, div, type_obj, syncher, parent_dict, feat)
+                count += 1
+            # Divisions missing from the source are not deleted by the import
+            self.add_syncher_diff('divisions:%s' % div['type'], syncher, deletes=False)
+            return count
+
+        self._geometry_ids = []
+        self._tree_ids = set()
+        self._changed_count = 0
+        with AdministrativeDivision.objects.disable_mptt_updates():
             for feat in lyr:
                 self._import_division(muni, div, type_obj, syncher, parent_dict, feat)
+                count += 1
+        rebuild_trees(AdministrativeDivision, self._tree_ids)
+        AdministrativeDivisionGeometryPart.objects.refresh(self._geometry_ids)
+        self.logger.info("%d %s changed" % (self._changed_count, div['name']))
+        if self._changed_count:
+            self.record_changes('divisions')
+        if self._normalize:
+            self.log_vertex_reduction(div['name'], *self._vertex_counts)
+        return count
 
     def import_divisions(self):
         path = self.find_data_file(os.path.join(self.muni_data_path, 'config.yml'))
@@ -260,70 +405,451 @@ class HelsinkiImporter(Importer):
         muni = Municipality.objects.get(division__origin_id=config['origin_id'])
         self.muni = muni
         for div in config['divisions']:
-            self._import_one_division_type(muni, div)
+            self.logger.info(div['name'])
+            with self.metrics.stage('divisions:%s:fetch' % div['type']):
+                lyr, digest = self._open_division_source(div)
+            if lyr is None:
+                self.logger.info(f"{div['name']} has no layers, skipping.")
+                continue
+            stage = "%s:divisions:%s:%s" % (self.name, div['type'], div.get('wfs_layer', div.get('file')))
+            if digest is not None and not self.source_changed(stage, digest):
+                self.logger.info(f"{div['name']} unchanged since the last import, skipping.")
+                continue
+            with self.metrics.stage('divisions:%s:write' % div['type']) as m:
+                try:
+                    count = self._import_one_division_type(muni, div, lyr, stage, digest)
+                except WFSLayerNotFound:
+                    self.logger.info(f"{div['name']} has no layers, skipping.")
+                    continue
+                if count is None:
+                    self.logger.info(f"{div['name']} unchanged since the last import, rolled back.")
+                    continue
+                m.add_rows(count)
+            self.mark_imported(stage, digest or lyr.digest)
 
-    def _import_plans(self, fname, in_effect):
-        path = os.path.join(self.data_path, 'kaavahakemisto', fname)
+    def _read_plan_parts(self, fname, in_effect, plans):
+        """Adds the polygons of the plan boundary file `fname` to `plans`,
+        a dict of origin_id -> [in_effect, polygons]."""
+        path = self.find_data_file(os.path.join('kaavahakemisto', fname))
         ds = DataSource(path, encoding='iso8859-1')
         lyr = ds[0]
+        ct = get_coord_transform(GK25_SRID, PROJECTION_SRID)
 
-        for idx, feat in enumerate(lyr):
+        count = 0
+        for feat in lyr:
             origin_id = feat['kaavatunnus'].as_string()
             geom = feat.geom
-            geom.srid = GK25_SRID
-            geom.transform(PROJECTION_SRID)
-            if origin_id not in self.plan_map:
-                obj = Plan(origin_id=origin_id, municipality=self.muni)
-                self.plan_map[origin_id] = obj
-            else:
-                obj = self.plan_map[origin_id]
-                if not obj.found:
-                    obj.geometry = None
-            poly = GEOSGeometry(geom.wkb, srid=geom.srid)
-            if obj.geometry:
-                obj.geometry.append(poly)
-            else:
-                obj.geometry = MultiPolygon(poly)
-            obj.in_effect = in_effect
-            obj.found = True
-            if (idx % 500) == 0:
-                self.logger.info("%d imported" % idx)
-        if in_effect:
-            type_str = "in effect"
-        else:
-            type_str = "development"
-        self.logger.info("%d %s plans imported" % (idx, type_str))
+            geom.transform(ct)
+            plan = plans.setdefault(origin_id, [in_effect, []])
+            # A plan in both files gets the state of the last one
+            plan[0] = in_effect
+            plan[1].extend(to_multipolygon(geom.geos))
+            count += 1
+        self.logger.info("%d %s plan parts read" % (count, "in effect" if in_effect else "development"))
 
     def import_plans(self):
-        self.plan_map = {}
-        self.muni = Municipality.objects.get(name="Helsinki")
-        for obj in Plan.objects.filter(municipality=self.muni):
-            self.plan_map[obj.origin_id] = obj
-            obj.found = False
-        self._import_plans('Lv_rajaus.TAB', True)
-        self._import_plans('Kaava_vir_rajaus.TAB', False)
-        self.logger.info("Saving")
-        for key, obj in self.plan_map.items():
-            if obj.found:
-                obj.save()
+        muni = Municipality.objects.get(id='helsinki')
+        plans = {}
+        try:
+            self._read_plan_parts('Lv_rajaus.TAB', True, plans)
+            self._read_plan_parts('Kaava_vir_rajaus.TAB', False, plans)
+        except FileNotFoundError as e:
+            self.logger.warning("%s, skipping plans" % e)
+            return
+
+        with self.write_transaction():
+            # The stored digests are compared, so the current geometries are not loaded
+            plan_qs = Plan.objects.filter(municipality=muni).defer('geometry')
+            syncher = BulkModelSyncher(plan_qs, lambda obj: obj.origin_id,
+                                       update_fields=['geometry', 'geometry_digest', 'in_effect'],
+                                       metrics=self.metrics, stage='plans')
+            for origin_id, (in_effect, polys) in plans.items():
+                geom = MultiPolygon(polys, srid=PROJECTION_SRID)
+                digest = geometry_digest(geom)
+                obj = syncher.get(origin_id)
+                if obj is None:
+                    obj = Plan(origin_id=origin_id, municipality=muni)
+                    changed = True
+                else:
+                    changed = obj.in_effect != in_effect or obj.geometry_digest != digest
+                if changed:
+                    obj.geometry = geom
+                    obj.geometry_digest = digest
+                    obj.in_effect = in_effect
+                syncher.mark(obj, changed)
+
+            if self.dry_run:
+                self.add_syncher_diff('plans', syncher)
+                return
+            created, updated, deleted = syncher.finish()
+            if created or updated or deleted:
+                self.record_changes('plans')
+        self.logger.info("Plans: %d created, %d updated, %d deleted" % (created, updated, deleted))
+
+    def _iter_address_rows(self, lyr):
+        """Yields (muni_name, street_name, street_name_sv, num, num2, letter,
+        coord_n, coord_e) tuples of the valid address features."""
+        count = 0
+        for feat in lyr:
+            count += 1
+            if count % 1000 == 0:
+                self.logger.debug("{} processed".format(count))
+
+            street_name = feat.get('katunimi').strip()
+            street_name_sv = feat.get('gatan').strip()
+
+            num = feat.get('osoitenumero')
+
+            if not num:
+                self.logger.debug("Rejecting {}, due to {} not being valid street number".format(street_name, num))
+                continue
             else:
-                self.logger.info("Plan %s deleted" % obj.name)
+                if num == '0':
+                    self.logger.debug("Rejecting {}, due to {} not being valid street number".format(street_name, num))
+                    continue
+
+            num2 = feat.get('osoitenumero2')
+            if num2 == 0:
+                num2 = ''
+            letter = feat.get('osoitekirjain').strip()
+            coord_n = int(feat.get('n'))
+            coord_e = int(feat.get('e'))
+            muni_name = feat.get('kaupunki')
+
+            yield muni_name, street_name, street_name_sv, num, num2, letter, coord_n, coord_e
 
-    @db.transaction.atomic
     def import_addresses(self):
-        wfs_url = 'http://kartta.hel.fi/ws/geoserver/avoindata/wfs?' \
-                  'SERVICE=WFS&VERSION=1.0.0&REQUEST=GetFeature&' \
-                  'TYPENAME=avoindata:PKS_osoiteluettelo&' \
-                  'SRSNAME=EPSG:3067&outputFormat=application/json'
         self.logger.info("Loading master data from WFS datasource")
-        ds = DataSource(wfs_url)
-        lyr = ds[0]
-        assert len(ds) == 1
+        lyr = WFSReader(ADDRESS_WFS_URL, ADDRESS_WFS_LAYER, srid=TM35_SRID, version='1.0.0',
+                        page_size=5000, cache=self.source_cache)
+        stage = "%s:addresses" % self.name
+        stream = not (self.dry_run or self.options.get('resume')) and db.connection.vendor == 'postgresql'
+        if not stream:
+            # The COPY import streams the layer and checks its digest before
+            # merging. The others need it up front, and a resumed import to
+            # validate its checkpoint; cached pages revalidate cheaply.
+            with self.metrics.stage('addresses:fetch'):
+                digest = lyr.prefetch()
+            if not self.source_changed(stage, digest):
+                self.logger.info("Addresses unchanged since the last import, skipping.")
+                return
 
         muni_names = ('Helsinki', 'Espoo', 'Vantaa', 'Kauniainen')
         muni_list = Municipality.objects.filter(translations__language_code='fi', translations__name__in=muni_names)
         muni_dict = {}
+        for muni in muni_list:
+            muni_dict[muni.get_translation('fi').name] = muni
+
+        rows = self._iter_address_rows(lyr)
+        if self.dry_run:
+            with self.metrics.stage('addresses:diff'):
+                self._diff_addresses(rows, muni_dict)
+        elif db.connection.vendor == 'postgresql':
+            if not self._import_addresses_copy(rows, muni_dict, stage, lyr):
+                self.logger.info("Addresses unchanged since the last import, not merged.")
+                return
+        else:
+            with self.metrics.stage('addresses:write'):
+                self._import_addresses_orm(rows, muni_dict)
+
+        self.mark_imported(stage, lyr.digest)
+        self.logger.info("synchronization complete")
+
+    def _diff_addresses(self, rows, muni_dict):
+        """Compares the address rows with the streets and addresses in the
+        database without writing anything and adds the changes to the
+        dry-run diff."""
+        munis = list(muni_dict.values())
+        streets = Street.objects.filter(municipality__in=munis).prefetch_related('translations')
+        street_syncher = ModelSyncher(streets, lambda s: "%s:%s" % (
+            s.municipality_id, s.safe_translation_getter('name', language_code='fi', any_language=False)))
+        street_ids = {street.pk: key for key, street in street_syncher.obj_dict.items()}
+
+        def make_addr_id(street_key, num, num_end, letter):
+            return '%s:%s-%s-%s' % (street_key, num, num_end or '', letter or '')
+
+        addrs = Address.objects.filter(street__municipality__in=munis)\
+            .only('id', 'street', 'number', 'number_end', 'letter', 'location')
+        addr_syncher = ModelSyncher(addrs, lambda a: make_addr_id(
+            street_ids[a.street_id], a.number, a.number_end, a.letter))
+
+        new_streets = set()
+        new_addrs = set()
+        matched_addrs = []
+        new_xs = []
+        new_ys = []
+        for chunk in chunked(rows, COORD_CHUNK_SIZE):
+            coords = convert_from_gk25_many([row[6] for row in chunk], [row[7] for row in chunk])
+            for row, (x, y) in zip(chunk, coords):
+                muni_name, street_name, street_name_sv, num, num2, letter, coord_n, coord_e = row
+                street_key = "%s:%s" % (muni_dict[muni_name].id, street_name)
+                street = street_syncher.get(street_key)
+                if street is None:
+                    new_streets.add(street_key)
+                elif not street._found:
+                    name_sv = street.safe_translation_getter('name', language_code='sv', any_language=False)
+                    street._changed = name_sv != street_name_sv
+                    street_syncher.mark(street)
+
+                addr_id = make_addr_id(street_key, num, num2, letter)
+                addr = addr_syncher.get(addr_id)
+                if addr is None:
+                    new_addrs.add(addr_id)
+                elif not addr._found:
+                    addr_syncher.mark(addr)
+                    matched_addrs.append(addr)
+                    new_xs.append(x)
+                    new_ys.append(y)
+
+        tolerance = metres_to_srid_units(ADDRESS_MOVE_TOLERANCE, PROJECTION_SRID)
+        moved = find_moved_points([addr.location.x for addr in matched_addrs],
+                                  [addr.location.y for addr in matched_addrs], new_xs, new_ys, tolerance)
+        for idx in moved:
+            matched_addrs[idx]._changed = True
+
+        self.add_syncher_diff('streets', street_syncher)
+        self.add_syncher_diff('addresses', addr_syncher)
+        for street_key in new_streets:
+            self.diff.add('streets', 'created', street_key)
+        for addr_id in new_addrs:
+            self.diff.add('addresses', 'created', addr_id)
+
+    def _import_addresses_copy(self, rows, muni_dict, stage, lyr):
+        """Synchronizes addresses by streaming them into an unlogged staging
+        table with COPY and merging them with a few set-based statements.
+        Returns False without merging if the layer read from `lyr` has not
+        changed since the last import.
+
+        Every COPY batch is committed and checkpointed, so that a resumed
+        import continues from the rows already in the staging table."""
+        street_tr_model = Street._parler_meta.root_model
+        tables = {
+            'staging': ADDRESS_STAGING_TABLE,
+            'street': Street._meta.db_table,
+            'street_tr': street_tr_model._meta.db_table,
+            'address': Address._meta.db_table,
+            'building_addresses': Building.addresses.through._meta.db_table,
+            'address_divisions': AddressDivision._meta.db_table,
+        }
+        tables = {key: quote_name(val) for key, val in tables.items()}
+        params = {
+            'muni_ids': [muni.id for muni in muni_dict.values()],
+            'gk25_srid': GK25_SRID,
+            'srid': PROJECTION_SRID,
+            'tolerance': metres_to_srid_units(ADDRESS_MOVE_TOLERANCE, PROJECTION_SRID),
+        }
+
+        def execute(cursor, sql):
+            cursor.execute(sql % tables, params)
+            return cursor.rowcount
+
+        staging_columns = ('municipality_id', 'street_fi', 'street_sv', 'number', 'number_end',
+                           'letter', 'north', 'east')
+
+        def staging_rows():
+            for muni_name, street_name, street_name_sv, num, num2, letter, coord_n, coord_e in rows:
+                muni = muni_dict[muni_name]
+                yield (muni.id, street_name, street_name_sv, num, num2 or '', letter or '',
+                       coord_n, coord_e)
+
+        with db.connection.cursor() as cursor:
+            execute(cursor, ADDRESS_STAGING_DDL)
+            count = 0
+            if self.get_stream_checkpoint(stage, lyr) is not None:
+                # The staging table itself is the authoritative checkpoint,
+                # as a batch may have been committed after the last save.
+                execute(cursor, "SELECT count(*) FROM %(staging)s")
+                count = cursor.fetchone()[0]
+                self.logger.info("Resuming after %d staged addresses" % count)
+            else:
+                execute(cursor, "TRUNCATE %(staging)s")
+            self.save_stream_checkpoint(stage, lyr, count)
+
+            skip = count
+            with self.metrics.stage('addresses:copy') as m:
+                batch = []
+                for row in staging_rows():
+                    if skip:
+                        skip -= 1
+                        continue
+                    batch.append(row)
+                    if len(batch) >= ADDRESS_COPY_BATCH_SIZE:
+                        n = copy_rows(cursor, ADDRESS_STAGING_TABLE, staging_columns, batch)
+                        count += n
+                        m.add_rows(n)
+                        self.save_stream_checkpoint(stage, lyr, count)
+                        batch = []
+                n = copy_rows(cursor, ADDRESS_STAGING_TABLE, staging_columns, batch)
+                count += n
+                m.add_rows(n)
+            self.save_stream_checkpoint(stage, lyr, count)
+            self.logger.info("%d addresses staged" % count)
+            if not self.source_changed(stage, lyr.digest):
+                execute(cursor, "TRUNCATE %(staging)s")
+                return False
+            execute(cursor, "ANALYZE %(staging)s")
+
+            with self.metrics.stage('addresses:merge') as m, db.transaction.atomic():
+                m.add_rows(count)
+                self._merge_staged_addresses(cursor, execute)
+
+            execute(cursor, "TRUNCATE %(staging)s")
+        return True
+
+    def _merge_staged_addresses(self, cursor, execute):
+        # Streets that are not in the database yet get their ids assigned
+        # up front, so that the translations can be inserted with them.
+        n = execute(cursor, """
+            CREATE TEMPORARY TABLE munigeo_new_street ON COMMIT DROP AS
+            SELECT nextval(pg_get_serial_sequence('%(street)s', 'id')) AS id,
+                   n.municipality_id, n.name_fi
+            FROM (
+                SELECT DISTINCT s.municipality_id, s.street_fi AS name_fi
+                FROM %(staging)s s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM %(street)s st
+                    JOIN %(street_tr)s t ON t.master_id = st.id AND t.language_code = 'fi'
+                    WHERE st.municipality_id = s.municipality_id AND t.name = s.street_fi
+                )
+            ) n
+        """)
+        execute(cursor, """
+            INSERT INTO %(street)s (id, municipality_id, modified_at)
+            SELECT id, municipality_id, now() FROM munigeo_new_street
+        """)
+        execute(cursor, """
+            INSERT INTO %(street_tr)s (master_id, language_code, name)
+            SELECT id, 'fi', name_fi FROM munigeo_new_street
+        """)
+        self.logger.info("%d new streets" % n)
+        streets_changed = n
+
+        execute(cursor, """
+            CREATE TEMPORARY TABLE munigeo_street_map ON COMMIT DROP AS
+            SELECT DISTINCT ON (st.municipality_id, t.name)
+                   st.municipality_id, t.name AS name_fi, st.id AS street_id
+            FROM %(street)s st
+            JOIN %(street_tr)s t ON t.master_id = st.id AND t.language_code = 'fi'
+            WHERE st.municipality_id = ANY(%%(muni_ids)s)
+            ORDER BY st.municipality_id, t.name, st.id
+        """)
+        execute(cursor, "CREATE INDEX ON munigeo_street_map (municipality_id, name_fi)")
+
+        # Swedish street names
+        execute(cursor, """
+            CREATE TEMPORARY TABLE munigeo_street_sv ON COMMIT DROP AS
+            SELECT DISTINCT ON (m.street_id) m.street_id, s.street_sv AS name
+            FROM %(staging)s s
+            JOIN munigeo_street_map m ON m.municipality_id = s.municipality_id AND m.name_fi = s.street_fi
+            WHERE s.street_sv <> ''
+            ORDER BY m.street_id, s.seq
+        """)
+        n = execute(cursor, """
+            UPDATE %(street_tr)s t SET name = sv.name
+            FROM munigeo_street_sv sv
+            WHERE t.master_id = sv.street_id AND t.language_code = 'sv' AND t.name <> sv.name
+        """)
+        n += execute(cursor, """
+            INSERT INTO %(street_tr)s (master_id, language_code, name)
+            SELECT sv.street_id, 'sv', sv.name FROM munigeo_street_sv sv
+            WHERE NOT EXISTS (
+                SELECT 1 FROM %(street_tr)s t WHERE t.master_id = sv.street_id AND t.language_code = 'sv'
+            )
+        """)
+        self.logger.info("%d Swedish street names changed" % n)
+        streets_changed += n
+
+        # Addresses; the first occurrence of a duplicate address wins.
+        execute(cursor, """
+            CREATE TEMPORARY TABLE munigeo_incoming_address ON COMMIT DROP AS
+            SELECT DISTINCT ON (m.street_id, s.number, s.number_end, s.letter)
+                   m.street_id, s.number, s.number_end, s.letter,
+                   ST_Transform(ST_SetSRID(ST_MakePoint(s.east, s.north), %%(gk25_srid)s), %%(srid)s) AS location
+            FROM %(staging)s s
+            JOIN munigeo_street_map m ON m.municipality_id = s.municipality_id AND m.name_fi = s.street_fi
+            ORDER BY m.street_id, s.number, s.number_end, s.letter, s.seq
+        """)
+        execute(cursor, "CREATE INDEX ON munigeo_incoming_address (street_id, number, number_end, letter)")
+        execute(cursor, "ANALYZE munigeo_incoming_address")
+        n = execute(cursor, """
+            INSERT INTO %(address)s AS a (street_id, number, number_end, letter, location, modified_at)
+            SELECT street_id, number, number_end, letter, location, now()
+            FROM munigeo_incoming_address
+            ON CONFLICT (street_id, number, number_end, letter) DO UPDATE
+                SET location = EXCLUDED.location, modified_at = EXCLUDED.modified_at
+                WHERE NOT ST_DWithin(a.location, EXCLUDED.location, %%(tolerance)s)
+        """)
+        self.logger.info("%d addresses added or moved" % n)
+        addresses_changed = n
+
+        # Addresses and streets that have disappeared from the source
+        execute(cursor, """
+            CREATE TEMPORARY TABLE munigeo_removed_address ON COMMIT DROP AS
+            SELECT a.id FROM %(address)s a
+            JOIN %(street)s st ON st.id = a.street_id
+            WHERE st.municipality_id = ANY(%%(muni_ids)s) AND NOT EXISTS (
+                SELECT 1 FROM munigeo_incoming_address i
+                WHERE i.street_id = a.street_id AND i.number = a.number
+                    AND i.number_end = a.number_end AND i.letter = a.letter
+            )
+        """)
+        execute(cursor, """
+            SELECT count(*) FROM %(address)s a JOIN %(street)s st ON st.id = a.street_id
+            WHERE st.municipality_id = ANY(%%(muni_ids)s)
+        """)
+        total = cursor.fetchone()[0]
+        execute(cursor, "SELECT count(*) FROM munigeo_removed_address")
+        removed = cursor.fetchone()[0]
+        if removed > 5 and removed > total * 0.4:
+            raise Exception("Attempting to delete more than 40% of total items")
+
+        execute(cursor, """
+            DELETE FROM %(building_addresses)s
+            WHERE address_id IN (SELECT id FROM munigeo_removed_address)
+        """)
+        execute(cursor, """
+            DELETE FROM %(address_divisions)s
+            WHERE address_id IN (SELECT id FROM munigeo_removed_address)
+        """)
+        n = execute(cursor, "DELETE FROM %(address)s WHERE id IN (SELECT id FROM munigeo_removed_address)")
+        self.logger.info("%d addresses removed" % n)
+        addresses_changed += n
+
+        execute(cursor, """
+            CREATE TEMPORARY TABLE munigeo_removed_street ON COMMIT DROP AS
+            SELECT st.id FROM %(street)s st
+            WHERE st.municipality_id = ANY(%%(muni_ids)s) AND NOT EXISTS (
+                SELECT 1 FROM %(address)s a WHERE a.street_id = st.id
+            ) AND NOT EXISTS (
+                SELECT 1 FROM munigeo_incoming_address i WHERE i.street_id = st.id
+            )
+        """)
+        execute(cursor, "DELETE FROM %(street_tr)s WHERE master_id IN (SELECT id FROM munigeo_removed_street)")
+        n = execute(cursor, "DELETE FROM %(street)s WHERE id IN (SELECT id FROM munigeo_removed_street)")
+        self.logger.info("%d streets removed" % n)
+        streets_changed += n
+
+        if streets_changed:
+            self.record_changes('streets')
+        if addresses_changed:
+            self.record_changes('addresses')
+
+    def _save_new_streets(self, streets):
+        """Inserts new streets and their translations in bulk."""
+        if not streets:
+            return
+        self.logger.info("Saving {} new streets".format(len(streets)))
+        bulk_create_saved(Street, streets)
+        bulk_save_translations(streets)
 
+    def _bulk_create_addresses(self, addrs):
+        # Pick up the ids of streets saved after the address was created
+        for addr in addrs:
+            addr.street_id = addr.street.pk
+        Address.objects.bulk_create(addrs)
+
+    @db.transaction.atomic
+    def _import_addresses_orm(self, rows, muni_dict):
         def make_addr_id(num, num_end, letter):
             if num_end is None:
                 num_end = ''
@@ -331,12 +857,11 @@ class HelsinkiImporter(Importer):
                 letter = ''
             return '%s-%s-%s' % (num, num_end, letter)
 
+        muni_list = list(muni_dict.values())
         for muni in muni_list:
-            muni_dict[muni.get_translation('fi').name] = muni
-
             self.logger.info("Loading existing data for {}".format(muni))
 
-            streets = Street.objects.filter(municipality=muni)
+            streets = Street.objects.filter(municipality=muni).prefetch_related('translations')
             muni.streets_by_name = {}
             muni.streets_by_id = {}
             for s in streets:
@@ -353,106 +878,121 @@ class HelsinkiImporter(Importer):
 
         bulk_addr_list = []
         bulk_street_list = []
-        count = 0
+        renamed_streets = {}
+        streets_changed = addresses_changed = 0
+        # Existing addresses found in the source and their new coordinates
+        matched_addrs = []
+        new_xs = []
+        new_ys = []
 
         self.logger.info("starting data synchronization")
-        for feat in lyr:
-            count += 1
-            if count % 1000 == 0:
-                self.logger.debug("{} processed".format(count))
-
-            street_name = feat.get('katunimi').strip()
-            street_name_sv = feat.get('gatan').strip()
-
-            num = feat.get('osoitenumero')
-
-            if not num:
-                self.logger.debug("Rejecting {}, due to {} not being valid street number".format(street_name, num))
-                continue
-            else:
-                if num == '0':
-                    self.logger.debug("Rejecting {}, due to {} not being valid street number".format(street_name, num))
-                    continue
-
-            num2 = feat.get('osoitenumero2')
-            if num2 == 0:
-                num2 = ''
-            letter = feat.get('osoitekirjain').strip()
-            coord_n = int(feat.get('n'))
-            coord_e = int(feat.get('e'))
-            muni_name = feat.get('kaupunki')
-
-            muni = muni_dict[muni_name]
-            street = muni.streets_by_name.get(street_name, None)
-            if not street:
-                self.logger.info("street {} not found in DB, creating it".format(street_name))
-                street = Street(municipality=muni)
-                street.set_current_language('fi')
-                street.name = street_name
-                street.set_current_language('sv')
-                street.name = street_name_sv
-
-                #bulk_street_list.append(street)
-                street.save()
-                muni.streets_by_name[street_name] = street
-                street.addrs = {}
-            else:
-                street.set_current_language('sv')
-                if street.name != street_name_sv:
-                    self.logger.warning("%s: %s -> %s" % (street, street.name, street_name_sv))
+        for chunk in chunked(rows, COORD_CHUNK_SIZE):
+            coords = convert_from_gk25_many([row[6] for row in chunk], [row[7] for row in chunk])
+            for row, (x, y) in zip(chunk, coords):
+                muni_name, street_name, street_name_sv, num, num2, letter, coord_n, coord_e = row
+                muni = muni_dict[muni_name]
+                street = muni.streets_by_name.get(street_name, None)
+                if not street:
+                    self.logger.info("street {} not found in DB, creating it".format(street_name))
+                    street = Street(municipality=muni)
+                    street.set_current_language('fi')
+                    street.name = street_name
+                    street.set_current_language('sv')
                     street.name = street_name_sv
-                    street.save()
-            street._found = True
-
-            addr_id = make_addr_id(num, num2, letter)
-            addr = street.addrs.get(addr_id, None)
-            location = convert_from_gk25(coord_n, coord_e)
-            if not addr:
-                self.logger.debug("Street {} did not have address {}. Creating".format(street.name, addr_id))
-                addr = Address(street=street, number=num, number_end=num2, letter=letter)
-                addr.location = location.wkb
-                bulk_addr_list.append(addr)
-                street.addrs[addr_id] = addr
-            else:
-                if addr._found:
-                    self.logger.debug("{}: is duplicate, skipping".format(addr))
-                    continue
-                # if the location has changed for more than 10cm, save the new one.
-                assert addr.location.srid == location.srid, "SRID changed"
-                #if addr.location.distance(location) >= 0.10:
-                #    self.logger.info("%s: Location changed" % addr)
-                #    addr.location = location
-                #    addr.save()
-            addr._found = True
 
-            # self.logger.info("%s: %s %d%s N%d E%d (%f,%f)" % (muni_name, street, num, letter, coord_n, coord_e, pnt.y, pnt.x))
+                    bulk_street_list.append(street)
+                    muni.streets_by_name[street_name] = street
+                    street.addrs = {}
+                else:
+                    street.set_current_language('sv')
+                    if street.name != street_name_sv:
+                        self.logger.warning("%s: %s -> %s" % (street, street.name, street_name_sv))
+                        street.name = street_name_sv
+                        renamed_streets[street.id] = street
+                street._found = True
+
+                addr_id = make_addr_id(num, num2, letter)
+                addr = street.addrs.get(addr_id, None)
+                location = Point(x, y, srid=PROJECTION_SRID)
+                if not addr:
+                    self.logger.debug("Street {} did not have address {}. Creating".format(street.name, addr_id))
+                    addr = Address(street=street, number=num, number_end=num2, letter=letter)
+                    addr.location = location
+                    bulk_addr_list.append(addr)
+                    street.addrs[addr_id] = addr
+                else:
+                    if addr._found:
+                        self.logger.debug("{}: is duplicate, skipping".format(addr))
+                        continue
+                    matched_addrs.append(addr)
+                    new_xs.append(x)
+                    new_ys.append(y)
+                addr._found = True
+
+                # self.logger.info("%s: %s %d%s N%d E%d (%f,%f)" % (muni_name, street, num, letter, coord_n, coord_e, pnt.y, pnt.x))
 
-            if len(bulk_addr_list) >= 10000:
-                self.logger.info("Saving %d new addresses" % len(bulk_addr_list))
+                if len(bulk_addr_list) >= 10000:
+                    streets_changed += len(bulk_street_list)
+                    addresses_changed += len(bulk_addr_list)
+                    self._save_new_streets(bulk_street_list)
+                    bulk_street_list = []
+                    self.logger.info("Saving %d new addresses" % len(bulk_addr_list))
 
-                Address.objects.bulk_create(bulk_addr_list)
-                bulk_addr_list = []
+                    self._bulk_create_addresses(bulk_addr_list)
+                    bulk_addr_list = []
 
-                # Reset DB query store to free up memory
-                db.reset_queries()
+                    # Reset DB query store to free up memory
+                    db.reset_queries()
 
+        streets_changed += len(bulk_street_list) + len(renamed_streets)
+        addresses_changed += len(bulk_addr_list)
+        self._save_new_streets(bulk_street_list)
+        bulk_street_list = []
+        if renamed_streets:
+            self.logger.info("Saving {} renamed streets".format(len(renamed_streets)))
+            bulk_save_translations(renamed_streets.values())
         if bulk_addr_list:
             self.logger.info("Saving {} new addresses".format(len(bulk_addr_list)))
-            Address.objects.bulk_create(bulk_addr_list)
+            self._bulk_create_addresses(bulk_addr_list)
             bulk_addr_list = []
 
+        # If the location has changed for more than 10cm, save the new one.
+        old_xs = [addr.location.x for addr in matched_addrs]
+        old_ys = [addr.location.y for addr in matched_addrs]
+        tolerance = metres_to_srid_units(ADDRESS_MOVE_TOLERANCE, PROJECTION_SRID)
+        moved = find_moved_points(old_xs, old_ys, new_xs, new_ys, tolerance)
+        if moved:
+            now = timezone.now()
+            moved_addrs = []
+            for idx in moved:
+                addr = matched_addrs[idx]
+                self.logger.debug("%s: Location changed" % addr)
+                addr.location = Point(new_xs[idx], new_ys[idx], srid=PROJECTION_SRID)
+                addr.modified_at = now
+                moved_addrs.append(addr)
+            self.logger.info("Updating the location of %d addresses" % len(moved_addrs))
+            Address.objects.bulk_update(moved_addrs, ['location', 'modified_at'], batch_size=1000)
+            addresses_changed += len(moved_addrs)
+
         for muni in muni_list:
             for s in muni.streets_by_name.values():
                 if not s._found:
                     self.logger.info("Street {} removed".format(s))
                     s.delete()
+                    streets_changed += 1
+                    # Its addresses are deleted with it
+                    addresses_changed += len(s.addrs)
                     continue
                 for a in s.addrs.values():
                     if not a._found:
                         self.logger.info("Address {} removed".format(a))
                         a.delete()
+                        addresses_changed += 1
 
-        self.logger.info("synchronization complete")
+        if streets_changed:
+            self.record_changes('streets')
+        if addresses_changed:
+            self.record_changes('addresses')
 
     def import_pois(self):
         URL_BASE = 'http://www.hel.fi/palvelukarttaws/rest/v2/unit/?service=%d'
@@ -461,48 +1001,72 @@ class HelsinkiImporter(Importer):
         for muni in Municipality.objects.all():
             muni_dict[muni.name] = muni
 
-        for srv_id in list(SERVICE_CATEGORY_MAP.keys()):
-            cat_type, cat_desc = SERVICE_CATEGORY_MAP[srv_id]
-            cat, c = POICategory.objects.get_or_create(type=cat_type, defaults={'description': cat_desc})
+        srv_ids = list(SERVICE_CATEGORY_MAP.keys())
+        with self.metrics.stage('pois:fetch'):
+            sources = dict(zip(srv_ids, self.fetch_sources([URL_BASE % srv_id for srv_id in srv_ids],
+                                                           ttl=POI_SOURCE_TTL)))
+        # All categories are synchronized together, so they are only skipped
+        # if none of them has changed.
+        stage = "%s:pois" % self.name
+        digest = combine_digests([sources[srv_id].digest for srv_id in sorted(sources)])
+        if not self.source_changed(stage, digest):
+            self.logger.info("POI sources unchanged since the last import, skipping")
+            return
 
-            self.logger.info("Importing %s" % cat_type)
-            ret = requests.get(URL_BASE % srv_id)
-            for srv_info in ret.json():
-                srv_id = str(srv_info['id'])
-                try:
-                    poi = POI.objects.get(origin_id=srv_id)
-                except POI.DoesNotExist:
-                    poi = POI(origin_id=srv_id)
-                poi.name = srv_info['name_fi']
-                poi.category = cat
-                if not 'address_city_fi' in srv_info:
-                    self.logger.info("No city!")
-                    self.logger.info(srv_info)
-                    continue
-                city_name = srv_info['address_city_fi']
-                if not city_name in muni_dict:
-                    city_name = city_name.encode('utf8')
-                    post_code = srv_info.get('address_zip', '')
-                    if post_code.startswith('00'):
-                        self.logger.info("%s: %s (%s)" % (srv_info['id'], poi.name.encode('utf8'), city_name))
-                        city_name = "Helsinki"
-                    elif post_code.startswith('01'):
-                        self.logger.info("%s: %s (%s)" % (srv_info['id'], poi.name.encode('utf8'), city_name))
-                        city_name = "Vantaa"
-                    elif post_code in ('02700', '02701', '02760'):
-                        self.logger.info("%s: %s (%s)" % (srv_info['id'], poi.name.encode('utf8'), city_name))
-                        city_name = "Kauniainen"
-                    elif post_code.startswith('02'):
-                        self.logger.info("%s: %s (%s)" % (srv_info['id'], poi.name.encode('utf8'), city_name))
-                        city_name = "Espoo"
-                    else:
+        cats = self.get_poi_categories(dict(SERVICE_CATEGORY_MAP.values()))
+
+        with self.metrics.stage('pois:parse') as m:
+            pending = []
+            for srv_id, (cat_type, cat_desc) in SERVICE_CATEGORY_MAP.items():
+                self.logger.info("Importing %s" % cat_type)
+                for srv_info in sources[srv_id].json():
+                    rec = {
+                        'origin_id': str(srv_info['id']),
+                        'name': srv_info['name_fi'],
+                        'category': cats[cat_type],
+                    }
+                    if not 'address_city_fi' in srv_info:
+                        self.logger.info("No city!")
                         self.logger.info(srv_info)
-                poi.municipality = muni_dict[city_name]
-                poi.street_address = srv_info.get('street_address_fi', None)
-                poi.zip_code = srv_info.get('address_zip', None)
-                if not 'northing_etrs_gk25' in srv_info:
-                    self.logger.info("No location!")
-                    self.logger.info(srv_info)
-                    continue
-                poi.location = convert_from_gk25(srv_info['northing_etrs_gk25'], srv_info['easting_etrs_gk25'])
-                poi.save()
+                        continue
+                    city_name = srv_info['address_city_fi']
+                    if not city_name in muni_dict:
+                        post_code = srv_info.get('address_zip', '')
+                        if post_code.startswith('00'):
+                            self.logger.info("%s: %s (%s)" % (srv_info['id'], rec['name'], city_name))
+                            city_name = "Helsinki"
+                        elif post_code.startswith('01'):
+                            self.logger.info("%s: %s (%s)" % (srv_info['id'], rec['name'], city_name))
+                            city_name = "Vantaa"
+                        elif post_code in ('02700', '02701', '02760'):
+                            self.logger.info("%s: %s (%s)" % (srv_info['id'], rec['name'], city_name))
+                            city_name = "Kauniainen"
+                        elif post_code.startswith('02'):
+                            self.logger.info("%s: %s (%s)" % (srv_info['id'], rec['name'], city_name))
+                            city_name = "Espoo"
+                        else:
+                            self.logger.info(srv_info)
+                            continue
+                    rec['municipality'] = muni_dict[city_name]
+                    rec['street_address'] = srv_info.get('street_address_fi', None)
+                    rec['zip_code'] = srv_info.get('address_zip', None)
+                    if not 'northing_etrs_gk25' in srv_info:
+                        self.logger.info("No location!")
+                        self.logger.info(srv_info)
+                        continue
+                    pending.append((rec, srv_info['northing_etrs_gk25'], srv_info['easting_etrs_gk25']))
+            m.add_rows(len(pending))
+
+        records = []
+        with self.metrics.stage('pois:transform') as m:
+            for chunk in chunked(pending, COORD_CHUNK_SIZE):
+                coords = convert_from_gk25_many([n for rec, n, e in chunk], [e for rec, n, e in chunk])
+                for (rec, n, e), (x, y) in zip(chunk, coords):
+                    rec['location'] = Point(x, y, srid=PROJECTION_SRID)
+                    records.append(rec)
+            m.add_rows(len(records))
+
+        # Service unit ids are plain numbers, unlike the ids of other POI sources.
+        queryset = POI.objects.filter(category__type__in=cats.keys(), origin_id__regex=r'^\d+$')
+        self.sync_pois(queryset, records)
+        self.mark_imported(stage, digest)
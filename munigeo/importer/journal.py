@@ -0,0 +1,82 @@
+"""
+Checkpoint journal for resuming interrupted imports
+
+The journal records the stages completed during the current import run and
+the progress made within long-running stages. When an import is run with
+`--resume`, stages completed with the same source digest are skipped and
+chunked stages continue from their last checkpoint. Otherwise the journal
+is reset when the importer is created.
+"""
+
+import threading
+import time
+
+from munigeo.importer.jsonfile import load_json, locked, update_json, write_json
+
+
+class ImportJournal(object):
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._load()
+
+    def _set_defaults(self, state):
+        state.setdefault('started_at', time.time())
+        state.setdefault('stages', {})
+
+    def _load(self):
+        self.state = load_json(self.path)
+        self._set_defaults(self.state)
+
+    def _set_stage(self, stage, entry):
+        # Stages may be run by several processes, so only this stage's entry
+        # is written into the current contents of the file
+        def update(state):
+            self._set_defaults(state)
+            state['stages'][stage] = entry
+        with self._lock:
+            self.state = update_json(self.path, update)
+
+    def reset(self):
+        with self._lock:
+            self.state = {'started_at': time.time(), 'stages': {}}
+            with locked(self.path):
+                write_json(self.path, self.state)
+
+    def _get(self, stage, digest):
+        entry = self.state['stages'].get(stage)
+        if not entry or entry['digest'] != digest:
+            return None
+        return entry
+
+    def stage_done(self, stage, digest):
+        """Returns True if `stage` was completed in this run with `digest`."""
+        with self._lock:
+            entry = self._get(stage, digest)
+            return bool(entry and entry['done'])
+
+    def mark_done(self, stage, digest):
+        self._set_stage(stage, {'digest': digest, 'done': True, 'progress': None,
+                                'updated_at': time.time()})
+
+    def get_progress(self, stage, digest):
+        """Returns the progress recorded for an unfinished `stage` with
+        `digest`, or None if there is nothing to resume from."""
+        with self._lock:
+            entry = self._get(stage, digest)
+            if not entry or entry['done']:
+                return None
+            return entry['progress']
+
+    def get_unfinished(self, stage):
+        """Returns the digest and progress of an unfinished `stage` whatever
+        the digest, for stages that can only verify it as they go."""
+        with self._lock:
+            entry = self.state['stages'].get(stage)
+            if not entry or entry['done']:
+                return None, None
+            return entry['digest'], entry['progress']
+
+    def set_progress(self, stage, digest, progress):
+        self._set_stage(stage, {'digest': digest, 'done': False, 'progress': progress,
+                                'updated_at': time.time()})
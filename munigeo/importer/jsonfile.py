@@ -0,0 +1,59 @@
+"""
+JSON state files shared by concurrent import processes
+
+Updates re-read the file under an exclusive lock, apply the change and
+replace the file atomically, so that processes changing different keys of
+the same file do not lose each other's changes.
+"""
+
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No locking between processes on platforms without fcntl
+    fcntl = None
+
+
+def load_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_json(path, data):
+    dir_path = os.path.dirname(path)
+    os.makedirs(dir_path, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def locked(path):
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def update_json(path, func):
+    """Calls `func` with the current contents of the JSON file at `path`,
+    writes the modified data back and returns it."""
+    with locked(path):
+        data = load_json(path)
+        func(data)
+        write_json(path, data)
+    return data
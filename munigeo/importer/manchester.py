@@ -3,7 +3,6 @@ import os
 import csv
 #import unicodecsv
 import requests
-import requests_cache
 import io
 import json
 
@@ -14,6 +13,7 @@ from django.contrib.gis.geos import GEOSGeometry, MultiPolygon, Point
 
 from munigeo.models import *
 from munigeo.importer.sync import ModelSyncher
+from munigeo.importer.fetch import combine_digests
 from munigeo import ocd
 
 from munigeo.importer.base import Importer, register_importer
@@ -42,6 +42,9 @@ SERVICE_CATEGORY_MAP = {
     #87: ("attractions", "Tourist attractions"),
 }
 
+# Time in seconds a cached service listing is used without revalidating it
+REST_SOURCE_TTL = 24 * 3600
+
 CITADEL_LIST = [
     {
         'url': 'http://www.citadelonthemove.eu/Portals/0/PropertyAgent/517/Files/9/CitadeL-Parking_Lots-Manchester.json',
@@ -62,6 +65,7 @@ def convert_from_wgs84(coords):
 @register_importer
 class ManchesterImporter(Importer):
     name = "manchester"
+    dry_run_types = ('pois',)
 
     def __init__(self, *args, **kwargs):
         super(ManchesterImporter, self).__init__(*args, **kwargs)
@@ -70,6 +74,8 @@ class ManchesterImporter(Importer):
 
     def import_municipalities(self):
         muni, c = Municipality.objects.get_or_create(id=44001, name="Manchester")
+        if c:
+            self.record_changes('municipalities')
         self.logger.info("Manchester municipality added.")
 
     def import_pois_from_csv(self):
@@ -108,52 +114,53 @@ class ManchesterImporter(Importer):
                 poi.municipality = muni
                 poi.location = convert_from_wgs84(coords)
                 poi.save()
+        self.record_changes('pois')
 
     def import_pois_from_rest(self):
         URL_BASE = 'http://www.manchester.gov.uk/site/custom_scripts/getServiceDetailsjs.php?service=%d&postcode=M2+5DB&count=10000&format=json'
 
         muni = Municipality.objects.get(id=44001)
-        for srv_id in list(SERVICE_CATEGORY_MAP.keys()):
-            cat_type, cat_desc = SERVICE_CATEGORY_MAP[srv_id]
-            cat, c = POICategory.objects.get_or_create(type=cat_type, defaults={'description': cat_desc})
-
+        srv_ids = list(SERVICE_CATEGORY_MAP.keys())
+        with self.metrics.stage('pois:fetch'):
+            sources = dict(zip(srv_ids, self.fetch_sources([URL_BASE % srv_id for srv_id in srv_ids],
+                                                           ttl=REST_SOURCE_TTL)))
+        stage = "%s:rest" % self.name
+        digest = combine_digests([sources[srv_id].digest for srv_id in sorted(sources)])
+        if not self.source_changed(stage, digest):
+            self.logger.info("REST sources unchanged since the last import, skipping")
+            return
+
+        cats = self.get_poi_categories(dict(SERVICE_CATEGORY_MAP.values()))
+        records = []
+        for srv_id, (cat_type, cat_desc) in SERVICE_CATEGORY_MAP.items():
             self.logger.info("Importing %s" % cat_type)
-            ret = requests.get(URL_BASE % srv_id)
-            if ret.status_code != 200:
-                raise Exception("HTTP request failed with %d" % ret.status_code)
             # Fix quoting bug
-            s = ret.content.replace("\\'", "'")
+            s = sources[srv_id].content.decode('utf8').replace("\\'", "'")
             ret_json = json.loads(s)
-            count = 0
             for srv_info in ret_json:
-                srv_id = "man-%s" % str(srv_info['uid'])
-                try:
-                    poi = POI.objects.get(origin_id=srv_id)
-                except POI.DoesNotExist:
-                    poi = POI(origin_id=srv_id)
-                poi.name = srv_info['name']
-                poi.category = cat
-                poi.municipality = muni
-                if 'address' in srv_info:
-                    poi.street_address = srv_info['address']
-                else:
-                    poi.street_address = ''
                 coords = srv_info['latlon'].strip()
                 if not coords:
                     continue
                 coords = [float(x) for x in coords.split(',')]
-                poi.location = convert_from_wgs84(coords)
-                poi.save()
-                count = count + 1
-            self.logger.info("%d imported" % count)
+                records.append({
+                    'origin_id': "man-%s" % str(srv_info['uid']),
+                    'name': srv_info['name'],
+                    'category': cats[cat_type],
+                    'municipality': muni,
+                    'street_address': srv_info.get('address', ''),
+                    'location': convert_from_wgs84(coords),
+                })
+
+        queryset = POI.objects.filter(municipality=muni, origin_id__startswith='man-',
+                                      category__type__in=cats.keys())
+        self.sync_pois(queryset, records)
+        self.mark_imported(stage, digest)
 
     def import_pois_from_citadel(self):
         muni = Municipality.objects.get(id=44001)
-        for d in CITADEL_LIST:
-            self._import_citadel(muni, d)
+        self.import_citadel_list(muni, CITADEL_LIST)
 
     def import_pois(self):
-        requests_cache.install_cache('geo_import_man')
         self.logger.info("Importing POIs from Citadel")
         self.import_pois_from_citadel()
         # self.logger.info("Importing POIs from CSV")
@@ -0,0 +1,127 @@
+"""
+Per-stage import metrics
+
+Importers wrap their work in `metrics.stage(name)` blocks. For every stage
+the wall time and the number of processed rows are recorded. When tracing
+is enabled (`geo_import --metrics-file`), the number of database queries
+and the tracemalloc memory peak are recorded as well. Stages with the same
+name are accumulated and stages may be nested.
+"""
+
+import json
+import logging
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class StageMetrics(object):
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = 0.0
+        self.rows = 0
+        self.queries = 0
+        self.peak_memory = 0
+        self.calls = 0
+
+    def add_rows(self, count):
+        self.rows += count
+
+    @property
+    def rows_per_second(self):
+        if not self.wall_time:
+            return None
+        return self.rows / self.wall_time
+
+    def as_dict(self):
+        return {
+            'wall_time': round(self.wall_time, 3),
+            'rows': self.rows,
+            'rows_per_second': round(self.rows_per_second, 1) if self.rows_per_second is not None else None,
+            'queries': self.queries,
+            'peak_memory': self.peak_memory,
+            'calls': self.calls,
+        }
+
+
+class ImportMetrics(object):
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.stages = {}
+        self._active = []
+        self.started_at = time.time()
+
+    def get_stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = StageMetrics(name)
+        return self.stages[name]
+
+    def _query_counter(self, stage):
+        def wrapper(execute, sql, params, many, context):
+            stage.queries += 1
+            return execute(sql, params, many, context)
+        return wrapper
+
+    def _update_peaks(self):
+        peak = tracemalloc.get_traced_memory()[1]
+        for stage in self._active:
+            stage.peak_memory = max(stage.peak_memory, peak)
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name):
+        """Records the metrics of the enclosed block under `name`. Yields the
+        StageMetrics object so that the block can add the rows it processed."""
+        stage = self.get_stage(name)
+        stage.calls += 1
+        if self.trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self._update_peaks()
+        self._active.append(stage)
+        start = time.perf_counter()
+        try:
+            if self.trace:
+                with connection.execute_wrapper(self._query_counter(stage)):
+                    yield stage
+            else:
+                yield stage
+        finally:
+            stage.wall_time += time.perf_counter() - start
+            if self.trace:
+                self._update_peaks()
+            self._active.pop()
+
+    def update(self, other):
+        """Adds the stages recorded by ImportMetrics `other`, e.g. in a
+        worker process, to these metrics."""
+        for name, other_stage in other.stages.items():
+            stage = self.get_stage(name)
+            stage.wall_time += other_stage.wall_time
+            stage.rows += other_stage.rows
+            stage.queries += other_stage.queries
+            stage.peak_memory = max(stage.peak_memory, other_stage.peak_memory)
+            stage.calls += other_stage.calls
+
+    def report(self):
+        return {
+            'started_at': self.started_at,
+            'wall_time': round(time.time() - self.started_at, 3),
+            'stages': {name: stage.as_dict() for name, stage in self.stages.items()},
+        }
+
+    def log_summary(self, log=logger):
+        for name, stage in self.stages.items():
+            msg = "%s: %.1f s, %d rows" % (name, stage.wall_time, stage.rows)
+            if self.trace:
+                msg += ", %d queries, %.1f MiB peak" % (stage.queries, stage.peak_memory / (1024 * 1024))
+            log.info(msg)
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
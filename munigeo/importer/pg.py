@@ -0,0 +1,61 @@
+"""
+PostgreSQL helpers for set-based importer operations
+"""
+
+import io
+
+from django.db import connection
+
+CHUNK_SIZE = 64 * 1024
+
+
+def quote_name(name):
+    return connection.ops.quote_name(name)
+
+
+def _copy_value(val):
+    if val is None:
+        return '\\N'
+    s = str(val)
+    if any(c in s for c in '\\\t\n\r'):
+        s = s.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return s
+
+
+def copy_expert(cursor, sql, f):
+    """Runs a `COPY ... FROM STDIN` or `COPY ... TO STDOUT` statement on a
+    Django cursor, reading from or writing to file object `f`. Works with
+    both psycopg2 and psycopg 3. Output is written to `f` as bytes."""
+    raw = cursor.cursor
+    if hasattr(raw, 'copy_expert'):
+        raw.copy_expert(sql, f)
+        return
+    with raw.copy(sql) as copy:
+        if 'FROM STDIN' in sql.upper():
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                copy.write(chunk)
+        else:
+            for chunk in copy:
+                f.write(bytes(chunk))
+
+
+def copy_rows(cursor, table, columns, rows):
+    """Writes `rows` (sequences of values) into `table` using COPY in text format.
+
+    Returns the number of rows written.
+    """
+    buf = io.StringIO()
+    count = 0
+    for row in rows:
+        buf.write('\t'.join(_copy_value(val) for val in row))
+        buf.write('\n')
+        count += 1
+    if not count:
+        return 0
+    buf.seek(0)
+    sql = 'COPY %s (%s) FROM STDIN' % (quote_name(table), ', '.join(quote_name(c) for c in columns))
+    copy_expert(cursor, sql, buf)
+    return count
@@ -0,0 +1,184 @@
+"""
+Shadow-table imports
+
+With `geo_import --shadow` the importers write into copies of the munigeo
+tables in a separate schema while API readers keep using the live tables.
+The copies are created with Django's schema editor and filled from the live
+tables before their indexes and foreign keys are built. The import
+connections find them first on their search_path. When the import is done,
+the live tables are moved into a schema for the previous generation and
+the copies take their place in one short transaction. `geo_rollback` swaps
+the previous generation back.
+
+Rows written into the live tables during a shadow import are lost in the
+swap, so nothing else may write munigeo data meanwhile. Data generations
+stay in the live schema and are bumped after the swap.
+"""
+
+import logging
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+
+from munigeo.importer.pg import quote_name
+from munigeo.importer.snapshot import get_snapshot_models
+from munigeo.models import DATA_ENTITIES, DataGeneration
+
+logger = logging.getLogger(__name__)
+
+SHADOW_SCHEMA = 'munigeo_shadow'
+PREVIOUS_SCHEMA = 'munigeo_previous'
+# Longest time the swap waits for the locks of API queries on the live tables
+SWAP_LOCK_TIMEOUT = '30s'
+
+
+class ShadowImportError(Exception):
+    pass
+
+
+def _get_live_schema(cursor):
+    cursor.execute('SELECT current_schema()')
+    return cursor.fetchone()[0]
+
+
+def _move_tables(cursor, tables, from_schema, to_schema):
+    for table in tables:
+        cursor.execute('ALTER TABLE %s.%s SET SCHEMA %s' % (
+            quote_name(from_schema), quote_name(table), quote_name(to_schema)))
+
+
+def _get_tables():
+    return [model._meta.db_table for model in get_snapshot_models()]
+
+
+class ShadowImport(object):
+    def __init__(self):
+        self.models = get_snapshot_models()
+        self.tables = [model._meta.db_table for model in self.models]
+        self.live_schema = None
+        self._search_path = None
+
+    def _external_references(self, cursor):
+        """Returns foreign keys from other tables to the munigeo tables. They
+        would follow the live tables into the previous generation's schema."""
+        cursor.execute("""
+            SELECT c.conrelid::regclass::text, c.confrelid::regclass::text
+            FROM pg_constraint c
+            JOIN pg_class t ON t.oid = c.confrelid
+            JOIN pg_class s ON s.oid = c.conrelid
+            JOIN pg_namespace n ON n.oid = t.relnamespace
+            WHERE c.contype = 'f' AND n.nspname = %s AND t.relname = ANY(%s)
+            AND NOT (s.relnamespace = t.relnamespace AND s.relname = ANY(%s))
+        """, [self.live_schema, self.tables, self.tables])
+        return cursor.fetchall()
+
+    def prepare(self):
+        """Creates the shadow tables and copies the live data into them."""
+        if connection.vendor != 'postgresql':
+            raise ShadowImportError("Shadow imports require PostgreSQL")
+        with connection.cursor() as cursor:
+            self.live_schema = _get_live_schema(cursor)
+            refs = self._external_references(cursor)
+            if refs:
+                raise ShadowImportError("Tables outside munigeo reference munigeo tables: %s" % ', '.join(
+                    '%s -> %s' % ref for ref in refs))
+            cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE' % quote_name(SHADOW_SCHEMA))
+            cursor.execute('CREATE SCHEMA %s' % quote_name(SHADOW_SCHEMA))
+
+        search_path = '%s, %s' % (quote_name(SHADOW_SCHEMA), quote_name(self.live_schema))
+        # Indexes and foreign keys are deferred by the schema editor and
+        # built when it exits, after the data has been copied.
+        with connection.schema_editor() as editor:
+            editor.execute('SET LOCAL search_path TO %s' % search_path)
+            for model in self.models:
+                # Many-to-many tables are created with their models
+                if not model._meta.auto_created:
+                    editor.create_model(model)
+            for model in self.models:
+                columns = ', '.join(quote_name(field.column) for field in model._meta.local_concrete_fields)
+                editor.execute('INSERT INTO %s.%s (%s) SELECT %s FROM %s.%s' % (
+                    quote_name(SHADOW_SCHEMA), quote_name(model._meta.db_table), columns,
+                    columns, quote_name(self.live_schema), quote_name(model._meta.db_table)))
+            for sql in connection.ops.sequence_reset_sql(no_style(), self.models):
+                editor.execute(sql)
+        self._copy_extra_indexes()
+        logger.info("Created shadow copies of %d tables in schema %s" % (len(self.tables), SHADOW_SCHEMA))
+
+    def _copy_extra_indexes(self):
+        """Creates the indexes of the live tables that the models do not
+        declare, such as those of RunPython migrations, on the shadow tables."""
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT live.indexdef, quote_ident(live.schemaname) || '.' || quote_ident(live.tablename)
+                FROM pg_indexes live
+                WHERE live.schemaname = %s AND live.tablename = ANY(%s)
+                AND NOT EXISTS (SELECT 1 FROM pg_indexes shadow WHERE shadow.schemaname = %s
+                                AND shadow.indexname = live.indexname)
+            """, [self.live_schema, self.tables, SHADOW_SCHEMA])
+            for indexdef, live_table in cursor.fetchall():
+                shadow_table = '%s.%s' % (quote_name(SHADOW_SCHEMA), live_table.split('.', 1)[1])
+                cursor.execute(indexdef.replace(' ON %s ' % live_table, ' ON %s ' % shadow_table, 1))
+
+    def _set_search_path(self, sender=None, connection=None, **kwargs):
+        if connection.vendor != 'postgresql':
+            return
+        with connection.cursor() as cursor:
+            cursor.execute('SET search_path TO %s, %s' % (
+                quote_name(SHADOW_SCHEMA), quote_name(self.live_schema)))
+
+    def activate(self):
+        """Makes the database connections of this process, and of worker
+        processes forked from it, use the shadow tables."""
+        with connection.cursor() as cursor:
+            cursor.execute('SHOW search_path')
+            self._search_path = cursor.fetchone()[0]
+        connection_created.connect(self._set_search_path, dispatch_uid='munigeo_shadow_import')
+        self._set_search_path(connection=connection)
+
+    def deactivate(self):
+        connection_created.disconnect(dispatch_uid='munigeo_shadow_import')
+        if connection.connection is not None:
+            with connection.cursor() as cursor:
+                cursor.execute('SET search_path TO %s' % self._search_path)
+
+    def swap(self):
+        """Replaces the live tables with the shadow tables and keeps the
+        replaced tables as the previous generation."""
+        with connection.cursor() as cursor:
+            for table in self.tables:
+                cursor.execute('ANALYZE %s.%s' % (quote_name(SHADOW_SCHEMA), quote_name(table)))
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("SET LOCAL lock_timeout = '%s'" % SWAP_LOCK_TIMEOUT)
+            cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE' % quote_name(PREVIOUS_SCHEMA))
+            cursor.execute('CREATE SCHEMA %s' % quote_name(PREVIOUS_SCHEMA))
+            _move_tables(cursor, self.tables, self.live_schema, PREVIOUS_SCHEMA)
+            _move_tables(cursor, self.tables, SHADOW_SCHEMA, self.live_schema)
+            # Only work tables of the importers remain
+            cursor.execute('DROP SCHEMA %s CASCADE' % quote_name(SHADOW_SCHEMA))
+        logger.info("Swapped in the shadow tables, previous tables kept in schema %s" % PREVIOUS_SCHEMA)
+
+    def discard(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE' % quote_name(SHADOW_SCHEMA))
+
+
+def swap_back():
+    """Swaps the tables replaced by the last shadow import back in. Calling
+    it again undoes the rollback."""
+    tables = _get_tables()
+    with transaction.atomic(), connection.cursor() as cursor:
+        live_schema = _get_live_schema(cursor)
+        cursor.execute("""
+            SELECT count(*) FROM pg_tables WHERE schemaname = %s AND tablename = ANY(%s)
+        """, [PREVIOUS_SCHEMA, tables])
+        if cursor.fetchone()[0] != len(tables):
+            raise ShadowImportError("No previous generation of the munigeo tables in schema %s" % PREVIOUS_SCHEMA)
+        cursor.execute("SET LOCAL lock_timeout = '%s'" % SWAP_LOCK_TIMEOUT)
+        cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE' % quote_name(SHADOW_SCHEMA))
+        cursor.execute('CREATE SCHEMA %s' % quote_name(SHADOW_SCHEMA))
+        _move_tables(cursor, tables, live_schema, SHADOW_SCHEMA)
+        _move_tables(cursor, tables, PREVIOUS_SCHEMA, live_schema)
+        _move_tables(cursor, tables, SHADOW_SCHEMA, PREVIOUS_SCHEMA)
+        cursor.execute('DROP SCHEMA %s' % quote_name(SHADOW_SCHEMA))
+        DataGeneration.objects.bump(DATA_ENTITIES)
@@ -0,0 +1,170 @@
+"""
+Binary snapshots of all munigeo data
+
+A snapshot is a gzipped tar file with a manifest and one file per munigeo
+table in PostgreSQL's binary COPY format. Translations, geometries, tree
+fields and many-to-many tables are included as they are stored.
+
+Restoring replaces the contents of the munigeo tables in one transaction.
+The plain (non-constraint) indexes are dropped before loading and rebuilt
+afterwards, and foreign keys are checked at commit.
+"""
+
+import datetime
+import json
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+
+from django.apps import apps
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.migrations.recorder import MigrationRecorder
+
+from munigeo.importer.pg import copy_expert, quote_name
+from munigeo.models import DATA_ENTITIES, DataGeneration, PROJECTION_SRID
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def get_snapshot_models():
+    models = apps.get_app_config('munigeo').get_models(include_auto_created=True)
+    # Data generations only ever increase, they are bumped instead of restored
+    return [model for model in models if model._meta.managed and not model._meta.proxy and
+            model is not DataGeneration]
+
+
+def get_applied_migrations():
+    recorder = MigrationRecorder(connection)
+    return sorted(name for app, name in recorder.applied_migrations() if app == 'munigeo')
+
+
+def _table_columns(cursor, table):
+    return [col.name for col in connection.introspection.get_table_description(cursor, table)]
+
+
+def dump_snapshot(path):
+    """Writes all munigeo tables into a snapshot file at `path`. Returns the
+    manifest."""
+    if connection.vendor != 'postgresql':
+        raise SnapshotError("Snapshots require PostgreSQL")
+    if connection.in_atomic_block:
+        # The isolation level can only be set before the first query
+        raise SnapshotError("Snapshots cannot be dumped inside a transaction")
+
+    tables = []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            # All tables are read from the same snapshot of the database
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            for model in get_snapshot_models():
+                table = model._meta.db_table
+                columns = _table_columns(cursor, table)
+                file_name = '%s.copy' % table
+                with open(os.path.join(tmp_dir, file_name), 'wb') as f:
+                    sql = 'COPY %s (%s) TO STDOUT WITH (FORMAT binary)' % (
+                        quote_name(table), ', '.join(quote_name(col) for col in columns))
+                    copy_expert(cursor, sql, f)
+                cursor.execute('SELECT count(*) FROM %s' % quote_name(table))
+                rows = cursor.fetchone()[0]
+                logger.info("%s: %d rows" % (table, rows))
+                tables.append({'table': table, 'file': file_name, 'columns': columns, 'rows': rows})
+            migrations = get_applied_migrations()
+
+        manifest = {
+            'format_version': FORMAT_VERSION,
+            'created_at': datetime.datetime.utcnow().isoformat() + 'Z',
+            'srid': PROJECTION_SRID,
+            'migrations': migrations,
+            'tables': tables,
+        }
+        with open(os.path.join(tmp_dir, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        with tarfile.open(path, 'w:gz', compresslevel=6) as tar:
+            tar.add(os.path.join(tmp_dir, MANIFEST_NAME), arcname=MANIFEST_NAME)
+            for info in tables:
+                tar.add(os.path.join(tmp_dir, info['file']), arcname=info['file'])
+    finally:
+        shutil.rmtree(tmp_dir)
+    return manifest
+
+
+def read_manifest(tar):
+    try:
+        manifest = json.load(tar.extractfile(MANIFEST_NAME))
+    except KeyError:
+        raise SnapshotError("Not a munigeo snapshot: %s missing" % MANIFEST_NAME)
+    if manifest.get('format_version') != FORMAT_VERSION:
+        raise SnapshotError("Unsupported snapshot format version %s" % manifest.get('format_version'))
+    if manifest['srid'] != PROJECTION_SRID:
+        raise SnapshotError("Snapshot SRID %d does not match PROJECTION_SRID %d" % (
+            manifest['srid'], PROJECTION_SRID))
+    if manifest['migrations'] != get_applied_migrations():
+        raise SnapshotError("The snapshot was made with different munigeo migrations applied")
+    return manifest
+
+
+def _drop_plain_indexes(cursor, tables):
+    """Drops the indexes of `tables` that do not back a constraint and
+    returns their definitions."""
+    cursor.execute("""
+        SELECT i.indexname, i.indexdef FROM pg_indexes i
+        WHERE i.schemaname = current_schema() AND i.tablename = ANY(%s)
+        AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conname = i.indexname)
+    """, [tables])
+    indexes = cursor.fetchall()
+    for name, indexdef in indexes:
+        cursor.execute('DROP INDEX %s' % quote_name(name))
+    return [indexdef for name, indexdef in indexes]
+
+
+def restore_snapshot(path):
+    """Replaces the contents of the munigeo tables with the snapshot at
+    `path`. Returns the manifest."""
+    if connection.vendor != 'postgresql':
+        raise SnapshotError("Snapshots require PostgreSQL")
+
+    models = {model._meta.db_table: model for model in get_snapshot_models()}
+    with tarfile.open(path, 'r:gz') as tar:
+        manifest = read_manifest(tar)
+        tables = [info['table'] for info in manifest['tables']]
+        if set(tables) != set(models):
+            raise SnapshotError("Snapshot tables do not match the munigeo models")
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+            cursor.execute('TRUNCATE %s' % ', '.join(quote_name(table) for table in tables))
+            indexdefs = _drop_plain_indexes(cursor, tables)
+
+            for info in manifest['tables']:
+                columns = _table_columns(cursor, info['table'])
+                if set(columns) != set(info['columns']):
+                    raise SnapshotError("Columns of %s do not match the snapshot" % info['table'])
+                f = tar.extractfile(info['file'])
+                sql = 'COPY %s (%s) FROM STDIN WITH (FORMAT binary)' % (
+                    quote_name(info['table']), ', '.join(quote_name(col) for col in info['columns']))
+                copy_expert(cursor, sql, f)
+                logger.info("%s: %d rows" % (info['table'], info['rows']))
+
+            logger.info("Rebuilding %d indexes" % len(indexdefs))
+            for indexdef in indexdefs:
+                cursor.execute(indexdef)
+            for sql in connection.ops.sequence_reset_sql(no_style(), list(models.values())):
+                cursor.execute(sql)
+            DataGeneration.objects.bump(DATA_ENTITIES)
+
+        with connection.cursor() as cursor:
+            for table in tables:
+                cursor.execute('ANALYZE %s' % quote_name(table))
+    return manifest
@@ -1,20 +1,82 @@
 import logging
+from collections import defaultdict
+from contextlib import nullcontext
+
+from django.db import connections, router
+from parler.cache import delete_cached_translations, is_missing
 
 logger = logging.getLogger(__name__)
 
 
+def bulk_create_saved(model, objs, batch_size=1000):
+    """Inserts `objs` so that their primary keys are set afterwards. On
+    backends that cannot return the ids of bulk inserted rows the objects
+    are saved one by one instead."""
+    if not objs:
+        return
+    connection = connections[router.db_for_write(model)]
+    if connection.features.can_return_rows_from_bulk_insert:
+        model.objects.bulk_create(objs, batch_size=batch_size)
+    else:
+        for obj in objs:
+            obj.save_base(force_insert=True)
+
+
+def bulk_save_translations(objs, batch_size=1000):
+    """Writes the new and modified parler translations of already saved
+    TranslatableModel objects with one bulk_create and one bulk_update per
+    translation model, instead of one query per object and language."""
+    new = defaultdict(list)
+    modified = defaultdict(list)
+    modified_objs = []
+    for obj in objs:
+        assert obj.pk is not None, "%s must be saved before its translations" % obj
+        obj_modified = False
+        for model, translations in obj._translations_cache.items():
+            for translation in translations.values():
+                if is_missing(translation):
+                    continue
+                if translation.pk is None:
+                    translation.master = obj
+                    new[model].append(translation)
+                elif translation.is_modified:
+                    modified[model].append(translation)
+                    obj_modified = True
+        if obj_modified:
+            modified_objs.append(obj)
+
+    for model, translations in new.items():
+        model.objects.bulk_create(translations, batch_size=batch_size)
+    for model, translations in modified.items():
+        fields = [f.name for f in model._meta.concrete_fields
+                  if f.name not in ('id', 'language_code', 'master')]
+        model.objects.bulk_update(translations, fields, batch_size=batch_size)
+    for obj in modified_objs:
+        delete_cached_translations(obj)
+
+
 class ModelSyncher(object):
-    def __init__(self, queryset, generate_obj_id):
+    def __init__(self, queryset, generate_obj_id, metrics=None, stage=None):
         d = {}
         self.generate_obj_id = generate_obj_id
+        self.metrics = metrics
+        self.stage = stage or 'sync'
         # Generate a list of all objects
-        for obj in queryset:
-            d[generate_obj_id(obj)] = obj
-            obj._found = False
-            obj._changed = False
+        with self._measure('load') as m:
+            for obj in queryset:
+                d[generate_obj_id(obj)] = obj
+                obj._found = False
+                obj._changed = False
+            if m:
+                m.add_rows(len(d))
 
         self.obj_dict = d
 
+    def _measure(self, step):
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.stage('%s:%s' % (self.stage, step))
+
     def mark(self, obj):
         if getattr(obj, '_found', False):
             raise Exception("Object %s (%s) already marked" % (obj, self.generate_obj_id(obj)))
@@ -44,6 +106,47 @@ class ModelSyncher(object):
         delete_list = self.get_deleted_objects()
         if len(delete_list) > 5 and len(delete_list) > len(self.obj_dict) * 0.4:
             raise Exception("Attempting to delete more than 40% of total items")
-        for obj in delete_list:
-            logger.debug("Deleting object %s" % obj)
-            obj.delete()
+        with self._measure('delete') as m:
+            for obj in delete_list:
+                logger.debug("Deleting object %s" % obj)
+                obj.delete()
+            if m:
+                m.add_rows(len(delete_list))
+
+
+class BulkModelSyncher(ModelSyncher):
+    """ModelSyncher that writes the new and changed objects and deletes the
+    vanished ones with bulk queries when finish() is called."""
+    def __init__(self, queryset, generate_obj_id, update_fields, batch_size=1000, metrics=None, stage=None):
+        super(BulkModelSyncher, self).__init__(queryset, generate_obj_id, metrics=metrics, stage=stage)
+        self.model = queryset.model
+        self.update_fields = update_fields
+        self.batch_size = batch_size
+
+    def mark(self, obj, changed=True):
+        super(BulkModelSyncher, self).mark(obj)
+        obj._changed = changed
+
+    def finish(self):
+        """Returns the number of created, updated and deleted objects."""
+        delete_list = self.get_deleted_objects()
+        if len(delete_list) > 5 and len(delete_list) > len(self.obj_dict) * 0.4:
+            raise Exception("Attempting to delete more than 40% of total items")
+
+        found = [obj for obj in self.obj_dict.values() if obj._found]
+        new_list = [obj for obj in found if obj.pk is None]
+        changed_list = [obj for obj in found if obj.pk is not None and obj._changed]
+        with self._measure('write') as m:
+            if new_list:
+                self.model.objects.bulk_create(new_list, batch_size=self.batch_size)
+            if changed_list:
+                self.model.objects.bulk_update(changed_list, self.update_fields, batch_size=self.batch_size)
+            if m:
+                m.add_rows(len(new_list) + len(changed_list))
+        with self._measure('delete') as m:
+            if delete_list:
+                logger.debug("Deleting %d objects" % len(delete_list))
+                self.model.objects.filter(pk__in=[obj.pk for obj in delete_list]).delete()
+            if m:
+                m.add_rows(len(delete_list))
+        return len(new_list), len(changed_list), len(delete_list)
@@ -0,0 +1,88 @@
+"""
+Bulk rebuilding of MPTT trees
+
+Importers write tree nodes with MPTT updates disabled, giving new nodes
+placeholder tree fields, and then rebuild only the trees they touched.
+"""
+
+import logging
+
+from django.db.models import Max
+
+logger = logging.getLogger(__name__)
+
+
+def placeholder_tree_fields(obj):
+    """Sets tree fields to a new, unsaved node so that it can be saved with
+    MPTT updates disabled. `rebuild_trees` fixes them afterwards."""
+    opts = obj._mptt_meta
+    parent = getattr(obj, opts.parent_attr)
+    tree_id = getattr(parent, opts.tree_id_attr) if parent is not None else 0
+    setattr(obj, opts.tree_id_attr, tree_id)
+    setattr(obj, opts.left_attr, 1)
+    setattr(obj, opts.right_attr, 2)
+    setattr(obj, opts.level_attr, 0)
+
+
+def rebuild_trees(model, tree_ids, batch_size=1000):
+    """Recomputes the tree fields of the nodes of `model` in the trees with
+    the given ids from one scan of those trees and writes back the changed
+    ones in bulk. Every node moved between trees must be included with its
+    old and new tree id. Roots without a valid tree id of their own get a
+    new one. Returns the number of updated nodes."""
+    opts = model._mptt_meta
+    fields = (opts.tree_id_attr, opts.left_attr, opts.right_attr, opts.level_attr)
+    tree_ids = set(tree_ids)
+    if not tree_ids:
+        return 0
+
+    rows = model._tree_manager.filter(**{'%s__in' % opts.tree_id_attr: tree_ids})\
+        .values_list('pk', '%s_id' % opts.parent_attr, *fields)
+    nodes = {}
+    children = {}
+    for pk, parent_id, *values in rows:
+        nodes[pk] = values
+        children.setdefault(parent_id, []).append(pk)
+    orphans = [parent_id for parent_id in children if parent_id is not None and parent_id not in nodes]
+    if orphans:
+        raise Exception("Nodes have parents outside of trees %s: %s" % (sorted(tree_ids), orphans[:10]))
+    roots = children.get(None, [])
+
+    next_tree_id = (model._tree_manager.aggregate(max_id=Max(opts.tree_id_attr))['max_id'] or 0) + 1
+    used_tree_ids = set()
+    new_values = {}
+    for root in sorted(roots):
+        tree_id = nodes[root][0]
+        if not tree_id or tree_id in used_tree_ids:
+            tree_id = next_tree_id
+            next_tree_id += 1
+        used_tree_ids.add(tree_id)
+
+        # Iterative depth-first walk; siblings are ordered by primary key
+        counter = 1
+        new_values[root] = [tree_id, counter, None, 0]
+        stack = [(root, iter(sorted(children.get(root, []))))]
+        while stack:
+            pk, child_iter = stack[-1]
+            child = next(child_iter, None)
+            if child is None:
+                counter += 1
+                new_values[pk][2] = counter
+                stack.pop()
+                continue
+            counter += 1
+            new_values[child] = [tree_id, counter, None, len(stack)]
+            stack.append((child, iter(sorted(children.get(child, [])))))
+
+    changed = []
+    for pk, values in new_values.items():
+        if list(nodes[pk]) == values:
+            continue
+        obj = model(pk=pk)
+        for field, val in zip(fields, values):
+            setattr(obj, field, val)
+        changed.append(obj)
+    if changed:
+        model._tree_manager.bulk_update(changed, fields, batch_size=batch_size)
+    logger.debug("Rebuilt %d trees, %d nodes updated" % (len(roots), len(changed)))
+    return len(changed)
@@ -0,0 +1,424 @@
+"""
+Paged, streaming WFS client for importer data sources
+
+Features are requested from a WFS server one page at a time using
+`startIndex` and `count` (`maxFeatures` for WFS 1.x) and the GeoJSON
+responses are parsed incrementally, so that a feature is handed to the
+importer as soon as it has been received. Pages are downloaded in a
+background thread into a bounded queue, which lets download and processing
+overlap while keeping memory usage independent of the layer size.
+"""
+
+import codecs
+import json
+import logging
+import queue
+import re
+import threading
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+from django.contrib.gis.gdal import OGRGeometry
+
+from munigeo.importer.fetch import combine_digests
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 1000
+CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+class WFSError(Exception):
+    def __init__(self, message, code=None, locator=None):
+        super(WFSError, self).__init__(message)
+        self.code = code
+        self.locator = locator
+
+
+class WFSLayerNotFound(WFSError):
+    pass
+
+
+class FeatureCollectionParser(object):
+    """Incremental parser for a GeoJSON FeatureCollection.
+
+    `chunks` is an iterable of bytes (or str) pieces of the document.
+    Iterating over the parser yields the feature dicts one by one.
+    The other top-level members (e.g. `numberMatched`) are collected
+    into `members`.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self.members = {}
+
+    def _read(self):
+        if self._eof:
+            return False
+        for chunk in self._chunks:
+            if isinstance(chunk, bytes):
+                chunk = self._text_decoder.decode(chunk)
+            if not chunk:
+                continue
+            if self._pos > CHUNK_SIZE:
+                # Drop the already consumed part to keep memory bounded
+                self._buf = self._buf[self._pos:]
+                self._pos = 0
+            self._buf += chunk
+            return True
+        self._eof = True
+        self._buf += self._text_decoder.decode(b'', final=True)
+        return False
+
+    def _read_more(self):
+        # Grow the pending data at least twofold so that a large value
+        # is not re-decoded from the start for every chunk.
+        target = 2 * (len(self._buf) - self._pos) + 1
+        ret = False
+        while len(self._buf) - self._pos < target:
+            if not self._read():
+                break
+            ret = True
+        return ret
+
+    def _skip_ws(self):
+        while True:
+            buf = self._buf
+            pos = self._pos
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            self._pos = pos
+            if pos < len(buf) or not self._read():
+                return
+
+    def _next_char(self):
+        self._skip_ws()
+        if self._pos >= len(self._buf):
+            raise ValueError("Unexpected end of GeoJSON document")
+        c = self._buf[self._pos]
+        self._pos += 1
+        return c
+
+    def _peek(self):
+        self._skip_ws()
+        if self._pos >= len(self._buf):
+            return None
+        return self._buf[self._pos]
+
+    def _expect(self, char):
+        c = self._next_char()
+        if c != char:
+            raise ValueError("Invalid GeoJSON: expected '%s', got '%s'" % (char, c))
+
+    def _decode(self):
+        self._skip_ws()
+        while True:
+            try:
+                val, end = _decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if not self._read_more():
+                    raise
+                continue
+            # A number at the very end of the buffer might continue in
+            # the next chunk.
+            if end >= len(self._buf) and self._read_more():
+                continue
+            self._pos = end
+            return val
+
+    def _iter_array(self):
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self._decode()
+            c = self._next_char()
+            if c == ']':
+                return
+            if c != ',':
+                raise ValueError("Invalid GeoJSON: expected ',' or ']', got '%s'" % c)
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._decode()
+            self._expect(':')
+            if key == 'features':
+                for feat in self._iter_array():
+                    yield feat
+            else:
+                self.members[key] = self._decode()
+            c = self._next_char()
+            if c == '}':
+                return
+            if c != ',':
+                raise ValueError("Invalid GeoJSON: expected ',' or '}', got '%s'" % c)
+
+
+class WFSField(object):
+    """Mimics the parts of `django.contrib.gis.gdal.Field` used by the importers"""
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+    def as_string(self):
+        if self.value is None:
+            return None
+        return str(self.value)
+
+
+class WFSFeature(object):
+    """Mimics the parts of `django.contrib.gis.gdal.Feature` used by the importers"""
+    def __init__(self, data, srid=None):
+        self.fid = data.get('id')
+        self.properties = data.get('properties') or {}
+        self.srid = srid
+        self._geometry = data.get('geometry')
+
+    def get(self, field):
+        return self.properties.get(field)
+
+    def __getitem__(self, field):
+        if field not in self.properties:
+            raise KeyError("Field '%s' not found in feature %s" % (field, self.fid))
+        return WFSField(field, self.properties[field])
+
+    @property
+    def fields(self):
+        return list(self.properties.keys())
+
+    @property
+    def geom(self):
+        if self._geometry is None:
+            return None
+        return OGRGeometry(json.dumps(self._geometry), self.srid)
+
+
+def _check_response(resp):
+    content_type = resp.headers.get('content-type', '')
+    if resp.status_code != 200 or 'json' not in content_type:
+        raise _parse_exception_report(resp)
+
+
+def _parse_exception_report(resp):
+    text = resp.text
+    m = re.search(r'exceptionCode="([^"]*)"', text)
+    code = m.group(1) if m else None
+    m = re.search(r'locator="([^"]*)"', text)
+    locator = m.group(1) if m else None
+    m = re.search(r'<(?:\w+:)?ExceptionText>(.*?)</(?:\w+:)?ExceptionText>', text, re.S)
+    message = m.group(1).strip() if m else text[:200]
+    if locator and locator.lower() in ('typename', 'typenames'):
+        exc_class = WFSLayerNotFound
+    else:
+        exc_class = WFSError
+    return exc_class("%s: %s" % (resp.url, message), code=code, locator=locator)
+
+
+_STOP = object()
+
+
+class WFSReader(object):
+    """Iterable over the features of a WFS layer.
+
+    Yields `WFSFeature` objects, which can be used in place of OGR
+    features by the importers.
+
+    If a `SourceCache` is given, the pages are fetched through it and
+    parsed from the cached copies. `digest` is then set once the features
+    have been read to the end. `prefetch()` downloads the whole layer up
+    front instead, for callers that need the digest before processing.
+
+    `bbox` (minx, miny, maxx, maxy) in `bbox_srid` and the CQL `filter`
+    are evaluated by the server. When both are given, the bbox is folded
+    into the CQL filter as a BBOX() on `geometry_field`, since servers do
+    not accept both parameters.
+    """
+    def __init__(self, url, layer, srid=None, version='2.0.0', page_size=DEFAULT_PAGE_SIZE,
+                 params=None, session=None, queue_size=None, cache=None, ttl=0,
+                 bbox=None, bbox_srid=None, filter=None, geometry_field='geom'):
+        self.url = url
+        self.layer = layer
+        self.srid = srid
+        self.version = version
+        self.page_size = page_size
+        self.params = params or {}
+        self.session = session or requests.Session()
+        self.queue_size = queue_size or 2 * page_size
+        self.cache = cache
+        self.ttl = ttl
+        self.bbox = bbox
+        self.bbox_srid = bbox_srid
+        self.filter = filter
+        self.geometry_field = geometry_field
+        self.page_count = 0
+        self._page_sources = {}
+        self._prefetched = None
+
+    def get_filter_params(self):
+        if not self.bbox and not self.filter:
+            return {}
+        bbox = None
+        if self.bbox:
+            bbox = ','.join(str(val) for val in self.bbox)
+        if self.filter and bbox:
+            crs = ",'EPSG:%d'" % self.bbox_srid if self.bbox_srid else ''
+            return {'CQL_FILTER': '(%s) AND BBOX(%s,%s%s)' % (self.filter, self.geometry_field, bbox, crs)}
+        if self.filter:
+            return {'CQL_FILTER': self.filter}
+        if self.bbox_srid:
+            bbox += ',EPSG:%d' % self.bbox_srid
+        return {'BBOX': bbox}
+
+    def get_page_params(self, start_index):
+        url_params = set(key.lower() for key, val in parse_qsl(urlsplit(self.url).query))
+        wfs_1 = self.version.startswith('1.')
+        params = {
+            'service': 'WFS',
+            'version': self.version,
+            'request': 'GetFeature',
+            'typeName' if wfs_1 else 'typeNames': self.layer,
+            'outputFormat': 'application/json',
+            'startIndex': start_index,
+            'maxFeatures' if wfs_1 else 'count': self.page_size,
+        }
+        if self.srid:
+            params['srsName'] = 'EPSG:%d' % self.srid
+        params.update(self.get_filter_params())
+        params.update(self.params)
+        # Parameters given in the URL itself take precedence
+        return {key: val for key, val in params.items() if key.lower() not in url_params}
+
+    def iter_page(self, start_index, members=None):
+        """Yields the feature dicts of a single page."""
+        params = self.get_page_params(start_index)
+        if self.cache:
+            source = None
+            if self._prefetched is not None:
+                source = self._prefetched.get(start_index)
+            if source is None:
+                source = self.cache.fetch(self.url, params=params, ttl=self.ttl,
+                                          validate=_check_response)
+            self._page_sources[start_index] = source
+            chunks = source.iter_content(CHUNK_SIZE)
+            close = chunks.close
+        else:
+            resp = self.session.get(self.url, params=params, stream=True)
+            close = resp.close
+            try:
+                _check_response(resp)
+            except Exception:
+                close()
+                raise
+            chunks = resp.iter_content(chunk_size=CHUNK_SIZE)
+        try:
+            parser = FeatureCollectionParser(chunks)
+            for feat in parser:
+                yield feat
+            if members is not None:
+                members.update(parser.members)
+        finally:
+            close()
+
+    def iter_features(self):
+        """Yields feature dicts from all pages, without prefetching."""
+        start_index = 0
+        self.page_count = 0
+        self._page_sources = {}
+        while True:
+            members = {}
+            count = 0
+            for feat in self.iter_page(start_index, members):
+                count += 1
+                yield feat
+            self.page_count += 1
+            start_index += count
+            logger.debug("%s: page %d done, %d features" % (self.layer, self.page_count, start_index))
+            matched = members.get('numberMatched', members.get('totalFeatures'))
+            if not count:
+                break
+            if isinstance(matched, int):
+                if start_index >= matched:
+                    break
+            elif count < self.page_size:
+                break
+        if self.cache:
+            # All pages have been read, later iterations reuse them
+            self._prefetched = self._page_sources
+
+    def prefetch(self):
+        """Downloads all pages into the cache and returns a digest of the layer contents."""
+        assert self.cache, "prefetch() requires a SourceCache"
+        self._prefetched = None
+        for feat in self.iter_features():
+            pass
+        return self.digest
+
+    @property
+    def digest(self):
+        """Digest of the layer contents, or None until all pages have been read."""
+        if self._prefetched is None:
+            return None
+        return self.partial_digest(len(self._prefetched))
+
+    @property
+    def pages_read(self):
+        """Number of pages fetched by the current iteration. The pages are
+        read ahead of the features handed to the caller."""
+        return len(self._page_sources)
+
+    def partial_digest(self, pages):
+        """Returns a digest of the first `pages` pages, or None if fewer
+        pages have been read."""
+        sources = self._prefetched if self._prefetched is not None else self._page_sources
+        sources = sorted(sources.items())
+        if len(sources) < pages:
+            return None
+        return combine_digests([source.digest for start_index, source in sources[:pages]])
+
+    def _produce(self, out_queue, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    out_queue.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for feat in self.iter_features():
+                if not put(feat):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(_STOP)
+
+    def __iter__(self):
+        out_queue = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(out_queue, stop),
+                                  name='wfs-%s' % self.layer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = out_queue.get()
+                if item is _STOP:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield WFSFeature(item, self.srid)
+        finally:
+            # The producer notices this on its next queue operation
+            stop.set()
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from munigeo.importer.snapshot import SnapshotError, dump_snapshot
+
+
+class Command(BaseCommand):
+    help = "Dump all munigeo data into a binary snapshot file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', type=str, help='Snapshot file to write (.tar.gz)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        try:
+            manifest = dump_snapshot(path)
+        except SnapshotError as e:
+            raise CommandError(str(e))
+        rows = sum(info['rows'] for info in manifest['tables'])
+        self.stdout.write("Dumped %d rows from %d tables into %s (%.1f MiB)" % (
+            rows, len(manifest['tables']), path, os.path.getsize(path) / (1024 * 1024)))
@@ -1,54 +1,255 @@
 # -*- coding: utf-8 -*-
-import os
-from optparse import make_option
+import json
+import logging
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from django import db
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.utils.translation import activate, get_language
 
-from munigeo.importer.base import get_importers
+from munigeo.importer.base import find_importers, get_import_journal, get_importer
+from munigeo.importer.diff import ImportDiff
+from munigeo.importer.metrics import ImportMetrics
+from munigeo.importer.shadow import ShadowImport, ShadowImportError
+from munigeo.models import AddressDivision, DataGeneration
+
+
+def run_import_stage(module, imp_type, options):
+    """Imports `imp_type` with importer `module` and returns the result.
+    Runs in a worker process when stages are imported in parallel."""
+    importer = get_importer(module)(options)
+    result = {'module': module, 'type': imp_type}
+    start = time.perf_counter()
+
+    # Activate the default language for the duration of the import
+    # to make sure translated fields are populated correctly.
+    old_lang = get_language()
+    activate(settings.LANGUAGES[0][0])
+    try:
+        getattr(importer, 'import_%s' % imp_type)()
+        result['status'] = 'ok'
+    except Exception as e:
+        importer.logger.exception("Importing %s failed" % imp_type)
+        result['status'] = 'failed'
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    finally:
+        activate(old_lang)
+
+    result['wall_time'] = time.perf_counter() - start
+    result['metrics'] = importer.metrics
+    result['diff'] = importer.diff
+    result['changed_entities'] = sorted(importer.changed_entities)
+    return result
 
 
 class Command(BaseCommand):
     help = "Import geo data"
 
-    importer_types = ['municipalities', 'divisions', 'addresses', 'pois']
+    importer_types = ['municipalities', 'divisions', 'addresses', 'pois', 'plans']
+    # Entity types imported before the given type when both are part of the
+    # same run, whichever importers provide them
+    type_dependencies = {
+        'divisions': ('municipalities',),
+        'addresses': ('municipalities',),
+        'pois': ('municipalities',),
+        'plans': ('municipalities',),
+    }
 
     def add_arguments(self, parser):
-        parser.add_argument('module', type=str)
+        parser.add_argument('module', type=str, nargs='+')
         parser.add_argument('--all', action='store_true', dest='all', help='Import all entities')
         for imp in self.importer_types:
             parser.add_argument('--%s' % imp, dest=imp, action='store_true', help='import %s' % imp)
+        parser.add_argument('--force', action='store_true', dest='force',
+                            help='Import sources even if they have not changed since the last import')
+        parser.add_argument('--resume', action='store_true', dest='resume',
+                            help='Resume an interrupted import, skipping the stages it completed')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+                            help='Only report what would change as JSON, without writing to the database')
+        parser.add_argument('--metrics-file', dest='metrics_file',
+                            help='Write per-stage timings, row counts, query counts and memory peaks '
+                                 'as JSON to this file')
+        parser.add_argument('--workers', type=int, dest='workers',
+                            help='Number of worker processes for geometry processing (default: CPU count)')
+        parser.add_argument('--shadow', action='store_true', dest='shadow',
+                            help='Import into copies of the munigeo tables and swap them in when done')
+        parser.add_argument('--jobs', '-j', type=int, dest='jobs', default=1,
+                            help='Number of import stages run in parallel worker processes (default: 1)')
 
     def __init__(self):
         super(Command, self).__init__()
 
+    def get_stages(self, modules, options):
+        stages = []
+        for module in modules:
+            imp_class = get_importer(module)
+            for imp_type in self.importer_types:
+                method = getattr(imp_class, "import_%s" % imp_type, None)
+                if options[imp_type]:
+                    if not method:
+                        raise CommandError("Importer %s does not support importing %s" % (module, imp_type))
+                else:
+                    if not options['all'] or not method:
+                        continue
+                if options.get('dry_run') and imp_type not in imp_class.dry_run_types:
+                    logging.getLogger("%s_importer" % module).warning(
+                        "Importing %s does not support --dry-run, skipping" % imp_type)
+                    continue
+                stages.append((module, imp_type))
+        return stages
+
+    def run_stages(self, stages, options, jobs):
+        """Runs `stages` in dependency order, up to `jobs` at a time, and
+        returns their results by stage. Stages that depend on a failed stage
+        are skipped."""
+        stage_options = {key: val for key, val in options.items() if key not in ('stdout', 'stderr')}
+        stage_options['keep_journal'] = True
+        deps = {stage: [other for other in stages
+                        if other[1] in self.type_dependencies.get(stage[1], ())]
+                for stage in stages}
+
+        executor = None
+        if jobs > 1:
+            # Worker processes must not share the database connection. They
+            # are forked to inherit the configured Django setup and the
+            # search_path of a shadow import.
+            db.connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('fork'))
+            # Pool workers may not start process pools of their own
+            stage_options['workers'] = 1
+        pending = list(stages)
+        running = {}
+        results = {}
+        try:
+            while pending or running:
+                for stage in list(pending):
+                    if any(dep in results and results[dep]['status'] != 'ok' for dep in deps[stage]):
+                        results[stage] = {'module': stage[0], 'type': stage[1], 'status': 'skipped'}
+                        pending.remove(stage)
+                    elif all(dep in results for dep in deps[stage]):
+                        pending.remove(stage)
+                        if executor is None:
+                            results[stage] = run_import_stage(stage[0], stage[1], stage_options)
+                            break
+                        try:
+                            future = executor.submit(run_import_stage, stage[0], stage[1], stage_options)
+                        except BrokenProcessPool as e:
+                            # A worker has died; the stages that have not run
+                            # yet are failed, those running are collected below
+                            for failed in [stage] + pending:
+                                results[failed] = {'module': failed[0], 'type': failed[1], 'status': 'failed',
+                                                   'error': '%s: %s' % (e.__class__.__name__, e)}
+                            pending = []
+                            break
+                        running[future] = stage
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        results[stage] = future.result()
+                    except Exception as e:
+                        # The worker process died
+                        results[stage] = {'module': stage[0], 'type': stage[1], 'status': 'failed',
+                                          'error': '%s: %s' % (e.__class__.__name__, e)}
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return results
+
+    def refresh_derived_data(self, results):
+        """Updates the data derived from several entity types once all
+        stages are done."""
+        changed = set(entity for result in results.values() for entity in result.get('changed_entities', ()))
+        if changed & {'addresses', 'divisions'}:
+            start = time.perf_counter()
+            count = AddressDivision.objects.refresh()
+            self.stderr.write("Address divisions: %d memberships in %.1f s" % (count, time.perf_counter() - start))
+
     def handle(self, *args, **options):
-        importers = get_importers()
+        importers = find_importers()
         imp_list = ', '.join(sorted(importers.keys()))
-        imp_name = options.get('module')
-        if not imp_name:
+        modules = options.get('module')
+        if not modules:
             raise CommandError("Enter the name of the geo importer module. Valid importers: %s" % imp_list)
-        if imp_name not in importers:
-            raise CommandError("Importer %s not found. Valid importers: %s" % (args[0], imp_list))
-        imp_class = importers[imp_name]
-        importer = imp_class(options)
-
-        # Activate the default language for the duration of the import
-        # to make sure translated fields are populated correctly.
-        old_lang = get_language()
-        activate(settings.LANGUAGES[0][0])
-
-        for imp_type in self.importer_types:
-            name = "import_%s" % imp_type
-            method = getattr(importer, name, None)
-            if options[imp_type]:
-                if not method:
-                    raise CommandError("Importer %s does not support importing %s" % (name, imp_type))
+        for imp_name in modules:
+            if imp_name not in importers:
+                raise CommandError("Importer %s not found. Valid importers: %s" % (imp_name, imp_list))
+
+        stages = self.get_stages(modules, options)
+        if not options.get('resume') and not options.get('dry_run'):
+            for module in modules:
+                get_import_journal(module).reset()
+
+        shadow = None
+        if options.get('shadow'):
+            if options.get('dry_run'):
+                raise CommandError("--shadow cannot be used with --dry-run")
+            shadow = ShadowImport()
+            try:
+                shadow.prepare()
+            except ShadowImportError as e:
+                raise CommandError(str(e))
+
+        metrics = {module: ImportMetrics(trace=bool(options.get('metrics_file'))) for module in modules}
+        diff = ImportDiff()
+        if shadow is None:
+            results = self.run_stages(stages, options, max(options.get('jobs') or 1, 1))
+            self.refresh_derived_data(results)
+        else:
+            shadow.activate()
+            try:
+                results = self.run_stages(stages, options, max(options.get('jobs') or 1, 1))
+                self.refresh_derived_data(results)
+            except Exception:
+                shadow.deactivate()
+                shadow.discard()
+                raise
+            shadow.deactivate()
+            if all(result['status'] == 'ok' for result in results.values()):
+                shadow.swap()
+                DataGeneration.objects.bump(set(entity for result in results.values()
+                                                for entity in result.get('changed_entities', ())))
             else:
-                if not options['all']:
-                    continue
+                # Failed stages may have committed part of their data, so
+                # none of it is published
+                self.stderr.write("Import stages failed, discarding the shadow tables")
+                shadow.discard()
 
-            if method:
-                method()
+        imports = []
+        for stage in stages:
+            result = results[stage]
+            if 'metrics' in result:
+                metrics[stage[0]].update(result.pop('metrics'))
+                diff.update(result.pop('diff'))
+            imports.append(result)
 
-        activate(old_lang)
+        # Write the metrics of failed runs too, they show where the time went
+        for module in modules:
+            metrics[module].log_summary(logging.getLogger("%s_importer" % module))
+        for result in imports:
+            msg = "%s %s: %s" % (result['module'], result['type'], result['status'])
+            if 'wall_time' in result:
+                msg += " in %.1f s" % result['wall_time']
+            self.stderr.write(msg)
+        if options.get('metrics_file'):
+            report = {
+                'imports': imports,
+                'modules': {module: module_metrics.report() for module, module_metrics in metrics.items()},
+            }
+            with open(options['metrics_file'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+        failed = [result for result in imports if result['status'] != 'ok']
+        if failed:
+            raise CommandError("%d of %d import stages failed or were skipped: %s" % (
+                len(failed), len(imports),
+                ', '.join("%s %s" % (result['module'], result['type']) for result in failed)))
+
+        if options.get('dry_run'):
+            self.stdout.write(diff.as_json())
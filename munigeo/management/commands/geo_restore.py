@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from munigeo.importer.snapshot import SnapshotError, restore_snapshot
+
+
+class Command(BaseCommand):
+    help = "Replace all munigeo data with the contents of a snapshot made with geo_dump"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', type=str, help='Snapshot file to restore')
+        parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive',
+                            help='Do not prompt for confirmation')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if options['interactive']:
+            confirm = input("This will replace ALL munigeo data in the database with %s.\n"
+                            "Type 'yes' to continue, or 'no' to cancel: " % path)
+            if confirm != 'yes':
+                raise CommandError("Restore cancelled.")
+        try:
+            manifest = restore_snapshot(path)
+        except SnapshotError as e:
+            raise CommandError(str(e))
+        rows = sum(info['rows'] for info in manifest['tables'])
+        self.stdout.write("Restored %d rows into %d tables from snapshot created at %s" % (
+            rows, len(manifest['tables']), manifest['created_at']))
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from munigeo.importer.shadow import ShadowImportError, swap_back
+
+
+class Command(BaseCommand):
+    help = "Swap the munigeo tables replaced by the last geo_import --shadow back in"
+
+    def handle(self, *args, **options):
+        try:
+            swap_back()
+        except ShadowImportError as e:
+            raise CommandError(str(e))
+        self.stdout.write("Restored the previous munigeo tables. Run again to undo.")
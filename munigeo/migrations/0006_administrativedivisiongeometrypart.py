@@ -0,0 +1,38 @@
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+from munigeo.utils import get_default_srid
+DEFAULT_SRID = get_default_srid()
+
+
+def create_parts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('''
+        INSERT INTO munigeo_administrativedivisiongeometrypart (geometry_id, boundary)
+        SELECT id, part FROM (
+            SELECT id, (ST_Dump(ST_Subdivide(boundary, 256))).geom AS part
+            FROM munigeo_administrativedivisiongeometry
+        ) AS parts
+        WHERE GeometryType(part) = 'POLYGON'
+    ''')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('munigeo', '0005_update_translation_foreign_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdministrativeDivisionGeometryPart',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('boundary', django.contrib.gis.db.models.fields.PolygonField(srid=DEFAULT_SRID)),
+                ('geometry', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='parts', to='munigeo.AdministrativeDivisionGeometry')),
+            ],
+        ),
+        migrations.RunPython(create_parts, migrations.RunPython.noop),
+    ]
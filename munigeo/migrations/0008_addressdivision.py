@@ -0,0 +1,28 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('munigeo', '0007_datageneration'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AddressDivision',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='munigeo.Address')),
+                ('division', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='munigeo.AdministrativeDivision')),
+            ],
+            options={
+                'unique_together': {('address', 'division')},
+            },
+        ),
+        migrations.AddField(
+            model_name='address',
+            name='divisions',
+            field=models.ManyToManyField(blank=True, help_text='Divisions that contain the address', related_name='addresses', through='munigeo.AddressDivision', to='munigeo.AdministrativeDivision'),
+        ),
+    ]
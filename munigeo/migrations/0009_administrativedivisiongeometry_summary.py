@@ -0,0 +1,48 @@
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+
+from munigeo.utils import get_default_srid
+DEFAULT_SRID = get_default_srid()
+
+
+def fill_summaries(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('''
+            UPDATE munigeo_administrativedivisiongeometry
+            SET bbox = ST_Envelope(boundary), area = ST_Area(boundary), label_point = ST_PointOnSurface(boundary)
+        ''')
+        return
+    from django.contrib.gis.geos import Polygon
+    AdministrativeDivisionGeometry = apps.get_model('munigeo', 'AdministrativeDivisionGeometry')
+    for geom_obj in AdministrativeDivisionGeometry.objects.all():
+        geom_obj.bbox = Polygon.from_bbox(geom_obj.boundary.extent)
+        geom_obj.bbox.srid = geom_obj.boundary.srid
+        geom_obj.area = geom_obj.boundary.area
+        geom_obj.label_point = geom_obj.boundary.point_on_surface
+        geom_obj.save(update_fields=['bbox', 'area', 'label_point'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('munigeo', '0008_addressdivision'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='administrativedivisiongeometry',
+            name='area',
+            field=models.FloatField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='administrativedivisiongeometry',
+            name='bbox',
+            field=django.contrib.gis.db.models.fields.PolygonField(null=True, srid=DEFAULT_SRID),
+        ),
+        migrations.AddField(
+            model_name='administrativedivisiongeometry',
+            name='label_point',
+            field=django.contrib.gis.db.models.fields.PointField(null=True, srid=DEFAULT_SRID),
+        ),
+        migrations.RunPython(fill_summaries, migrations.RunPython.noop),
+    ]
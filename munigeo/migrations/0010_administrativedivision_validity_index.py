@@ -0,0 +1,41 @@
+from django.db import DatabaseError, migrations, transaction
+
+VALIDITY_RANGE = (
+    "(CASE WHEN \"end\" < start THEN 'empty'::daterange ELSE daterange(start, \"end\", '[]') END)"
+)
+
+
+def create_validity_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX munigeo_admdiv_validity_gist ON munigeo_administrativedivision '
+        'USING gist (%s)' % VALIDITY_RANGE)
+    # Combining the type with the validity needs btree_gist, which may not
+    # be available to the database user
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute('CREATE EXTENSION IF NOT EXISTS btree_gist')
+    except DatabaseError:
+        return
+    schema_editor.execute(
+        'CREATE INDEX munigeo_admdiv_type_validity_gist ON munigeo_administrativedivision '
+        'USING gist (type_id, %s)' % VALIDITY_RANGE)
+
+
+def drop_validity_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS munigeo_admdiv_type_validity_gist')
+    schema_editor.execute('DROP INDEX IF EXISTS munigeo_admdiv_validity_gist')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('munigeo', '0009_administrativedivisiongeometry_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_validity_indexes, drop_validity_indexes),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('munigeo', '0010_administrativedivision_validity_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportedSource',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(max_length=500, unique=True)),
+                ('digest', models.CharField(max_length=64)),
+                ('imported_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
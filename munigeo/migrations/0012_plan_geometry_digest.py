@@ -0,0 +1,27 @@
+import hashlib
+
+from django.db import migrations, models
+
+
+def fill_digests(apps, schema_editor):
+    # Same digest as munigeo.importer.geometry.geometry_digest()
+    Plan = apps.get_model('munigeo', 'Plan')
+    for plan in Plan.objects.only('id', 'geometry').iterator():
+        plan.geometry_digest = hashlib.sha256(bytes(plan.geometry.wkb)).hexdigest()
+        plan.save(update_fields=['geometry_digest'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('munigeo', '0011_importedsource'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plan',
+            name='geometry_digest',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.RunPython(fill_digests, migrations.RunPython.noop),
+    ]
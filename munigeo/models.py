@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 from django.utils.translation import gettext as _
 from django.contrib.gis.db import models
+from django.contrib.gis.geos import Polygon
+from django.db import connections, transaction
+from django.db.models import F, Func
 from django.db.models.query import Q
+from django.utils import timezone
 from mptt.models import MPTTModel, TreeForeignKey
 from mptt.managers import TreeManager
 from parler.models import TranslatableModel, TranslatedFields
 from parler.managers import TranslatableQuerySet, TranslatableManager
 
+from munigeo.signals import data_changed
 from munigeo.utils import get_default_srid
 
 PROJECTION_SRID = get_default_srid()
@@ -26,8 +31,34 @@ class AdministrativeDivisionType(models.Model):
         return "%s (%s)" % (self.name, self.type)
 
 
+class ValidityRange(Func):
+    """The validity period of a division as a daterange, matching the GiST
+    indexes created in migration 0010. Inverted periods are empty."""
+    template = ("CASE WHEN %(end)s < %(start)s THEN 'empty'::daterange "
+                "ELSE daterange(%(start)s, %(end)s, '[]') END")
+
+    def __init__(self, **extra):
+        # Only used on PostgreSQL, which has psycopg2 installed
+        from django.contrib.postgres.fields import DateRangeField
+        super(ValidityRange, self).__init__(F('start'), F('end'), output_field=DateRangeField(), **extra)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        start, start_params = compiler.compile(self.source_expressions[0])
+        end, end_params = compiler.compile(self.source_expressions[1])
+        sql = self.template % {'start': start, 'end': end}
+        return sql, end_params + start_params + start_params + end_params
+
+
 class AdministrativeDivisionQuerySet(TranslatableQuerySet):
 
+    def valid_on(self, date):
+        """Filters the divisions whose validity period includes `date`.
+        Unset start and end dates are open ends."""
+        if connections[self.db].vendor != 'postgresql':
+            return self.filter((Q(start__lte=date) | Q(start__isnull=True)) &
+                               (Q(end__gte=date) | Q(end__isnull=True)))
+        return self.alias(validity=ValidityRange()).filter(validity__contains=date)
+
     def by_ancestor(self, ancestor):
         manager = self.model.objects
         max_level = manager.determine_max_level()
@@ -101,6 +132,92 @@ class AdministrativeDivision(MPTTModel, TranslatableModel):
 class AdministrativeDivisionGeometry(models.Model):
     division = models.OneToOneField(AdministrativeDivision, related_name='geometry', on_delete=models.CASCADE)
     boundary = models.MultiPolygonField(srid=PROJECTION_SRID)
+    # Derived from the boundary, so that lists can be sorted, labelled and
+    # prefiltered without loading it. Area is in PROJECTION_SRID units.
+    bbox = models.PolygonField(srid=PROJECTION_SRID, null=True)
+    area = models.FloatField(null=True, db_index=True)
+    label_point = models.PointField(srid=PROJECTION_SRID, null=True)
+
+    def update_summary(self):
+        """Sets bbox, area and label_point from the boundary. Called by
+        save(); bulk writes must call it themselves."""
+        if self.boundary is None:
+            self.bbox = self.area = self.label_point = None
+            return
+        self.bbox = Polygon.from_bbox(self.boundary.extent)
+        self.bbox.srid = self.boundary.srid
+        self.area = self.boundary.area
+        self.label_point = self.boundary.point_on_surface
+
+    def save(self, *args, **kwargs):
+        # Importers that save many geometries refresh their parts in one go
+        refresh_parts = kwargs.pop('refresh_parts', True)
+        self.update_summary()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'boundary' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'bbox', 'area', 'label_point'}
+        super(AdministrativeDivisionGeometry, self).save(*args, **kwargs)
+        if refresh_parts and (update_fields is None or 'boundary' in update_fields):
+            AdministrativeDivisionGeometryPart.objects.db_manager(kwargs.get('using') or self._state.db).refresh(
+                [self.pk])
+
+
+# Maximum number of vertices in one AdministrativeDivisionGeometryPart
+GEOMETRY_PART_MAX_VERTICES = 256
+
+
+class AdministrativeDivisionGeometryPartManager(models.Manager):
+    def refresh(self, geometry_ids=None):
+        """Recreates the parts of the given AdministrativeDivisionGeometry
+        ids, or of all geometries if `geometry_ids` is None."""
+        if geometry_ids is not None:
+            geometry_ids = list(geometry_ids)
+            if not geometry_ids:
+                return
+        connection = connections[self.db]
+        if connection.vendor != 'postgresql':
+            return self._refresh_python(geometry_ids)
+
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        geom_table = connection.ops.quote_name(AdministrativeDivisionGeometry._meta.db_table)
+        if geometry_ids is None:
+            where, params = '', []
+        else:
+            where, params = 'WHERE id = ANY(%s)', [geometry_ids]
+        with connection.cursor() as cursor:
+            if geometry_ids is None:
+                cursor.execute('DELETE FROM %s' % table)
+            else:
+                cursor.execute('DELETE FROM %s WHERE geometry_id = ANY(%%s)' % table, [geometry_ids])
+            cursor.execute('''
+                INSERT INTO %(table)s (geometry_id, boundary)
+                SELECT id, part FROM (
+                    SELECT id, (ST_Dump(ST_Subdivide(boundary, %%s))).geom AS part
+                    FROM %(geom_table)s %(where)s
+                ) AS parts
+                WHERE GeometryType(part) = 'POLYGON'
+            ''' % {'table': table, 'geom_table': geom_table, 'where': where},
+                [GEOMETRY_PART_MAX_VERTICES] + params)
+
+    def _refresh_python(self, geometry_ids):
+        # Without ST_Subdivide the parts are the polygons of the boundary
+        geometries = AdministrativeDivisionGeometry.objects.all()
+        parts = self.all()
+        if geometry_ids is not None:
+            geometries = geometries.filter(id__in=geometry_ids)
+            parts = parts.filter(geometry__in=geometry_ids)
+        parts.delete()
+        self.bulk_create([self.model(geometry=geom_obj, boundary=poly)
+                          for geom_obj in geometries for poly in geom_obj.boundary])
+
+
+class AdministrativeDivisionGeometryPart(models.Model):
+    """A piece of an AdministrativeDivisionGeometry with a bounded number of
+    vertices, for fast point-in-polygon queries."""
+    geometry = models.ForeignKey(AdministrativeDivisionGeometry, related_name='parts', on_delete=models.CASCADE)
+    boundary = models.PolygonField(srid=PROJECTION_SRID)
+
+    objects = AdministrativeDivisionGeometryPartManager()
 
 
 class Municipality(TranslatableModel):
@@ -121,6 +238,8 @@ class Plan(models.Model):
     geometry = models.MultiPolygonField(srid=PROJECTION_SRID)
     origin_id = models.CharField(max_length=20)
     in_effect = models.BooleanField(default=False)
+    # Digest of the geometry, so that importers can detect changes without loading it
+    geometry_digest = models.CharField(max_length=64, blank=True, editable=False)
 
     def __str__(self):
         effect = "in effect"
@@ -159,6 +278,9 @@ class Address(models.Model):
                               help_text="Building letter if applicable")
     location = models.PointField(srid=PROJECTION_SRID,
                                  help_text="Coordinates of the address")
+    divisions = models.ManyToManyField(AdministrativeDivision, through='AddressDivision',
+                                       related_name='addresses', blank=True,
+                                       help_text="Divisions that contain the address")
 
     modified_at = models.DateTimeField(auto_now=True,
                                        help_text='Time when the information was last changed')
@@ -177,6 +299,54 @@ class Address(models.Model):
         ordering = ['street', 'number']
 
 
+class AddressDivisionManager(models.Manager):
+    def refresh(self):
+        """Recomputes the divisions containing each address with one
+        spatial join against the subdivided division boundaries."""
+        connection = connections[self.db]
+        if connection.vendor != 'postgresql':
+            return self._refresh_python()
+
+        with transaction.atomic(using=self.db), connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s' % connection.ops.quote_name(self.model._meta.db_table))
+            # Points on the cut lines of the subdivision are in two parts
+            cursor.execute('''
+                INSERT INTO %(table)s (address_id, division_id)
+                SELECT DISTINCT a.id, g.division_id
+                FROM %(address_table)s a
+                JOIN %(part_table)s p ON ST_Intersects(p.boundary, a.location)
+                JOIN %(geom_table)s g ON g.id = p.geometry_id
+            ''' % {
+                'table': connection.ops.quote_name(self.model._meta.db_table),
+                'address_table': connection.ops.quote_name(Address._meta.db_table),
+                'part_table': connection.ops.quote_name(AdministrativeDivisionGeometryPart._meta.db_table),
+                'geom_table': connection.ops.quote_name(AdministrativeDivisionGeometry._meta.db_table),
+            })
+            return cursor.rowcount
+
+    def _refresh_python(self):
+        with transaction.atomic(using=self.db):
+            self.all().delete()
+            objs = [self.model(address_id=address_id, division_id=geom_obj.division_id)
+                    for geom_obj in AdministrativeDivisionGeometry.objects.all()
+                    for address_id in Address.objects.filter(location__intersects=geom_obj.boundary)
+                    .values_list('id', flat=True)]
+            self.bulk_create(objs, batch_size=1000)
+        return len(objs)
+
+
+class AddressDivision(models.Model):
+    """Membership of an address in a division, precomputed by the importers
+    so that the divisions of an address can be fetched with a join."""
+    address = models.ForeignKey(Address, on_delete=models.CASCADE)
+    division = models.ForeignKey(AdministrativeDivision, on_delete=models.CASCADE)
+
+    objects = AddressDivisionManager()
+
+    class Meta:
+        unique_together = (('address', 'division'),)
+
+
 class Building(models.Model):
     origin_id = models.CharField(max_length=40, db_index=True)
     municipality = models.ForeignKey(Municipality, db_index=True, on_delete=models.CASCADE)
@@ -212,3 +382,54 @@ class POI(models.Model):
 
     def __str__(self):
         return "%s (%s, %s)" % (self.name, self.category.type, self.municipality)
+
+
+# Entity types that have a data generation
+DATA_ENTITIES = ('municipalities', 'divisions', 'streets', 'addresses', 'pois', 'plans')
+
+
+class DataGenerationManager(models.Manager):
+    def get_generations(self):
+        """Returns the current generation of every entity type that has
+        been changed by an import."""
+        return dict(self.values_list('entity', 'generation'))
+
+    def bump(self, entities):
+        """Increments the generations of `entities`, sends `data_changed`
+        when the change is committed and returns the new generations."""
+        entities = sorted(set(entities))
+        if not entities:
+            return {}
+        with transaction.atomic(using=self.db):
+            for entity in entities:
+                self.get_or_create(entity=entity)
+            self.filter(entity__in=entities).update(generation=F('generation') + 1, updated_at=timezone.now())
+            generations = dict(self.filter(entity__in=entities).values_list('entity', 'generation'))
+            transaction.on_commit(lambda: data_changed.send(sender=self.model, generations=generations),
+                                  using=self.db)
+        return generations
+
+
+class DataGeneration(models.Model):
+    """A counter per entity type that importers increment whenever they
+    commit changes, so that API caches can tell when to invalidate."""
+    entity = models.CharField(max_length=50, unique=True)
+    generation = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = DataGenerationManager()
+
+    def __str__(self):
+        return "%s: %d" % (self.entity, self.generation)
+
+
+class ImportedSource(models.Model):
+    """The digest of the source data last imported by an import stage.
+    Kept with the data, so that snapshots, shadow imports and rollbacks
+    carry it along."""
+    stage = models.CharField(max_length=500, unique=True)
+    digest = models.CharField(max_length=64)
+    imported_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "%s: %s" % (self.stage, self.digest[:12])
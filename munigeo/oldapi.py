@@ -377,6 +377,7 @@ class PlanResource(ModelResource):
 
     class Meta:
         queryset = Plan.objects.all()
+        excludes = ['geometry_digest']
         filtering = {
             'municipality': ALL,
             'origin_id': ['exact'],
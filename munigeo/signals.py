@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent when an import has committed changes. `generations` maps the changed
+# entity types to their new DataGeneration numbers.
+data_changed = Signal()
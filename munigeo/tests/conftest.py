@@ -1,3 +1,5 @@
+import os
+
 import django
 from django.conf import settings
 
@@ -25,7 +27,10 @@ settings.configure(
     DATABASES={
         'default': {
             'ENGINE': 'django.contrib.gis.db.backends.postgis',
-            'NAME': 'servicemap-api',
+            'NAME': os.environ.get('DATABASE_NAME', 'servicemap-api'),
+            'USER': os.environ.get('DATABASE_USER', ''),
+            'PASSWORD': os.environ.get('DATABASE_PASSWORD', ''),
+            'HOST': os.environ.get('DATABASE_HOST', ''),
             'ATOMIC_REQUESTS': True,
         }
     },
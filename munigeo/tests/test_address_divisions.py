@@ -0,0 +1,31 @@
+import pytest
+from django.contrib.gis.geos import MultiPolygon, Point, Polygon
+
+from munigeo.models import (
+    Address, AddressDivision, AdministrativeDivision, AdministrativeDivisionGeometry,
+    AdministrativeDivisionGeometryPart, AdministrativeDivisionType, Municipality, PROJECTION_SRID, Street
+)
+
+
+@pytest.mark.django_db
+def test_address_division_refresh():
+    div_type = AdministrativeDivisionType.objects.create(type='district', name='District')
+    divs = []
+    for i in range(2):
+        div = AdministrativeDivision.objects.create(type=div_type, origin_id=str(i))
+        poly = Polygon.from_bbox((i * 100, 0, i * 100 + 100, 100))
+        poly.srid = PROJECTION_SRID
+        AdministrativeDivisionGeometry.objects.create(division=div, boundary=MultiPolygon(poly))
+        divs.append(div)
+    AdministrativeDivisionGeometryPart.objects.refresh()
+
+    muni = Municipality.objects.create(id='test', name='Test')
+    street = Street.objects.create(municipality=muni, name='Street')
+    inside = Address.objects.create(street=street, number='1', location=Point(50, 50, srid=PROJECTION_SRID))
+    # On the shared border of both divisions
+    border = Address.objects.create(street=street, number='2', location=Point(100, 50, srid=PROJECTION_SRID))
+    Address.objects.create(street=street, number='3', location=Point(500, 50, srid=PROJECTION_SRID))
+
+    assert AddressDivision.objects.refresh() == 3
+    assert list(inside.divisions.all()) == [divs[0]]
+    assert set(border.divisions.all()) == set(divs)
@@ -0,0 +1,62 @@
+import pytest
+from django.contrib.gis.geos import MultiPolygon, Point, Polygon
+from rest_framework.test import APIRequestFactory
+
+from munigeo.api import AddressViewSet, AdministrativeDivisionViewSet
+from munigeo.models import (
+    Address, AddressDivision, AdministrativeDivision, AdministrativeDivisionGeometry, AdministrativeDivisionType,
+    Municipality, PROJECTION_SRID, Street
+)
+
+
+def get_divisions(params):
+    request = APIRequestFactory().get('/administrative_division/', params)
+    response = AdministrativeDivisionViewSet.as_view({'get': 'list'})(request)
+    assert response.status_code == 200
+    response.render()
+    return response.data
+
+
+@pytest.mark.django_db
+def test_division_geometry_output():
+    div_type = AdministrativeDivisionType.objects.create(type='muni', name='Municipality')
+    div = AdministrativeDivision.objects.create(type=div_type, origin_id='1')
+    poly = Polygon(((0, 0), (0, 100), (100, 100), (100, 0), (0, 0)), srid=PROJECTION_SRID)
+    AdministrativeDivisionGeometry.objects.create(division=div, boundary=MultiPolygon(poly))
+
+    data = get_divisions({'geometry': 'true', 'srid': PROJECTION_SRID})
+    results = data['results'] if 'results' in data else data
+    assert len(results) == 1
+    assert results[0]['boundary']['type'] == 'MultiPolygon'
+    assert results[0]['bbox'] == [0, 0, 100, 100]
+    assert results[0]['label_point']['type'] == 'Point'
+
+
+def get_addresses(params):
+    request = APIRequestFactory().get('/address/', params)
+    response = AddressViewSet.as_view({'get': 'list'})(request)
+    response.render()
+    return response
+
+
+@pytest.mark.django_db
+def test_address_divisions_parameter():
+    div_type = AdministrativeDivisionType.objects.create(type='district', name='District')
+    div = AdministrativeDivision.objects.create(type=div_type, origin_id='1')
+    muni = Municipality.objects.create(id='test', name='Test')
+    street = Street.objects.create(municipality=muni, name='Street')
+    address = Address.objects.create(street=street, number='1', location=Point(50, 50, srid=PROJECTION_SRID))
+    AddressDivision.objects.create(address=address, division=div)
+
+    def get_divisions(value):
+        response = get_addresses({'divisions': value})
+        assert response.status_code == 200
+        data = response.data
+        results = data['results'] if 'results' in data else data
+        return results[0].get('divisions')
+
+    for value in ('true', '1', 'True', 'district'):
+        assert [d['origin_id'] for d in get_divisions(value)] == ['1']
+    for value in ('false', '0'):
+        assert get_divisions(value) is None
+    assert get_addresses({'divisions': 'district,nonexistent'}).status_code == 400
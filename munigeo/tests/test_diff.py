@@ -0,0 +1,83 @@
+import pytest
+from django.contrib.gis.geos import Point
+
+from munigeo.importer.base import Importer
+from munigeo.importer.diff import ImportDiff
+from munigeo.models import ImportedSource, Municipality, POI, POICategory, PROJECTION_SRID
+
+
+def test_diff_report():
+    diff = ImportDiff()
+    assert not diff.report()['changed']
+
+    diff.add('divisions:district', 'missing', '12')
+    diff.add_unchanged_stage('helsinki:pois')
+    assert not diff.has_changes
+
+    for i in range(3):
+        diff.add('addresses', 'created', 'street:%d' % i)
+    report = diff.report(max_ids=2)
+    assert report['changed']
+    assert report['entities']['addresses']['created'] == {'count': 3, 'ids': ['street:0', 'street:1']}
+    assert report['entities']['addresses']['deleted']['count'] == 0
+    assert report['unchanged_stages'] == ['helsinki:pois']
+
+
+class ExampleImporter(Importer):
+    name = 'example'
+
+
+@pytest.mark.django_db
+def test_dry_run_with_new_poi_category(settings, tmp_path):
+    settings.BASE_DIR = str(tmp_path)
+    settings.MUNIGEO_SOURCE_CACHE_DIR = str(tmp_path / 'cache')
+    muni = Municipality.objects.create(id='test', name='Test')
+    importer = ExampleImporter({'dry_run': True})
+
+    cats = importer.get_poi_categories({'library': 'Library'})
+    assert cats['library'].pk is None
+    point = Point(0, 0, srid=PROJECTION_SRID)
+    importer.sync_pois(POI.objects.all(), [
+        {'origin_id': 'test-1', 'name': 'Library', 'category': cats['library'], 'municipality': muni,
+         'location': point},
+    ])
+
+    assert not POICategory.objects.exists()
+    assert not POI.objects.exists()
+    report = importer.diff.report()
+    assert report['entities']['poi_categories']['created']['ids'] == ['library']
+    assert report['entities']['pois']['created']['ids'] == ['test-1']
+
+
+@pytest.mark.django_db
+def test_sync_pois_updates_poi_outside_queryset(settings, tmp_path):
+    settings.BASE_DIR = str(tmp_path)
+    settings.MUNIGEO_SOURCE_CACHE_DIR = str(tmp_path / 'cache')
+    muni = Municipality.objects.create(id='test', name='Test')
+    library = POICategory.objects.create(type='library', description='Library')
+    park = POICategory.objects.create(type='park', description='Park')
+    point = Point(0, 0, srid=PROJECTION_SRID)
+    poi = POI.objects.create(origin_id='1', name='Old', category=library, municipality=muni, location=point)
+
+    importer = ExampleImporter({})
+    importer.sync_pois(POI.objects.filter(category=park), [
+        {'origin_id': '1', 'name': 'Park', 'category': park, 'municipality': muni, 'location': point},
+    ])
+
+    poi = POI.objects.get()
+    assert (poi.name, poi.category) == ('Park', park)
+
+
+@pytest.mark.django_db
+def test_imported_sources_are_stored_in_database(settings, tmp_path):
+    settings.BASE_DIR = str(tmp_path)
+    settings.MUNIGEO_SOURCE_CACHE_DIR = str(tmp_path / 'cache')
+    importer = ExampleImporter({})
+    assert importer.source_changed('example:pois', 'abc')
+    importer.mark_imported('example:pois', 'abc')
+    assert not importer.source_changed('example:pois', 'abc')
+    assert importer.source_changed('example:pois', 'def')
+
+    # A database without the record imports the source again
+    ImportedSource.objects.all().delete()
+    assert ExampleImporter({}).source_changed('example:pois', 'abc')
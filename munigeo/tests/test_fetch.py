@@ -0,0 +1,80 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from munigeo.importer.fetch import SourceCache, SourceFetchError
+
+
+class FakeSourceHandler(BaseHTTPRequestHandler):
+    body = b'{"version": 1}'
+    etag = '"v1"'
+    hits = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.hits.append(self.headers.get('If-None-Match'))
+        if self.path == '/missing':
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.path.startswith('/slow'):
+            time.sleep(0.5)
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(self.body)
+
+
+@pytest.fixture
+def server_url():
+    FakeSourceHandler.hits = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSourceHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d' % server.server_port
+    server.shutdown()
+    server.server_close()
+
+
+def test_cache_revalidates(server_url, tmp_path):
+    cache = SourceCache(str(tmp_path))
+    url = server_url + '/source.json'
+
+    first = cache.fetch(url)
+    assert not first.from_cache
+    assert first.json() == {'version': 1}
+
+    # Revalidation with If-None-Match returns the cached copy
+    second = cache.fetch(url)
+    assert second.from_cache
+    assert second.digest == first.digest
+    assert FakeSourceHandler.hits == [None, '"v1"']
+
+    # Within the TTL the server is not contacted at all
+    cache.fetch(url, ttl=3600)
+    assert len(FakeSourceHandler.hits) == 2
+
+
+def test_cache_http_error(server_url, tmp_path):
+    cache = SourceCache(str(tmp_path))
+    with pytest.raises(SourceFetchError):
+        cache.fetch(server_url + '/missing')
+
+
+def test_cache_fetches_concurrently(server_url, tmp_path):
+    cache = SourceCache(str(tmp_path))
+    urls = [server_url + '/slow/%d' % i for i in range(4)]
+    start = time.time()
+    sources = cache.fetch_many(urls)
+    assert time.time() - start < 1.5
+    assert [source.url for source in sources] == urls
+    assert all(source.json() == {'version': 1} for source in sources)
@@ -0,0 +1,50 @@
+import pytest
+from django.contrib.gis.geos import MultiPolygon, Polygon
+
+from munigeo.importer.finland import FinlandImporter
+from munigeo.importer.geometry import TM35_SRID
+from munigeo.models import AdministrativeDivisionType, Municipality, PROJECTION_SRID
+from munigeo.utils import get_srs
+
+
+@pytest.fixture
+def cache_settings(settings, tmp_path):
+    settings.BASE_DIR = str(tmp_path)
+    settings.MUNIGEO_SOURCE_CACHE_DIR = str(tmp_path / 'cache')
+
+
+def get_square(x, srid):
+    return Polygon.from_bbox((385000 + x * 1000, 6672000, 385500 + x * 1000, 6672500), srid=srid)
+
+
+def test_transform_geometries_in_pool(cache_settings):
+    wkbs = [bytes(get_square(x, TM35_SRID).wkb) for x in range(8)]
+    srs_wkt = get_srs(TM35_SRID).wkt
+
+    serial = FinlandImporter({'workers': 1})._transform_geometries(wkbs, srs_wkt)
+    pooled = FinlandImporter({'workers': 2})._transform_geometries(wkbs, srs_wkt)
+    assert [bytes(geom.ewkb) for geom in pooled] == [bytes(geom.ewkb) for geom in serial]
+    assert all(geom.geom_type == 'MultiPolygon' and geom.srid == PROJECTION_SRID for geom in pooled)
+
+
+@pytest.mark.django_db
+def test_save_munis_skips_unchanged(cache_settings):
+    importer = FinlandImporter({})
+    importer.muni_type = AdministrativeDivisionType.objects.create(type='muni', name='Municipality')
+    munis = [
+        (('091', 'Helsinki', 'Helsingfors'), MultiPolygon(get_square(0, PROJECTION_SRID))),
+        (('049', 'Espoo', 'Esbo'), MultiPolygon(get_square(1, PROJECTION_SRID))),
+    ]
+    saved_divs, divs_changed, munis_changed = importer._save_munis(munis)
+    assert (len(saved_divs), divs_changed, munis_changed) == (2, 2, 2)
+    assert sorted(Municipality.objects.values_list('id', flat=True)) == ['espoo', 'helsinki']
+
+    assert importer._save_munis(munis)[1:] == (0, 0)
+
+    munis[1] = (('049', 'Espoo', 'Esbo'), MultiPolygon(get_square(2, PROJECTION_SRID)))
+    assert importer._save_munis(munis)[1:] == (1, 0)
+
+    munis[0] = (('091', 'Helsinki', 'Helsingfors stad'), munis[0][1])
+    assert importer._save_munis(munis)[1:] == (1, 1)
+    helsinki = Municipality.objects.language('sv').get(id='helsinki')
+    assert helsinki.name == 'Helsingfors stad'
@@ -0,0 +1,21 @@
+import pytest
+
+from munigeo.models import DataGeneration
+from munigeo.signals import data_changed
+
+
+@pytest.mark.django_db(transaction=True)
+def test_bump_generations():
+    received = []
+
+    def receiver(sender, generations, **kwargs):
+        received.append(generations)
+    data_changed.connect(receiver)
+    try:
+        assert DataGeneration.objects.bump(['divisions', 'streets']) == {'divisions': 1, 'streets': 1}
+        assert DataGeneration.objects.bump(['divisions']) == {'divisions': 2}
+    finally:
+        data_changed.disconnect(receiver)
+
+    assert DataGeneration.objects.get_generations() == {'divisions': 2, 'streets': 1}
+    assert received == [{'divisions': 1, 'streets': 1}, {'divisions': 2}]
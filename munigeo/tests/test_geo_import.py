@@ -0,0 +1,18 @@
+import os
+
+from munigeo.management.commands import geo_import
+
+
+def exit_worker(module, imp_type, options):
+    os._exit(1)
+
+
+def test_run_stages_survives_dead_workers(monkeypatch):
+    monkeypatch.setattr(geo_import, 'run_import_stage', exit_worker)
+    stages = [('example', 'municipalities'), ('example', 'divisions'), ('other', 'municipalities')]
+    results = geo_import.Command().run_stages(stages, {}, 2)
+
+    assert set(results) == set(stages)
+    assert results[('other', 'municipalities')]['status'] == 'failed'
+    assert results[('example', 'municipalities')]['status'] == 'failed'
+    assert results[('example', 'divisions')]['status'] in ('failed', 'skipped')
@@ -0,0 +1,71 @@
+import math
+
+import pytest
+from django.contrib.gis.geos import MultiPolygon, Point, Polygon
+
+from munigeo.importer.geometry import get_normalize_options, normalize_geometry
+from munigeo.models import AdministrativeDivision, AdministrativeDivisionGeometry, \
+    AdministrativeDivisionGeometryPart, AdministrativeDivisionType, PROJECTION_SRID
+
+
+def test_normalize_drops_noise_and_collinear_vertices():
+    # A 10 m square with sub-millimetre noise and collinear vertices on its edges
+    coords = [(0, 0), (5, 0.0001), (10, 0), (10, 5), (10.0002, 10), (5, 10), (0, 10), (0, 5), (0, 0)]
+    geom = Polygon(coords, srid=3067)
+    result = normalize_geometry(geom, get_normalize_options(None))
+    assert result.geom_type == 'MultiPolygon'
+    assert result.srid == 3067
+    assert result.num_coords == 5
+    assert abs(result.area - 100) < 0.01
+
+
+def test_normalize_repairs_invalid_polygon():
+    bowtie = Polygon([(0, 0), (10, 10), (10, 0), (0, 10), (0, 0)], srid=3067)
+    assert not bowtie.valid
+    result = normalize_geometry(bowtie, get_normalize_options({'simplify': 0}))
+    assert result.valid
+    assert abs(result.area - 50) < 0.01
+
+
+def test_normalize_can_be_disabled():
+    assert get_normalize_options(False) is None
+    assert get_normalize_options({'grid_size': 0.1})['grid_size'] == 0.1
+
+
+@pytest.mark.django_db
+def test_geometry_parts_refresh():
+    div_type = AdministrativeDivisionType.objects.create(type='muni', name='Municipality')
+    div = AdministrativeDivision.objects.create(type=div_type, origin_id='1')
+    # A circle with 2000 vertices around (25, 60)
+    ring = [(25 + 0.1 * math.cos(2 * math.pi * i / 2000), 60 + 0.1 * math.sin(2 * math.pi * i / 2000))
+            for i in range(2000)]
+    ring.append(ring[0])
+    poly = Polygon(ring, srid=4326)
+    poly.transform(PROJECTION_SRID)
+    geom_obj = AdministrativeDivisionGeometry.objects.create(division=div, boundary=MultiPolygon(poly))
+    # Saving a geometry refreshes its parts
+    assert geom_obj.parts.count() > 1
+
+    AdministrativeDivisionGeometryPart.objects.refresh([geom_obj.pk])
+    parts = list(geom_obj.parts.all())
+    assert len(parts) > 1
+    assert all(part.boundary.num_coords <= 256 for part in parts)
+
+    point = Point(25, 60, srid=4326)
+    point.transform(PROJECTION_SRID)
+    qs = AdministrativeDivision.objects.filter(geometry__parts__boundary__intersects=point).distinct()
+    assert list(qs) == [div]
+
+
+@pytest.mark.django_db
+def test_geometry_summary():
+    div_type = AdministrativeDivisionType.objects.create(type='muni', name='Municipality')
+    div = AdministrativeDivision.objects.create(type=div_type, origin_id='1')
+    # An L-shaped polygon whose centroid is outside of it
+    poly = Polygon(((0, 0), (0, 100), (10, 100), (10, 10), (100, 10), (100, 0), (0, 0)), srid=PROJECTION_SRID)
+    geom_obj = AdministrativeDivisionGeometry.objects.create(division=div, boundary=MultiPolygon(poly))
+
+    geom_obj = AdministrativeDivisionGeometry.objects.defer('boundary').get(pk=geom_obj.pk)
+    assert geom_obj.bbox.extent == (0, 0, 100, 100)
+    assert geom_obj.area == pytest.approx(1900)
+    assert poly.contains(geom_obj.label_point)
@@ -0,0 +1,111 @@
+import pytest
+from django.contrib.gis.geos import MultiPolygon, Point
+
+from munigeo.importer.helsinki import GK25_SRID, HelsinkiImporter
+from munigeo.models import (
+    Address, AddressDivision, AdministrativeDivision, AdministrativeDivisionGeometry, AdministrativeDivisionType,
+    DataGeneration, Municipality, PROJECTION_SRID, Street
+)
+
+
+class StagedReader:
+    """Stands in for the WFS reader the address rows are streamed from."""
+    digest = 'digest'
+    pages_read = 0
+
+    def partial_digest(self, pages):
+        return None
+
+
+@pytest.fixture
+def importer(settings, tmp_path):
+    settings.BASE_DIR = str(tmp_path)
+    settings.MUNIGEO_SOURCE_CACHE_DIR = str(tmp_path / 'cache')
+    return HelsinkiImporter({})
+
+
+@pytest.fixture
+def muni():
+    return Municipality.objects.create(id='helsinki', name='Helsinki')
+
+
+def import_addresses(importer, muni, rows):
+    rows = [('Helsinki',) + row for row in rows]
+    assert importer._import_addresses_copy(iter(rows), {'Helsinki': muni}, 'helsinki:addresses', StagedReader())
+
+
+def get_location(north, east):
+    point = Point(east, north, srid=GK25_SRID)
+    point.transform(PROJECTION_SRID)
+    return point
+
+
+def get_addresses():
+    addrs = Address.objects.filter(street__translations__language_code='fi')
+    return {(name, number, letter): location for name, number, letter, location in addrs.values_list(
+        'street__translations__name', 'number', 'letter', 'location')}
+
+
+def get_street_names():
+    return set(Street._parler_meta.root_model.objects.values_list('language_code', 'name'))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_address_import_merges_changes(importer, muni):
+    import_addresses(importer, muni, [
+        ('Testikatu', 'Testgatan', '1', None, None, 6672000, 25496000),
+        ('Testikatu', 'Testgatan', '2', None, None, 6672010, 25496000),
+        ('Testikatu', 'Testgatan', '3', None, 'a', 6672020, 25496000),
+        ('Toinenkatu', '', '1', None, None, 6673000, 25496000),
+    ])
+    addrs = get_addresses()
+    assert set(addrs) == {('Testikatu', '1', ''), ('Testikatu', '2', ''), ('Testikatu', '3', 'a'),
+                          ('Toinenkatu', '1', '')}
+    assert get_street_names() == {('fi', 'Testikatu'), ('sv', 'Testgatan'), ('fi', 'Toinenkatu')}
+    assert DataGeneration.objects.get_generations() == {'streets': 1, 'addresses': 1}
+
+    import_addresses(importer, muni, [
+        # Moved less than the tolerance
+        ('Testikatu', 'Provgatan', '1', None, None, 6672000.05, 25496000),
+        ('Testikatu', 'Provgatan', '2', None, None, 6672060, 25496000),
+        ('Testikatu', 'Provgatan', '4', None, None, 6672030, 25496000),
+        ('Kolmaskatu', 'Tredjegatan', '5', '7', None, 6674000, 25496000),
+    ])
+    moved = get_addresses()
+    assert set(moved) == {('Testikatu', '1', ''), ('Testikatu', '2', ''), ('Testikatu', '4', ''),
+                          ('Kolmaskatu', '5', '')}
+    assert moved['Testikatu', '1', ''] == addrs['Testikatu', '1', '']
+    assert moved['Testikatu', '2', ''].distance(get_location(6672060, 25496000)) < 0.01
+    assert Address.objects.get(number='5').number_end == '7'
+    assert get_street_names() == {('fi', 'Testikatu'), ('sv', 'Provgatan'),
+                                  ('fi', 'Kolmaskatu'), ('sv', 'Tredjegatan')}
+    assert Street.objects.count() == 2
+    assert DataGeneration.objects.get_generations() == {'streets': 2, 'addresses': 2}
+
+    import_addresses(importer, muni, [
+        ('Testikatu', 'Provgatan', '1', None, None, 6672000, 25496000),
+        ('Testikatu', 'Provgatan', '2', None, None, 6672060, 25496000),
+        ('Testikatu', 'Provgatan', '4', None, None, 6672030, 25496000),
+        ('Kolmaskatu', 'Tredjegatan', '5', '7', None, 6674000, 25496000),
+    ])
+    assert get_addresses() == moved
+    assert DataGeneration.objects.get_generations() == {'streets': 2, 'addresses': 2}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_address_import_removes_address_divisions(importer, muni):
+    import_addresses(importer, muni, [
+        ('Testikatu', 'Testgatan', '1', None, None, 6672000, 25496000),
+        ('Testikatu', 'Testgatan', '2', None, None, 6672010, 25496000),
+    ])
+    div_type = AdministrativeDivisionType.objects.create(type='district', name='District')
+    div = AdministrativeDivision.objects.create(type=div_type, origin_id='1')
+    poly = get_location(6671900, 25495900).buffer(1000)
+    AdministrativeDivisionGeometry.objects.create(division=div, boundary=MultiPolygon(poly))
+    assert AddressDivision.objects.refresh() == 2
+
+    import_addresses(importer, muni, [
+        ('Testikatu', 'Testgatan', '1', None, None, 6672000, 25496000),
+    ])
+    assert list(Address.objects.values_list('number', flat=True)) == ['1']
+    assert AddressDivision.objects.count() == 1
@@ -0,0 +1,46 @@
+import pytest
+from django.contrib.gis.geos import Polygon
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from munigeo.importer.geometry import geometry_digest
+from munigeo.importer.helsinki import HelsinkiImporter
+from munigeo.models import Municipality, Plan, PROJECTION_SRID
+
+
+@pytest.fixture
+def importer(settings, tmp_path):
+    settings.BASE_DIR = str(tmp_path)
+    settings.MUNIGEO_SOURCE_CACHE_DIR = str(tmp_path / 'cache')
+    return HelsinkiImporter({})
+
+
+def set_plans(monkeypatch, importer, plans):
+    """Makes the importer read `plans`, a dict of origin_id -> (in_effect, x),
+    instead of the plan boundary files."""
+    def read_plan_parts(fname, in_effect, out):
+        for origin_id, (plan_in_effect, x) in plans.items():
+            if plan_in_effect == in_effect:
+                poly = Polygon.from_bbox((x * 100, 0, x * 100 + 50, 50), srid=PROJECTION_SRID)
+                out[origin_id] = [in_effect, [poly]]
+    monkeypatch.setattr(importer, '_read_plan_parts', read_plan_parts)
+
+
+@pytest.mark.django_db
+def test_plan_import_skips_unchanged(importer, monkeypatch):
+    Municipality.objects.create(id='helsinki', name='Helsinki')
+    set_plans(monkeypatch, importer, {'1': (True, 0), '2': (False, 1)})
+    importer.import_plans()
+    assert Plan.objects.count() == 2
+
+    with CaptureQueriesContext(connection) as ctx:
+        importer.import_plans()
+    plan_queries = [q['sql'] for q in ctx.captured_queries if 'munigeo_plan' in q['sql']]
+    assert [sql for sql in plan_queries if sql.startswith(('INSERT', 'UPDATE', 'DELETE'))] == []
+    assert not any('"munigeo_plan"."geometry"' in sql for sql in plan_queries)
+
+    set_plans(monkeypatch, importer, {'1': (True, 0), '2': (True, 2)})
+    importer.import_plans()
+    plan = Plan.objects.get(origin_id='2')
+    assert plan.in_effect
+    assert plan.geometry_digest == geometry_digest(plan.geometry)
@@ -0,0 +1,16 @@
+import sys
+
+from munigeo.importer.base import find_importers, get_importer
+
+
+def test_find_importers_does_not_import_modules():
+    modules = find_importers()
+    assert modules['helsinki'] == 'munigeo.importer.helsinki'
+    assert modules['finland'] == 'munigeo.importer.finland'
+    assert 'munigeo.importer.athens' not in sys.modules
+
+
+def test_get_importer():
+    klass = get_importer('athens')
+    assert klass.name == 'athens'
+    assert 'munigeo.importer.manchester' not in sys.modules
@@ -0,0 +1,31 @@
+from munigeo.importer.journal import ImportJournal
+
+
+def test_journal_tracks_stages_and_progress(tmp_path):
+    path = str(tmp_path / 'journal.json')
+    journal = ImportJournal(path)
+    journal.set_progress('addresses', 'abc', 20000)
+    journal.mark_done('divisions', 'def')
+
+    journal = ImportJournal(path)
+    assert journal.stage_done('divisions', 'def')
+    assert not journal.stage_done('divisions', 'changed')
+    assert not journal.stage_done('addresses', 'abc')
+    assert journal.get_progress('addresses', 'abc') == 20000
+    # Progress made with another version of the source is not resumed
+    assert journal.get_progress('addresses', 'changed') is None
+
+    journal.reset()
+    assert not ImportJournal(path).stage_done('divisions', 'def')
+
+
+def test_journal_keeps_stages_of_other_processes(tmp_path):
+    path = str(tmp_path / 'journal.json')
+    first = ImportJournal(path)
+    second = ImportJournal(path)
+    first.mark_done('divisions', 'abc')
+    second.mark_done('addresses', 'def')
+
+    journal = ImportJournal(path)
+    assert journal.stage_done('divisions', 'abc')
+    assert journal.stage_done('addresses', 'def')
@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+from munigeo.importer.metrics import ImportMetrics
+from munigeo.models import AdministrativeDivisionType
+
+
+def test_metrics_accumulate_stages():
+    metrics = ImportMetrics()
+    for i in range(2):
+        with metrics.stage('parse') as m:
+            with metrics.stage('transform') as inner:
+                inner.add_rows(5)
+            m.add_rows(10)
+    report = metrics.report()['stages']
+    assert report['parse']['rows'] == 20
+    assert report['parse']['calls'] == 2
+    assert report['transform']['rows'] == 10
+    assert report['parse']['wall_time'] >= report['transform']['wall_time']
+
+
+@pytest.mark.django_db
+def test_metrics_trace_queries_and_memory(tmp_path):
+    metrics = ImportMetrics(trace=True)
+    with metrics.stage('write'):
+        for i in range(3):
+            AdministrativeDivisionType.objects.create(type='type%d' % i, name='Type %d' % i)
+        data = [bytearray(1024 * 1024)]
+    del data
+    path = str(tmp_path / 'metrics.json')
+    metrics.write(path)
+    with open(path) as f:
+        report = json.load(f)['stages']['write']
+    assert report['queries'] == 3
+    assert report['peak_memory'] >= 1024 * 1024
+
+
+def test_metrics_update():
+    metrics = ImportMetrics()
+    worker = ImportMetrics()
+    with metrics.stage('parse') as m:
+        m.add_rows(10)
+    with worker.stage('parse') as m:
+        m.add_rows(5)
+    with worker.stage('write'):
+        pass
+    metrics.update(worker)
+    report = metrics.report()['stages']
+    assert report['parse']['rows'] == 15
+    assert report['parse']['calls'] == 2
+    assert report['write']['calls'] == 1
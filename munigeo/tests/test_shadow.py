@@ -0,0 +1,57 @@
+import io
+
+import pytest
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+
+from munigeo.importer.shadow import SHADOW_SCHEMA, ShadowImport, swap_back
+from munigeo.management.commands import geo_import
+from munigeo.models import AdministrativeDivisionType
+
+
+@pytest.mark.django_db(transaction=True)
+def test_shadow_import_swap_and_rollback():
+    AdministrativeDivisionType.objects.create(type='muni', name='Municipality')
+
+    shadow = ShadowImport()
+    shadow.prepare()
+    shadow.activate()
+    try:
+        AdministrativeDivisionType.objects.create(type='district', name='District')
+        assert AdministrativeDivisionType.objects.count() == 2
+    finally:
+        shadow.deactivate()
+    # The live table is untouched until the swap
+    assert list(AdministrativeDivisionType.objects.values_list('type', flat=True)) == ['muni']
+
+    shadow.swap()
+    assert set(AdministrativeDivisionType.objects.values_list('type', flat=True)) == {'muni', 'district'}
+    # New rows do not collide with the copied ones
+    AdministrativeDivisionType.objects.create(type='sub_district', name='Sub-district')
+
+    swap_back()
+    assert list(AdministrativeDivisionType.objects.values_list('type', flat=True)) == ['muni']
+    swap_back()
+    assert AdministrativeDivisionType.objects.count() == 3
+
+
+@pytest.mark.django_db(transaction=True)
+def test_shadow_import_failed_stage_is_not_swapped(monkeypatch):
+    AdministrativeDivisionType.objects.create(type='muni', name='Municipality')
+
+    def run_stages(self, stages, options, jobs):
+        # A stage that commits part of its data before failing
+        AdministrativeDivisionType.objects.create(type='district', name='District')
+        return {stage: {'module': stage[0], 'type': stage[1], 'status': 'failed'} for stage in stages}
+
+    monkeypatch.setattr(geo_import, 'find_importers', lambda: {'example': 'example'})
+    monkeypatch.setattr(geo_import.Command, 'get_stages', lambda self, modules, options: [('example', 'divisions')])
+    monkeypatch.setattr(geo_import.Command, 'run_stages', run_stages)
+    with pytest.raises(CommandError):
+        call_command('geo_import', 'example', '--shadow', '--resume', stderr=io.StringIO())
+
+    assert list(AdministrativeDivisionType.objects.values_list('type', flat=True)) == ['muni']
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM pg_namespace WHERE nspname = %s", [SHADOW_SCHEMA])
+        assert cursor.fetchone()[0] == 0
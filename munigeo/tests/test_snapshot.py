@@ -0,0 +1,34 @@
+import pytest
+from django.contrib.gis.geos import MultiPolygon, Polygon
+
+from munigeo.importer.snapshot import dump_snapshot, restore_snapshot
+from munigeo.models import (
+    AdministrativeDivision, AdministrativeDivisionGeometry, AdministrativeDivisionType, PROJECTION_SRID
+)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_snapshot_round_trip(tmp_path):
+    div_type = AdministrativeDivisionType.objects.create(type='muni', name='Municipality')
+    parent = AdministrativeDivision.objects.create(type=div_type, origin_id='1', name='Parent')
+    child = AdministrativeDivision.objects.create(type=div_type, origin_id='2', name='Child', parent=parent)
+    poly = Polygon(((0, 0), (0, 10), (10, 10), (10, 0), (0, 0)), srid=PROJECTION_SRID)
+    AdministrativeDivisionGeometry.objects.create(division=child, boundary=MultiPolygon(poly))
+
+    path = str(tmp_path / 'munigeo.tar.gz')
+    manifest = dump_snapshot(path)
+    counts = {info['table']: info['rows'] for info in manifest['tables']}
+    assert counts[AdministrativeDivision._meta.db_table] == 2
+
+    AdministrativeDivision.objects.all().delete()
+    AdministrativeDivisionType.objects.all().delete()
+    restore_snapshot(path)
+
+    child = AdministrativeDivision.objects.get(origin_id='2')
+    assert child.name == 'Child'
+    assert child.parent.origin_id == '1'
+    assert child.geometry.boundary.equals(MultiPolygon(poly))
+    assert list(child.get_ancestors()) == [child.parent]
+    # Sequences are reset past the restored ids
+    new_div = AdministrativeDivision.objects.create(type=child.type, origin_id='3')
+    assert new_div.pk > child.pk
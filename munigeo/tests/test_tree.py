@@ -0,0 +1,39 @@
+import pytest
+
+from munigeo.importer.tree import placeholder_tree_fields, rebuild_trees
+from munigeo.models import AdministrativeDivision, AdministrativeDivisionType
+
+
+def tree_fields():
+    return {obj.origin_id: (obj.tree_id, obj.lft, obj.rght, obj.level)
+            for obj in AdministrativeDivision.objects.all()}
+
+
+@pytest.mark.django_db
+def test_rebuild_trees_matches_mptt():
+    div_type = AdministrativeDivisionType.objects.create(type='district', name='District')
+    other = AdministrativeDivision.objects.create(type=div_type, origin_id='other')
+    root = AdministrativeDivision.objects.create(type=div_type, origin_id='root')
+
+    with AdministrativeDivision.objects.disable_mptt_updates():
+        nodes = {}
+        for origin_id, parent in (('a', root), ('b', root), ('a1', 'a'), ('a2', 'a'), ('new_root', None)):
+            if isinstance(parent, str):
+                parent = nodes[parent]
+            obj = AdministrativeDivision(type=div_type, origin_id=origin_id, parent=parent)
+            placeholder_tree_fields(obj)
+            obj.save()
+            nodes[origin_id] = obj
+
+    rebuild_trees(AdministrativeDivision, {root.tree_id, 0})
+    rebuilt = tree_fields()
+    # The untouched tree keeps its fields
+    assert rebuilt['other'] == (other.tree_id, 1, 2, 0)
+    assert rebuilt['a2'][3] == 2
+    assert rebuilt['root'][1:] == (1, 10, 0)
+
+    AdministrativeDivision.objects.rebuild()
+    expected = tree_fields()
+    # Tree ids may be numbered differently, the structure must be the same
+    assert {key: val[1:] for key, val in rebuilt.items()} == {key: val[1:] for key, val in expected.items()}
+    assert len(set(val[0] for val in rebuilt.values())) == 3
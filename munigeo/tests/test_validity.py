@@ -0,0 +1,33 @@
+import datetime
+
+import pytest
+
+from munigeo.models import AdministrativeDivision, AdministrativeDivisionType
+
+
+@pytest.mark.django_db
+def test_valid_on():
+    div_type = AdministrativeDivisionType.objects.create(type='district', name='District')
+    always = AdministrativeDivision.objects.create(type=div_type, origin_id='1')
+    old = AdministrativeDivision.objects.create(type=div_type, origin_id='2', end=datetime.date(2016, 12, 31))
+    new = AdministrativeDivision.objects.create(type=div_type, origin_id='3', start=datetime.date(2017, 1, 1))
+    AdministrativeDivision.objects.create(type=div_type, origin_id='4', start=datetime.date(2017, 1, 1),
+                                          end=datetime.date(2016, 1, 1))
+
+    def valid_on(date):
+        return set(AdministrativeDivision.objects.valid_on(date))
+
+    assert valid_on(datetime.date(2016, 12, 31)) == {always, old}
+    assert valid_on(datetime.date(2017, 1, 1)) == {always, new}
+
+
+@pytest.mark.django_db
+def test_valid_on_in_subquery():
+    div_type = AdministrativeDivisionType.objects.create(type='district', name='District')
+    parent = AdministrativeDivision.objects.create(type=div_type, origin_id='1', end=datetime.date(2016, 12, 31))
+    child = AdministrativeDivision.objects.create(type=div_type, origin_id='2', parent=parent)
+
+    valid = AdministrativeDivision.objects.valid_on(datetime.date(2016, 1, 1))
+    assert list(AdministrativeDivision.objects.filter(parent__in=valid)) == [child]
+    valid = AdministrativeDivision.objects.valid_on(datetime.date(2017, 1, 1))
+    assert not AdministrativeDivision.objects.filter(parent__in=valid).exists()
@@ -0,0 +1,125 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from munigeo.importer.fetch import SourceCache
+from munigeo.importer.wfs import FeatureCollectionParser, WFSLayerNotFound, WFSReader
+
+FEATURES = [
+    {
+        'type': 'Feature',
+        'id': 'layer.%d' % i,
+        'properties': {'tunnus': i, 'nimi_fi': 'Alue %d' % i, 'nimi_se': 'Område %d' % i},
+        'geometry': None,
+    } for i in range(25)
+]
+
+
+class FakeWFSHandler(BaseHTTPRequestHandler):
+    requests_seen = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        params = {key.lower(): val[0] for key, val in parse_qs(urlsplit(self.path).query).items()}
+        self.requests_seen.append(params)
+        if params.get('typenames') != 'test:layer':
+            body = ('<ows:ExceptionReport><ows:Exception exceptionCode="InvalidParameterValue" '
+                    'locator="typeName"><ows:ExceptionText>Unknown layer</ows:ExceptionText>'
+                    '</ows:Exception></ows:ExceptionReport>').encode('utf8')
+            self.send_response(400)
+            self.send_header('Content-Type', 'application/xml')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        start = int(params['startindex'])
+        count = int(params['count'])
+        page = FEATURES[start:start + count]
+        doc = {
+            'type': 'FeatureCollection',
+            'features': page,
+            'numberMatched': len(FEATURES),
+            'numberReturned': len(page),
+        }
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(doc, ensure_ascii=False).encode('utf8'))
+
+
+@pytest.fixture
+def wfs_url():
+    FakeWFSHandler.requests_seen = []
+    server = HTTPServer(('127.0.0.1', 0), FakeWFSHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d/wfs?sortBy=tunnus' % server.server_port
+    server.shutdown()
+    server.server_close()
+
+
+def test_parser_handles_split_chunks():
+    doc = {'type': 'FeatureCollection', 'features': FEATURES, 'numberMatched': 25}
+    data = json.dumps(doc, ensure_ascii=False).encode('utf8')
+    for size in (1, 7, 1000):
+        parser = FeatureCollectionParser(data[i:i + size] for i in range(0, len(data), size))
+        assert list(parser) == FEATURES
+        assert parser.members['numberMatched'] == 25
+
+
+def test_reader_pages_through_layer(wfs_url):
+    reader = WFSReader(wfs_url, 'test:layer', srid=3879, page_size=10)
+    feats = list(reader)
+    assert [feat.get('tunnus') for feat in feats] == list(range(25))
+    assert feats[3]['nimi_se'].as_string() == 'Område 3'
+    assert reader.page_count == 3
+    seen = FakeWFSHandler.requests_seen
+    assert [int(params['startindex']) for params in seen] == [0, 10, 20]
+    assert all(params['srsname'] == 'EPSG:3879' for params in seen)
+    assert all(params['sortby'] == 'tunnus' for params in seen)
+
+
+def test_reader_unknown_layer(wfs_url):
+    reader = WFSReader(wfs_url, 'test:missing')
+    with pytest.raises(WFSLayerNotFound):
+        list(reader)
+
+
+def test_reader_filter_params():
+    reader = WFSReader('http://example.com/wfs', 'test:layer', bbox=(1, 2, 3, 4), bbox_srid=3067)
+    assert reader.get_page_params(0)['BBOX'] == '1,2,3,4,EPSG:3067'
+
+    reader = WFSReader('http://example.com/wfs', 'test:layer', filter="kunta = '091'")
+    params = reader.get_page_params(0)
+    assert params['CQL_FILTER'] == "kunta = '091'"
+    assert 'BBOX' not in params
+
+    # Servers reject BBOX together with CQL_FILTER, so the bbox goes into the filter
+    reader = WFSReader('http://example.com/wfs', 'test:layer', bbox=(1, 2, 3, 4), bbox_srid=3067,
+                       filter="kunta = '091'", geometry_field='the_geom')
+    params = reader.get_page_params(0)
+    assert params['CQL_FILTER'] == "(kunta = '091') AND BBOX(the_geom,1,2,3,4,'EPSG:3067')"
+    assert 'BBOX' not in params
+
+
+def test_reader_digest_after_streaming(wfs_url, tmp_path):
+    cache = SourceCache(str(tmp_path))
+    reader = WFSReader(wfs_url, 'test:layer', page_size=10, cache=cache)
+    assert reader.digest is None
+    assert len(list(reader)) == 25
+    digest = reader.digest
+    assert digest is not None
+    # Read from the pages of the first iteration
+    assert len(list(reader)) == 25
+    assert len(FakeWFSHandler.requests_seen) == 3
+    assert reader.digest == digest
+    assert reader.pages_read == 3
+    assert reader.partial_digest(3) == digest
+    assert reader.partial_digest(2) not in (None, digest)
+    assert reader.partial_digest(4) is None
+
+    assert WFSReader(wfs_url, 'test:layer', page_size=10, cache=cache).prefetch() == reader.digest
@@ -1,4 +1,9 @@
 from django.conf import settings
+from django.contrib.gis.gdal import CoordTransform, SpatialReference
+
+# GDAL objects are created on first use and shared, not at import time
+_srs_cache = {}
+_coord_transforms = {}
 
 
 def get_default_srid():
@@ -11,3 +16,20 @@ def get_default_srid():
         srid = 4326
 
     return srid
+
+
+def get_srs(srid):
+    srs = _srs_cache.get(srid)
+    if srs is None:
+        srs = SpatialReference(srid)
+        _srs_cache[srid] = srs
+    return srs
+
+
+def get_coord_transform(source_srid, target_srid):
+    key = (source_srid, target_srid)
+    ct = _coord_transforms.get(key)
+    if ct is None:
+        ct = CoordTransform(get_srs(source_srid), get_srs(target_srid))
+        _coord_transforms[key] = ct
+    return ct
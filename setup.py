@@ -19,10 +19,10 @@ setup(
     url='https://github.com/City-of-Helsinki/django-munigeo',
     author='City of Helsinki',
     author_email='dev@hel.fi',
+    python_requires='>=3.7',
     install_requires=[
-        'Django',
+        'Django>=3.2',
         'requests',
-        'requests_cache',
         'django_mptt',
         'django-parler>=2',
         'django-parler-rest',
@@ -38,14 +38,9 @@ setup(
         'License :: OSI Approved :: BSD License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.6',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.2',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
         'Topic :: Internet :: WWW/HTTP',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
         'Topic :: Scientific/Engineering :: GIS',